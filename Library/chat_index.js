@@ -0,0 +1,150 @@
+/* This script lists every chat in an output directory on index.html, with sorting and filtering, without any other libraries.
+
+chats.js next to index.html calls ChatIndex.add() with the entry of every chat from the manifest in library.py. A chat
+that was formatted again is added again, and its newest entry replaces the old one. It's loaded with a script tag
+instead of fetch(), so that the page also works when it's opened straight from the disk. */
+
+var ChatIndex = (function () {
+    'use strict';
+
+    var entries = {}; // The newest entry of every chat, by the path of its HTML file
+
+    var sortKey = 'last';
+    var ascending = false;
+
+    var rows, filterBox;
+
+    function escapeHtml(text) {
+        return String(text).replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;').replace(/"/g, '&quot;');
+    }
+
+    function formatBytes(bytes) {
+        var units = ['B', 'KB', 'MB', 'GB', 'TB'];
+        var i = 0;
+
+        while (bytes >= 1024 && i < units.length - 1) {
+            bytes /= 1024;
+            i++;
+        }
+
+        return (i === 0 ? bytes : bytes.toFixed(1)) + ' ' + units[i];
+    }
+
+    // Each part of a path is encoded on its own, because encodeURI() leaves # and ? in file names alone
+    function encodePath(path) {
+        return path.split('/').map(encodeURIComponent).join('/');
+    }
+
+    // ISO timestamps are shown as just their date
+    function formatDate(timestamp) {
+        return timestamp ? timestamp.slice(0, 10) : '';
+    }
+
+    function getSortValue(entry) {
+        var value = entry[sortKey];
+
+        if (sortKey === 'participants') {
+            return value.length;
+        }
+
+        if (typeof value === 'string') {
+            return value.toLowerCase();
+        }
+
+        return value === null ? '' : value;
+    }
+
+    function compare(a, b) {
+        var x = getSortValue(a);
+        var y = getSortValue(b);
+        var result = x < y ? -1 : (x > y ? 1 : 0);
+
+        return ascending ? result : -result;
+    }
+
+    function matches(entry, words) {
+        var text = (entry.title + ' ' + entry.participants.join(' ')).toLowerCase();
+
+        for (var i = 0; i < words.length; i++) {
+            if (text.indexOf(words[i]) === -1) {
+                return false;
+            }
+        }
+
+        return true;
+    }
+
+    function render() {
+        var words = filterBox.value.toLowerCase().split(/\s+/).filter(function (word) {
+            return word !== '';
+        });
+
+        var list = [];
+        for (var path in entries) {
+            if (entries.hasOwnProperty(path) && matches(entries[path], words)) {
+                list.push(entries[path]);
+            }
+        }
+
+        list.sort(compare);
+
+        var html = [];
+
+        for (var i = 0; i < list.length; i++) {
+            var entry = list[i];
+
+            html.push('<tr><td><a href="' + escapeHtml(encodePath(entry.html_path)) + '">' + escapeHtml(entry.title) + '</a></td>' +
+                '<td>' + escapeHtml(entry.participants.join(', ')) + '</td>' +
+                '<td>' + entry.messages + '</td>' +
+                '<td>' + formatDate(entry.first) + '</td>' +
+                '<td>' + formatDate(entry.last) + '</td>' +
+                '<td>' + formatBytes(entry.attachment_bytes) + '</td></tr>');
+        }
+
+        rows.innerHTML = html.join('');
+
+        var headings = document.querySelectorAll('th[data-key]');
+
+        for (var j = 0; j < headings.length; j++) {
+            var isSortKey = headings[j].getAttribute('data-key') === sortKey;
+
+            headings[j].className = isSortKey ? (ascending ? 'ascending' : 'descending') : '';
+        }
+    }
+
+    function sortBy(event) {
+        var key = event.target.getAttribute('data-key');
+
+        if (key === sortKey) {
+            ascending = !ascending;
+        } else {
+            sortKey = key;
+            ascending = key === 'title' || key === 'participants';
+        }
+
+        render();
+    }
+
+    return {
+        // Called by every line of chats.js
+        add: function (entry) {
+            entries[entry.html_path] = entry;
+        },
+
+        // Show the chats once chats.js has been loaded
+        show: function () {
+            rows = document.getElementById('chat-index-rows');
+            filterBox = document.getElementById('chat-index-filter');
+
+            var headings = document.querySelectorAll('th[data-key]');
+
+            for (var i = 0; i < headings.length; i++) {
+                headings[i].addEventListener('click', sortBy);
+            }
+
+            filterBox.addEventListener('input', render);
+
+            render();
+        }
+    };
+}());
@@ -0,0 +1,325 @@
+/* This script renders a chat that was formatted with the virtualized option, without any other libraries.
+
+The messages are in Data/<chat>/chunk_*.js files, which call WhatsAppViewer.chunk(), and Data/<chat>/index.js
+calls WhatsAppViewer.index() with the number of messages and the first message of every day. They're loaded with
+script tags instead of fetch(), so that the page also works when it's opened straight from the disk.
+
+Only a window of messages is in the page at once. Spacers above and below it stand in for the rest of the chat,
+so the scrollbar still covers the whole chat, and the window moves along as the page is scrolled. */
+
+var WhatsAppViewer = (function () {
+    'use strict';
+
+    var windowSize = 200; // The number of messages in the page at once
+    var step = 100; // The number of messages the window moves by
+    var uiHeight = 110; // The height of the black bar at the top, which covers the top of the page
+
+    var kinds = ['sender', 'recipient', 'meta'];
+
+    var dataPath;
+    var chatIndex = null;
+    var chunks = {};
+    var waiting = {};
+
+    var windowStart = 0;
+    var windowEnd = 0;
+    var averageHeight = 80; // The average height of a message in pixels, which is measured every time the window is rendered
+    var rendering = false;
+    var scheduled = false;
+
+    var topSpacer, messageWindow, bottomSpacer, datePicker;
+
+    function pad(n) {
+        var s = String(n);
+        while (s.length < 5) {
+            s = '0' + s;
+        }
+        return s;
+    }
+
+    function escapeHtml(text) {
+        return text.replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;').replace(/"/g, '&quot;');
+    }
+
+    function loadChunk(n, callback) {
+        if (chunks[n]) {
+            callback();
+            return;
+        }
+
+        if (waiting[n]) {
+            waiting[n].push(callback);
+            return;
+        }
+
+        waiting[n] = [callback];
+
+        var script = document.createElement('script');
+        script.src = dataPath + '/chunk_' + pad(n) + '.js';
+        document.head.appendChild(script);
+    }
+
+    // Load every chunk with messages from start up to end, and then call callback
+    function loadMessages(start, end, callback) {
+        if (end <= start) {
+            callback();
+            return;
+        }
+
+        var first = Math.floor(start / chatIndex.chunk_size);
+        var last = Math.floor((end - 1) / chatIndex.chunk_size);
+        var remaining = last - first + 1;
+
+        for (var n = first; n <= last; n++) {
+            loadChunk(n, function () {
+                remaining--;
+                if (remaining === 0) {
+                    callback();
+                }
+            });
+        }
+    }
+
+    function getMessage(i) {
+        return chunks[Math.floor(i / chatIndex.chunk_size)][i % chatIndex.chunk_size];
+    }
+
+    // Return the index in chatIndex.days of the day that message i is on
+    function getDay(i) {
+        var low = 0;
+        var high = chatIndex.days.length - 1;
+
+        while (low < high) {
+            var middle = Math.ceil((low + high) / 2);
+            if (chatIndex.days[middle][2] <= i) {
+                low = middle;
+            } else {
+                high = middle - 1;
+            }
+        }
+
+        return low;
+    }
+
+    // This makes the same HTML as Message.create_html() in library.py
+    function renderMessage(i, message, date) {
+        var kind = kinds[message[0]];
+        var name = message[1];
+        var content = message[2];
+        var time = message[3];
+
+        var info = '<span class="message-info date">' + date + '</span><p>' + content + '</p>' +
+            '<span class="message-info time">' + time + '</span>';
+
+        if (kind === 'meta') {
+            return '<div class="group-chat-meta" data-index="' + i + '">' + info + '</div>';
+        }
+
+        var recipientName = '';
+        if (name) {
+            recipientName = '<span class="recipient-name ' + escapeHtml(name.replace(/\u00a0/g, '-')) + '">' +
+                escapeHtml(name) + '</span>';
+        }
+
+        return '<div class="message ' + kind + '" data-index="' + i + '">' + recipientName + info + '</div>';
+    }
+
+    // Return the index of the first message that can be seen and how far it is from the top of the screen
+    function getFirstVisibleMessage() {
+        var elements = messageWindow.querySelectorAll('[data-index]');
+
+        for (var j = 0; j < elements.length; j++) {
+            var rect = elements[j].getBoundingClientRect();
+            if (rect.bottom > uiHeight) {
+                return {index: Number(elements[j].getAttribute('data-index')), top: rect.top};
+            }
+        }
+
+        return null;
+    }
+
+    function scrollMessageTo(i, top) {
+        var element = messageWindow.querySelector('[data-index="' + i + '"]');
+
+        if (element !== null) {
+            // Show the date separator above the first message of a day as well
+            var previous = element.previousElementSibling;
+            if (top === uiHeight && previous !== null && previous.className === 'date-separator') {
+                element = previous;
+            }
+
+            window.scrollBy(0, element.getBoundingClientRect().top - top);
+        }
+    }
+
+    // Render the window of messages starting at start, and then call after
+    function render(start, after) {
+        var total = chatIndex.total;
+
+        start = Math.max(0, Math.min(start, total - windowSize));
+        var end = Math.min(total, start + windowSize);
+
+        rendering = true;
+
+        loadMessages(start, end, function () {
+            var html = [];
+
+            for (var i = start; i < end; i++) {
+                var day = chatIndex.days[getDay(i)];
+
+                if (day[2] === i) {
+                    html.push('<div class="date-separator">' + day[0] + '</div>');
+                }
+
+                html.push(renderMessage(i, getMessage(i), day[0]));
+            }
+
+            messageWindow.innerHTML = html.join('');
+            windowStart = start;
+            windowEnd = end;
+
+            if (end > start && messageWindow.offsetHeight > 0) {
+                averageHeight = messageWindow.offsetHeight / (end - start);
+            }
+
+            topSpacer.style.height = Math.round(start * averageHeight) + 'px';
+            bottomSpacer.style.height = Math.round((total - end) * averageHeight) + 'px';
+
+            if (after) {
+                after();
+            }
+
+            rendering = false;
+
+            // The page might have been scrolled while the chunks were loading
+            schedule();
+        });
+    }
+
+    function update() {
+        scheduled = false;
+
+        if (rendering || chatIndex === null) {
+            return;
+        }
+
+        var rect = messageWindow.getBoundingClientRect();
+        var screenHeight = window.innerHeight;
+        var anchor;
+
+        if (rect.bottom < 0 || rect.top > screenHeight) {
+            // The scrollbar was dragged past the rendered messages, so work out which message should be at the top
+            var i = Math.floor((uiHeight - topSpacer.getBoundingClientRect().top) / averageHeight);
+            i = Math.max(0, Math.min(i, chatIndex.total - 1));
+
+            render(i - step / 2, function () {
+                scrollMessageTo(i, uiHeight);
+            });
+        } else if (windowEnd < chatIndex.total && rect.bottom < 2 * screenHeight) {
+            // Keep the first visible message where it is on the screen while the window moves down
+            anchor = getFirstVisibleMessage();
+
+            render(anchor === null ? windowStart + step : Math.min(windowStart + step, anchor.index), function () {
+                if (anchor !== null) {
+                    scrollMessageTo(anchor.index, anchor.top);
+                }
+            });
+        } else if (windowStart > 0 && rect.top > -screenHeight) {
+            anchor = getFirstVisibleMessage();
+
+            render(windowStart - step, function () {
+                if (anchor !== null) {
+                    scrollMessageTo(anchor.index, anchor.top);
+                }
+            });
+        }
+    }
+
+    function schedule() {
+        if (!scheduled) {
+            scheduled = true;
+            window.requestAnimationFrame(update);
+        }
+    }
+
+    function jumpTo(i) {
+        render(i - step / 2, function () {
+            scrollMessageTo(i, uiHeight);
+        });
+    }
+
+    function jumpToDate() {
+        var days = chatIndex.days;
+
+        // ISO dates can be compared as strings
+        for (var d = 0; d < days.length; d++) {
+            if (days[d][1] >= datePicker.value) {
+                jumpTo(days[d][2]);
+                return;
+            }
+        }
+
+        if (days.length > 0) {
+            jumpTo(days[days.length - 1][2]);
+        }
+    }
+
+    function toggleImage(event) {
+        var image = event.target;
+
+        if (image.tagName === 'IMG') {
+            if (image.classList.contains('small')) {
+                image.classList.remove('small');
+                image.classList.add('large');
+            } else {
+                image.classList.remove('large');
+                image.classList.add('small');
+            }
+        }
+    }
+
+    return {
+        // Start loading the chat whose data files are in path
+        open: function (path) {
+            dataPath = path;
+
+            topSpacer = document.getElementById('viewer-top-spacer');
+            messageWindow = document.getElementById('viewer-window');
+            bottomSpacer = document.getElementById('viewer-bottom-spacer');
+            datePicker = document.getElementById('viewer-date');
+
+            var script = document.createElement('script');
+            script.src = dataPath + '/index.js';
+            document.head.appendChild(script);
+        },
+
+        // Called by index.js
+        index: function (data) {
+            chatIndex = data;
+
+            if (data.days.length > 0) {
+                datePicker.min = data.days[0][1];
+                datePicker.max = data.days[data.days.length - 1][1];
+            }
+
+            datePicker.addEventListener('change', jumpToDate);
+            messageWindow.addEventListener('click', toggleImage);
+            window.addEventListener('scroll', schedule);
+            window.addEventListener('resize', schedule);
+
+            render(0);
+        },
+
+        // Called by every chunk_*.js file
+        chunk: function (n, messages) {
+            chunks[n] = messages;
+
+            var callbacks = waiting[n] || [];
+            delete waiting[n];
+
+            for (var j = 0; j < callbacks.length; j++) {
+                callbacks[j]();
+            }
+        }
+    };
+}());
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+# WhatsApp-Formatter is a program that takes exported WhatsApp chats and
+# formats them into more readable HTML files, with embedded attachments.
+#
+# Copyright (C) 2020 Doctor Dalek <https://github.com/DoctorDalek1963>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""This module checks that importing library stays fast and doesn't load any heavy or optional dependencies.
+
+Every import is timed in a fresh Python process, so nothing is already cached in sys.modules.
+Run it from the command line. It exits with status 1 if the budget is exceeded or a heavy module got imported.
+
+Functions:
+    time_import(module_name: str) -> Tuple[float, List[str]]:
+        Import module_name in a fresh Python process and return how long it took and which heavy modules it loaded.
+
+    benchmark_startup(budget: float = 0.1, runs: int = 5) -> bool:
+        Time importing library several times and return True if the fastest import is within budget.
+
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+from typing import Tuple, List
+
+# These modules must only be imported when a chat or the GUI actually needs them
+heavy_modules = ('pydub', 'PyQt5', 'PIL', 'concurrent.futures', 'profiling', 'cProfile', 'tracemalloc')
+
+# This is run in a fresh Python process to time the import
+timing_script = '''
+import json, sys, time
+start = time.perf_counter()
+import {module_name}
+duration = time.perf_counter() - start
+print(json.dumps([duration, [m for m in {heavy_modules!r} if m in sys.modules]]))
+'''
+
+
+def time_import(module_name: str) -> Tuple[float, List[str]]:
+    """Import module_name in a fresh Python process and return how long it took and which heavy modules it loaded."""
+    output = subprocess.run([sys.executable, '-c', timing_script.format(module_name=module_name, heavy_modules=heavy_modules)],
+                            capture_output=True, text=True, check=True).stdout
+
+    duration, loaded_heavy_modules = json.loads(output.splitlines()[-1])
+    return duration, loaded_heavy_modules
+
+
+def benchmark_startup(budget: float = 0.1, runs: int = 5) -> bool:
+    """Time importing library several times and return True if the fastest import is within budget.
+
+    The fastest of several runs is used, because the slower runs are mostly noise from the rest of the system.
+
+    Keyword arguments:
+        budget: float:
+            The maximum number of seconds that importing library is allowed to take.
+
+        runs: int:
+            The number of fresh processes to time the import in.
+
+    """
+    results = [time_import('library') for _ in range(runs)]
+    fastest = min(duration for duration, _ in results)
+    loaded_heavy_modules = sorted({module for _, modules in results for module in modules})
+
+    print(f'import library: {fastest * 1000:.1f} ms (budget {budget * 1000:.1f} ms, fastest of {runs} runs)')
+
+    if loaded_heavy_modules:
+        print(f'FAIL: import library loaded {", ".join(loaded_heavy_modules)}')
+        return False
+
+    if fastest > budget:
+        print('FAIL: import library is over budget')
+        return False
+
+    print('OK')
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that importing library stays under a time budget.')
+    parser.add_argument('--budget', type=float, default=0.1, help='the time budget in seconds (default: 0.1)')
+    parser.add_argument('--runs', type=int, default=5, help='the number of fresh processes to time (default: 5)')
+    args = parser.parse_args()
+
+    sys.exit(0 if benchmark_startup(args.budget, args.runs) else 1)
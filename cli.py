@@ -21,20 +21,68 @@
 """This module simply contains a function to run the CLI version of the WhatsApp Formatter.
 
 Functions:
-    run_cli:
+    print_progress(chat_key: str, progress: dict):
+        Print one progress report from process_list_of_chats().
+
+    print_resource_report(report: dict):
+        Print the limits of a resource governor and how much of them was used, from ResourceGovernor.report().
+
+    run_cli(profile: str = None, virtualized: bool = False, governor: ResourceGovernor = None, image_settings: ImageSettings = None):
         Run the command line version of the WhatsApp Formatter.
 
 """
 
+import argparse
+import multiprocessing
 import os
 import re
 import shutil
 
-from library import process_list_of_chats
+from images import ImageSettings
+from library import ResourceGovernor, get_resource_governor, process_list_of_chats
+
+
+def print_progress(chat_key: str, progress: dict) -> None:
+    """Print one progress report from process_list_of_chats()."""
+    print(f'{progress["title"]}: {progress["stage"]}, {progress["messages_parsed"]}/{progress["messages_total"]} messages, '
+          f'{progress["attachments_done"]}/{progress["attachments_total"]} attachments, '
+          f'{progress["transcodes_queued"]} audio conversions')
+
+
+def print_resource_report(report: dict) -> None:
+    """Print the limits of a resource governor and how much of them was used, from ResourceGovernor.report()."""
+    def gib(n: int) -> str:
+        return f'{n / 1024 ** 3:.1f} GiB'
+
+    limits, peak = report['limits'], report['peak']
+
+    print(f'Resource limits: {gib(limits["extraction_bytes"])} of extraction, {limits["transcodes"]} transcodes, '
+          f'{gib(limits["memory_bytes"])} of memory')
+    print(f'Peak use: {gib(peak["extraction_bytes"])} of extraction, {peak["transcodes"]} transcodes, '
+          f'{gib(peak["memory_bytes"])} of memory')
+    print(f'Work was held back {report["waits"]} times, for {report["wait_seconds"]:.1f} seconds in total')
 
 
-def run_cli() -> None:
-    """Run the command line version of the WhatsApp Formatter."""
+def run_cli(profile: str = None, virtualized: bool = False, governor: ResourceGovernor = None,
+            image_settings: ImageSettings = None) -> None:
+    """Run the command line version of the WhatsApp Formatter.
+
+    Keyword arguments:
+        profile: str:
+            None to not profile anything, or 'cprofile' or 'sampling' to profile every chat and write the profiles
+            next to their HTML files.
+
+        virtualized: bool:
+            If True, write every chat for the virtualized viewer, which is much faster for very long chats.
+
+        governor: ResourceGovernor:
+            The governor that limits the disk space, transcodes, and memory that the chats use at once.
+            It defaults to the one from get_resource_governor().
+
+        image_settings: ImageSettings:
+            Optional settings to recompress photos and stickers with, so the attachments take up less space.
+
+    """
     cwd = os.getcwd()
     process_flag = False
 
@@ -81,10 +129,51 @@ def run_cli() -> None:
     # Process list of chats
     print()
     print('Processing all...')
-    process_list_of_chats(all_chats)
+    if governor is None:
+        governor = get_resource_governor()
+
+    rejected_chats = process_list_of_chats(all_chats, event_sink=print_progress, event_interval=1.0, profile=profile,
+                                           virtualized=virtualized, governor=governor, image_settings=image_settings)
     shutil.rmtree('temp')
     print('Processing complete!')
 
+    for chat_data in rejected_chats:
+        print(f'Couldn\'t format {chat_data[0]}')
+    print_resource_report(governor.report())
+
 
 if __name__ == "__main__":
-    run_cli()
+    # The process pool for parsing large chats needs this in a compiled executable
+    multiprocessing.freeze_support()
+
+    parser = argparse.ArgumentParser(description='Format exported WhatsApp chats into HTML files.')
+    parser.add_argument('--profile', choices=('cprofile', 'sampling'), default=None,
+                        help='profile every chat and write the profiles next to their HTML files')
+    parser.add_argument('--virtualized', action='store_true',
+                        help='write the messages to data files for a viewer that only renders the ones on the screen')
+    parser.add_argument('--max-extraction-gb', type=float, default=None,
+                        help='the most GiB of zip files to extract at once (default: half the free disk space)')
+    parser.add_argument('--max-transcodes', type=int, default=None,
+                        help='the most audio and video conversions to run at once (default: the number of CPUs)')
+    parser.add_argument('--max-memory-gb', type=float, default=None,
+                        help='the most GiB of memory for work in flight (default: half the physical memory)')
+    parser.add_argument('--image-format', choices=tuple(ImageSettings.formats), default=None,
+                        help='recompress photos and stickers to this format (needs Pillow)')
+    parser.add_argument('--image-quality', type=int, default=80,
+                        help='the quality to recompress images at, from 1 to 100 (default: 80)')
+    parser.add_argument('--image-max-size', type=int, default=2048,
+                        help='scale down recompressed images to at most this many pixels wide and high (default: 2048)')
+    args = parser.parse_args()
+
+    image_settings = None
+    if args.image_format is not None:
+        try:
+            image_settings = ImageSettings(args.image_format, args.image_quality, args.image_max_size)
+        except (ImportError, ValueError) as e:
+            parser.error(str(e))
+
+    run_cli(profile=args.profile, virtualized=args.virtualized, image_settings=image_settings,
+            governor=ResourceGovernor(
+                extraction_bytes=int(args.max_extraction_gb * 1024 ** 3) if args.max_extraction_gb is not None else None,
+                transcodes=args.max_transcodes,
+                memory_bytes=int(args.max_memory_gb * 1024 ** 3) if args.max_memory_gb is not None else None))
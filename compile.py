@@ -50,6 +50,8 @@ def compile_formatter(gui=True) -> None:
     # Copy dependencies to temporary directory
     shutil.copy('start_template.txt', 'compile_temp/')
     shutil.copy('end_template.txt', 'compile_temp/')
+    shutil.copy('viewer_template.txt', 'compile_temp/')
+    shutil.copy('index_template.txt', 'compile_temp/')
     shutil.copytree('Library', 'compile_temp/Library')
     shutil.copy('release_readme.md', 'compile_temp/README.md')
     shutil.copy('style_gui.css', 'compile_temp/')
@@ -0,0 +1,181 @@
+# WhatsApp-Formatter is a program that takes exported WhatsApp chats and
+# formats them into more readable HTML files, with embedded attachments.
+#
+# Copyright (C) 2020 Doctor Dalek <https://github.com/DoctorDalek1963>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""This module has exporters which write the parsed messages of chats to machine-readable files, next to the HTML.
+
+An exporter is passed to process_list_of_chats() (or process_chat()) in a list as the exporters keyword argument.
+Every chat sends it the records of its messages in batches, from the same pass that renders the HTML, so the chat
+is only parsed once. Exporters are shared by every chat in a batch, so they're all thread-safe.
+The caller creates the exporters and has to close them when the batch is finished.
+
+A batch that's resumed from a journal skips the chats that are already done and restarts the others, so only
+exporters that can forget a chat's earlier records, like SQLiteExporter, can be used with it. The others have the
+resumable attribute set to False, and process_list_of_chats() only lets them be used with a fresh journal.
+
+Classes:
+    MessageExporter:
+        The base class of every exporter.
+
+    JSONLinesExporter:
+        An exporter which streams one JSON object per message to a JSON Lines file.
+
+    SQLiteExporter:
+        An exporter which inserts every message into a table of an SQLite database.
+
+"""
+
+import abc
+import json
+import sqlite3
+import threading
+
+
+class MessageExporter(abc.ABC):
+    """The base class of every exporter.
+
+    Attributes:
+        resumable: bool:
+            True if the exporter can be used in a batch that's resumed from a journal, because start_chat()
+            removes the records that a chat wrote before it was interrupted.
+
+    Methods:
+        start_chat(chat_key: str) -> None:
+            Forget any records already written for a chat, because it's about to be written from the start.
+
+        write_messages(chat_key: str, chat_title: str, records: list) -> None:
+            Write a batch of message records from one chat.
+
+        close() -> None:
+            Finish writing and close the underlying file.
+
+    """
+
+    resumable = False
+
+    def __init__(self):
+        """Create the lock that makes the exporter thread-safe."""
+        self._lock = threading.Lock()
+
+    def start_chat(self, chat_key: str) -> None:
+        """Forget any records already written for a chat, because it's about to be written from the start.
+
+        Every chat calls this before its first batch. Exporters that aren't resumable only ever see each chat once,
+        so by default it does nothing.
+        """
+
+    @abc.abstractmethod
+    def write_messages(self, chat_key: str, chat_title: str, records: list) -> None:
+        """Write a batch of message records from one chat.
+
+        Arguments:
+            chat_key: str:
+                The key of the chat, from make_chat_key() in library.py.
+
+            chat_title: str:
+                The title of the chat.
+
+            records: list:
+                The records of the messages, in order. See Message.to_record() in library.py.
+
+        """
+
+    @abc.abstractmethod
+    def close(self) -> None:
+        """Finish writing and close the underlying file."""
+
+
+class JSONLinesExporter(MessageExporter):
+    """An exporter which streams one JSON object per message to a JSON Lines file.
+
+    Every object has the keys of Message.to_record(), plus chat_key and chat_title.
+    The messages of one chat stay in order, but the batches of different chats can be interleaved.
+    Lines can't be taken back out of the file, so this exporter isn't resumable.
+    """
+
+    def __init__(self, output_file: str):
+        """Open output_file for writing, overwriting it if it already exists."""
+        super().__init__()
+        self._file = open(output_file, 'w', encoding='utf-8')
+
+    def write_messages(self, chat_key: str, chat_title: str, records: list) -> None:
+        """Write a batch of message records from one chat as JSON lines."""
+        lines = ''.join(json.dumps({'chat_key': chat_key, 'chat_title': chat_title, **record}, ensure_ascii=False) + '\n'
+                        for record in records)
+
+        with self._lock:
+            self._file.write(lines)
+
+    def close(self) -> None:
+        """Close the JSON Lines file."""
+        with self._lock:
+            self._file.close()
+
+
+class SQLiteExporter(MessageExporter):
+    """An exporter which inserts every message into the messages table of an SQLite database.
+
+    The table has a column for every key of Message.to_record(), plus chat_key and chat_title.
+    The messages of every batch are inserted in one transaction, and the indexes on sender and timestamp are
+    created when the exporter is closed, so that they don't slow down the inserts. A chat's rows are deleted
+    when it starts, so a resumed batch doesn't insert them twice, and the rows of chats finished in earlier runs
+    are kept. The index on chat_key is created with the table, so that deleting them doesn't scan the whole table.
+    """
+
+    resumable = True
+
+    columns = ('chat_key', 'chat_title', 'sender', 'timestamp', 'kind', 'raw_text', 'formatted_text',
+               'attachment_path', 'attachment_type')
+
+    def __init__(self, database_file: str):
+        """Connect to database_file and create the messages table and its chat_key index if they don't already exist."""
+        super().__init__()
+
+        # The lock stops two threads from using the connection at once
+        self._connection = sqlite3.connect(database_file, check_same_thread=False)
+        self._connection.execute('PRAGMA synchronous = NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, '
+                                 + ', '.join(f'{column} TEXT' for column in SQLiteExporter.columns) + ')')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS messages_chat_key ON messages (chat_key)')
+        self._connection.commit()
+
+        self._insert_statement = f'INSERT INTO messages ({", ".join(SQLiteExporter.columns)}) ' \
+                                 f'VALUES ({", ".join("?" * len(SQLiteExporter.columns))})'
+
+    def start_chat(self, chat_key: str) -> None:
+        """Delete the rows that a chat inserted before it was interrupted."""
+        with self._lock:
+            with self._connection:
+                self._connection.execute('DELETE FROM messages WHERE chat_key = ?', (chat_key,))
+
+    def write_messages(self, chat_key: str, chat_title: str, records: list) -> None:
+        """Insert a batch of message records from one chat in one transaction."""
+        rows = [(chat_key, chat_title) + tuple(record[column] for column in SQLiteExporter.columns[2:])
+                for record in records]
+
+        with self._lock:
+            with self._connection:
+                self._connection.executemany(self._insert_statement, rows)
+
+    def close(self) -> None:
+        """Create the indexes and close the database."""
+        with self._lock:
+            with self._connection:
+                for column in ('sender', 'timestamp'):
+                    self._connection.execute(f'CREATE INDEX IF NOT EXISTS messages_{column} ON messages ({column})')
+
+            self._connection.close()
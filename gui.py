@@ -31,6 +31,7 @@ Functions:
         Create an instance of the GUI window and show it. Takes no arguments.
 """
 
+import multiprocessing
 import os
 import sys
 import threading
@@ -41,7 +42,7 @@ from PyQt5 import QtCore, QtWidgets
 from PyQt5.QtGui import QKeySequence
 from PyQt5.QtWidgets import QMainWindow, QApplication, QVBoxLayout, QHBoxLayout, QWidget, QShortcut
 
-from library import process_list_of_chats
+from library import make_chat_key, process_list_of_chats
 
 
 # This is a function I copied from [StackOverflow](https://stackoverflow.com/questions/64336575/select-a-file-or-a-folder-in-qfiledialog-pyqt5)
@@ -100,6 +101,11 @@ class FormatterGUI(QMainWindow):
     You have to create an instance (no arguments taken) and then call show() to show the window.
     """
 
+    # These signals are emitted from the processing thread and handled in the GUI thread,
+    # so the processing thread never touches the widgets and the GUI thread never waits on processing
+    _progress_signal = QtCore.pyqtSignal(str, dict)
+    _processing_finished_signal = QtCore.pyqtSignal()
+
     def __init__(self):
         """Create an instance of the WhatsApp Formatter GUI.
 
@@ -126,7 +132,7 @@ the top of the page and in the tab title)\n
 8. Repeat steps 1-7 until you have selected all your chats\n
 9. Click the 'Process all' button\n
 10. Wait until the 'Processing...' text disappears
-(This may take quite a while if you've selected several large chats)\n
+(The progress bars show how far each chat has got)\n
 11. Once the 'Exit' button is active, you can safely exit the program'''
         self._all_chats_list = []
         self._group_chat = False
@@ -204,6 +210,10 @@ the top of the page and in the tab title)\n
         self._processing_label.setText('')
         self._processing_label.setAlignment(QtCore.Qt.AlignCenter)
 
+        # A progress bar for every chat being processed, keyed by make_chat_key()
+        self._progress_bars = {}
+        self._progress_vbox = QVBoxLayout()
+
         self._exit_button = QtWidgets.QPushButton(self)
         self._exit_button.setText('Exit')
         self._exit_button.clicked.connect(self._close_properly)
@@ -227,6 +237,9 @@ the top of the page and in the tab title)\n
 
         self._process_all_thread: threading.Thread
 
+        self._progress_signal.connect(self._update_progress_bar)
+        self._processing_finished_signal.connect(self._finish_processing)
+
     def _set_sender_name(self) -> None:
         """Set self._sender_name to value."""
         self._sender_name = self._sender_name_textbox.text()
@@ -277,6 +290,7 @@ the top of the page and in the tab title)\n
         self._vbox.addWidget(self._add_to_list_button)
         self._vbox.addWidget(self._process_all_button)
         self._vbox.addWidget(self._processing_label)
+        self._vbox.addLayout(self._progress_vbox)
         self._vbox.addWidget(self._exit_button)
         self._hbox.setSpacing(20)
 
@@ -336,28 +350,68 @@ the top of the page and in the tab title)\n
 
         self._process_all_button.setEnabled(True)
 
-    def _process_all_chats(self) -> None:
-        """Process all the lists of chat data in self._all_chats_list with functions.process_list()."""
-        # Disable the exit button until the process_all function returns
-        self._exit_button.setEnabled(False)
-        self._processing_label.setText('Processing...')
+    def _create_progress_bars(self, all_chats: list) -> None:
+        """Replace the progress bars with a new one for every chat in all_chats."""
+        for progress_bar in self._progress_bars.values():
+            self._progress_vbox.removeWidget(progress_bar)
+            progress_bar.deleteLater()
 
-        # Assign all chats to temporary variable to allow the process_all button to be disabled
-        all_chats = self._all_chats_list.copy()
-        self._all_chats_list.clear()
-        process_list_of_chats(all_chats)
+        self._progress_bars.clear()
+
+        for chat_data in all_chats:
+            progress_bar = QtWidgets.QProgressBar(self)
+            progress_bar.setFormat(f'{chat_data[3]}: waiting')
+            progress_bar.setValue(0)
+
+            self._progress_bars[make_chat_key(chat_data[0], chat_data[4], chat_data[5])] = progress_bar
+            self._progress_vbox.addWidget(progress_bar)
+
+    def _update_progress_bar(self, chat_key: str, progress: dict) -> None:
+        """Show a progress report from process_list_of_chats() on the chat's progress bar."""
+        if (progress_bar := self._progress_bars.get(chat_key)) is None:
+            return
+
+        total = max(progress['messages_total'] + progress['attachments_total'], 1)
+        done = progress['messages_parsed'] + progress['attachments_done']
+
+        if progress['stage'] == 'done':
+            done = total
 
+        progress_bar.setMaximum(total)
+        progress_bar.setValue(min(done, total))
+        progress_bar.setFormat(f'{progress["title"]}: {progress["stage"].replace("_", " ")} (%p%)')
+
+    def _process_all_chats(self, all_chats: list) -> None:
+        """Process all the lists of chat data in all_chats with library.process_list_of_chats(). This runs in its own thread."""
+        try:
+            process_list_of_chats(all_chats, event_sink=self._progress_signal.emit)
+
+            # Remove temporary directory
+            if os.path.isdir('temp'):
+                rmtree('temp')
+        finally:
+            # Even if processing failed, the exit button has to be enabled again
+            self._processing_finished_signal.emit()
+
+    def _finish_processing(self) -> None:
+        """Re-enable the exit button once self._process_all_chats() has finished."""
         self._processing_label.setText('')
         self._exit_button.setEnabled(True)
 
-        # Remove temporary directory
-        if os.path.isdir('temp'):
-            rmtree('temp')
-
     def _process_all(self) -> None:
         """Run self._process_all_chats() in a thread."""
         self._process_all_button.setEnabled(False)
-        self._process_all_thread = threading.Thread(target=self._process_all_chats)
+
+        # Disable the exit button until the process_all function returns
+        self._exit_button.setEnabled(False)
+        self._processing_label.setText('Processing...')
+
+        # Assign all chats to temporary variable to allow the process_all button to be disabled
+        all_chats = self._all_chats_list.copy()
+        self._all_chats_list.clear()
+        self._create_progress_bars(all_chats)
+
+        self._process_all_thread = threading.Thread(target=self._process_all_chats, args=(all_chats,))
         self._process_all_thread.start()
 
     def _close_properly(self) -> None:
@@ -375,4 +429,6 @@ def show_window() -> None:
 
 
 if __name__ == '__main__':
+    # The process pool for parsing large chats needs this in a compiled executable
+    multiprocessing.freeze_support()
     show_window()
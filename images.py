@@ -0,0 +1,209 @@
+# WhatsApp-Formatter is a program that takes exported WhatsApp chats and
+# formats them into more readable HTML files, with embedded attachments.
+#
+# Copyright (C) 2020 Doctor Dalek <https://github.com/DoctorDalek1963>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""This module recompresses photos and stickers, which is used when a chat is formatted with the image_settings option.
+
+Pillow is only needed if images are recompressed. ImageSettings checks that it's installed without importing it,
+and it's only imported by optimise_image(), in the process pool.
+
+Classes:
+    ImageSettings:
+        The format, quality, and maximum size to recompress images to, and where to cache them.
+
+Functions:
+    optimise_image(source_path: str, destination_path: str, settings: ImageSettings) -> bool:
+        Recompress an image to destination_path, or copy it from the cache if it has been recompressed before.
+        Return False without writing anything if the image can't be read.
+
+"""
+
+import hashlib
+import importlib.util
+import os
+import shutil
+from typing import Optional
+
+
+class ImageSettings:
+    """The format, quality, and maximum size to recompress images to, and where to cache them.
+
+    Photos are always recompressed. Stickers have transparency, so they're only recompressed to WebP, and other
+    attachments are never recompressed. The object is passed to the worker processes, so it has to stay picklable.
+
+    Methods:
+        get_output_filename(filename: str, file_type: str) -> Optional[str]:
+            Return the name of the recompressed version of an attachment, or None if it isn't recompressed.
+
+    """
+
+    # Dict of formats and the extensions of their files
+    formats = {'webp': '.webp', 'jpeg': '.jpg'}
+
+    def __init__(self, image_format: str = 'webp', quality: int = 80, max_size: int = 2048, cache_dir: str = '.image_cache'):
+        """Create an ImageSettings object.
+
+        Keyword arguments:
+            image_format: str:
+                The format to recompress images to, which is 'webp' or 'jpeg'.
+
+            quality: int:
+                The quality to encode images at, from 1 to 100.
+
+            max_size: int:
+                The maximum width and height of an image in pixels. Bigger images are scaled down to fit.
+
+            cache_dir: str:
+                The directory of recompressed images, named after the hash of their contents and the settings, so
+                the same image is only recompressed once, even in different chats. It's created if it doesn't exist.
+
+        Raises:
+            ImportError:
+                If Pillow isn't installed.
+
+            ValueError:
+                If image_format isn't one of ImageSettings.formats, or quality or max_size is out of range.
+
+        """
+        # The HTML links to the recompressed names before the images are recompressed, so they have to be made
+        if importlib.util.find_spec('PIL') is None:
+            raise ImportError('Pillow is needed to recompress images. Install it with pip install Pillow.')
+
+        if image_format not in ImageSettings.formats:
+            raise ValueError(f'Expected an image format in {tuple(ImageSettings.formats)}. Got {image_format!r} instead.')
+
+        if not 1 <= quality <= 100 or max_size < 1:
+            raise ValueError(f'Expected a quality from 1 to 100 and a positive maximum size. Got {quality} and {max_size} instead.')
+
+        self.image_format = image_format
+        self.quality = quality
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+
+    def __repr__(self) -> str:
+        """Return a __repr__ of the ImageSettings instance with its format, quality, and maximum size."""
+        return f'<{self.__class__.__module__}.{self.__class__.__name__} {self.image_format} at quality {self.quality}, ' \
+               f'at most {self.max_size}px>'
+
+    def get_output_filename(self, filename: str, file_type: str) -> Optional[str]:
+        """Return the name of the recompressed version of an attachment, or None if it isn't recompressed.
+
+        Arguments:
+            filename: str:
+                The name of the attachment in the export.
+
+            file_type: str:
+                The type of the attachment, like 'PHOTO'.
+
+        """
+        if file_type == 'PHOTO' or (file_type == 'STICKER' and self.image_format == 'webp'):
+            return os.path.splitext(filename)[0] + ImageSettings.formats[self.image_format]
+
+        return None
+
+
+def _hash_file(path: str, settings: ImageSettings) -> str:
+    """Return the hash of the contents of a file and the settings that change how it's recompressed."""
+    file_hash = hashlib.sha256(f'{settings.image_format}|{settings.quality}|{settings.max_size}|'.encode('utf-8'))
+
+    with open(path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+def _encode_image(source_path: str, temp_path: str, settings: ImageSettings) -> bool:
+    """Recompress an image to temp_path with Pillow.
+
+    Returns True if it was recompressed, and False if Pillow can't read the image, in which case nothing is written.
+    An animated image keeps every frame at its original size if it's recompressed to WebP, and only its first frame
+    if it's recompressed to JPEG.
+    """
+    from PIL import Image, ImageOps
+
+    try:
+        with Image.open(source_path) as image:
+            if getattr(image, 'is_animated', False) and settings.image_format == 'webp':
+                image.save(temp_path, 'WEBP', save_all=True, quality=settings.quality, method=6)
+                return True
+
+            # The EXIF data isn't kept, so the photo has to be turned the right way up first
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((settings.max_size, settings.max_size))
+
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA' if 'A' in image.mode or 'transparency' in image.info else 'RGB')
+
+            if settings.image_format == 'jpeg':
+                if image.mode == 'RGBA':  # JPEG has no transparency, so it goes on a white background
+                    background = Image.new('RGB', image.size, (255, 255, 255))
+                    background.paste(image, mask=image.getchannel('A'))
+                    image = background
+
+                image.save(temp_path, 'JPEG', quality=settings.quality, optimize=True, progressive=True)
+            else:
+                image.save(temp_path, 'WEBP', quality=settings.quality, method=6)
+
+    except (OSError, ValueError, Image.DecompressionBombError):
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+
+        return False
+
+    return True
+
+
+def optimise_image(source_path: str, destination_path: str, settings: ImageSettings) -> bool:
+    """Recompress an image to destination_path, or copy it from the cache if it has been recompressed before.
+
+    If the recompressed image would be bigger than the original, and the original is already in the right format
+    and small enough, the original is cached instead. Nothing is ever written to destination_path in a different
+    format from its extension, so an image that Pillow can't read isn't written at all. This is run in the process pool.
+
+    Returns:
+        True if destination_path is the recompressed image, and False if the image couldn't be read.
+
+    """
+    extension = ImageSettings.formats[settings.image_format]
+    cache_path = os.path.join(settings.cache_dir, _hash_file(source_path, settings) + extension)
+
+    if os.path.isfile(cache_path):
+        shutil.copyfile(cache_path, destination_path)
+        return True
+
+    os.makedirs(settings.cache_dir, exist_ok=True)
+
+    # Several processes can recompress the same image at once, so each writes to its own file and then moves it into place
+    temp_path = f'{cache_path}.{os.getpid()}.tmp{extension}'
+
+    if not _encode_image(source_path, temp_path, settings):
+        return False
+
+    if os.path.getsize(temp_path) >= os.path.getsize(source_path) and \
+            os.path.splitext(source_path)[1].lower() in (extension, '.jpeg' if extension == '.jpg' else extension):
+        from PIL import Image
+
+        with Image.open(source_path) as image:
+            small_enough = max(image.size) <= settings.max_size
+
+        if small_enough:
+            shutil.copyfile(source_path, temp_path)
+
+    os.replace(temp_path, cache_path)
+    shutil.copyfile(cache_path, destination_path)
+    return True
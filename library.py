@@ -22,6 +22,33 @@ Classes:
     BadFormatError:
         A simple exception to be thrown if the format is incorrect.
 
+    BatchJournal:
+        A journal file which records how far each chat in a batch has got, so that an interrupted batch can be resumed.
+
+    ChatManifest:
+        The manifest of every chat that has been formatted into one output directory, which index.html lists.
+
+    ProgressTracker:
+        A thread-safe counter of one chat's progress, which passes snapshots of its counters to an event sink.
+
+    ResourceGovernor:
+        A thread-safe limiter of the disk space, transcodes, and memory that chats use at once, which holds back new work until there's room for it.
+
+    ArchiveWriter:
+        A thread-safe writer of formatted chats into one zip or tar archive, instead of a directory tree.
+
+    ViewerDataWriter:
+        A writer of the data files of one chat for the virtualized viewer in Library/viewer.js.
+
+    AttachmentIndex:
+        An index of the attachments that the messages of one chat refer to, which the text pass builds as it goes.
+
+    ChatSummary:
+        A summary of the messages of one chat for the chat index page, which the text pass builds as it goes.
+
+    ChatFormat:
+        One dialect of exported chats, like iOS or Android, with patterns and a timestamp parser that are specialised for it.
+
     Message:
         The class for each message in a chat. Every instance is a separate message.
 
@@ -29,438 +56,2899 @@ Classes:
         The class for each chat to be formatted. Every instance is a separate chat.
 
 Functions:
-    process_chat(input_file: str, group_chat: bool, sender_name: str, chat_title: str, html_file_name: str, output_dir: str) -> None:
-        Process one chat completely.
+    get_chat_format(platform: str, date_order: str, year_length: int, clock: str) -> ChatFormat:
+        Return the ChatFormat with the given options, compiling it the first time it's needed.
+
+    get_chat_format_by_name(name: str) -> ChatFormat:
+        Return the ChatFormat with the given name, like 'ios-dmy-yyyy-24h'.
+
+    detect_chat_format(chat_txt) -> ChatFormat:
+        Detect the dialect of a chat from the start of the raw UTF-8 bytes of its _chat.txt file.
+
+    split_messages(chat_txt, chat_format: ChatFormat) -> List[Tuple[int, int]]:
+        Return the (start, end) byte offsets of every message in the raw UTF-8 bytes of a _chat.txt file.
+
+    decode_message(chat_txt, span: Tuple[int, int]) -> str:
+        Decode one message from the raw bytes of a _chat.txt file, given its span from split_messages().
+
+    render_viewer_page(chat_title: str, data_path: str) -> str:
+        Return the HTML page of the virtualized viewer, with the chat title and the path of its data files filled in.
+
+    render_index_page() -> str:
+        Return the HTML page of the chat index, which lists the chats in its output directory from ChatManifest.
+
+    render_start_template(chat_title: str) -> str:
+        Return the start of the HTML file, with the chat title filled in.
 
-    process_list_of_chats(list_of_chats: list) -> list:
+    render_end_template() -> str:
+        Return the end of the HTML file.
+
+    render_messages(raw_messages, group_chat: bool, sender_name: str, html_file_name: str, chat_format: ChatFormat, records: list = None, attachment_index: AttachmentIndex = None, image_settings=None, video_posters: bool = False, summary: ChatSummary = None):
+        Yield the HTML of every raw message, with a date separator before the first message of each day.
+
+    render_viewer_rows(raw_messages, group_chat: bool, sender_name: str, html_file_name: str, chat_format: ChatFormat, records: list = None, attachment_index: AttachmentIndex = None, image_settings=None, video_posters: bool = False, summary: ChatSummary = None):
+        Yield the row of every raw message for the virtualized viewer.
+
+    render_chunk(chat_txt_path: str, start: int, end: int, group_chat: bool, sender_name: str, html_file_name: str, chat_format: ChatFormat, with_records: bool = False, viewer: bool = False, attachment_index: AttachmentIndex = None, image_settings=None, video_posters: bool = False) -> tuple:
+        Render the messages between two byte offsets of a _chat.txt file. This is run in the parse pool.
+
+    join_rendered_chunks(rendered_chunks):
+        Yield the HTML, number of messages, records, attachment references, and summary of every chunk from render_chunk(), in order, fixing the date separators between them.
+
+    precompress_file(path: str) -> None:
+        Write path.gz, and path.br if the brotli package is installed, next to path.
+
+    get_resource_governor() -> ResourceGovernor:
+        Return the resource governor shared by every chat that isn't given its own, creating it if necessary.
+
+    get_parse_executor():
+        Return the process pool shared by every chat for parsing chunks of very large chats and recompressing images.
+
+    get_video_executor():
+        Return the thread pool shared by every chat for running ffmpeg on videos.
+
+    remux_fast_start(source_path: str, destination_path: str) -> bool:
+        Remux a video to destination_path so that its moov atom comes first and browsers can start playing it straight away.
+
+    extract_video_poster(video_path: str, poster_path: str) -> bool:
+        Save the first frame of a video as a JPEG at poster_path.
+
+    make_chat_key(input_file: str, html_file_name: str, output_dir: str) -> str:
+        Return the key that identifies a chat in a batch journal and in progress events.
+
+    process_chat(input_file: str, group_chat: bool, sender_name: str, chat_title: str, html_file_name: str, output_dir: str, **keyword_arguments) -> None:
+        Process one chat completely. See the function for the optional keyword arguments.
+
+    process_list_of_chats(list_of_chats: list, **keyword_arguments) -> list:
         Fully format a list of lists, where each sub-list is a set of arguments to be passed to process_chat().
 
         Returns a list of all the sub-lists that couldn't be processed properly.
 
-"""
+"""
+
+# Heavy and optional dependencies (concurrent.futures, pydub, profiling) are imported where they're used,
+# so that importing this module stays fast and doesn't need them for chats that never use them
+import collections
+import contextlib
+import functools
+import gzip
+import io
+import json
+import mmap
+import os
+import re
+import threading
+import time
+import shutil
+import signal
+import subprocess
+import sys
+import tarfile
+import tempfile
+import urllib.parse
+import zipfile
+
+from datetime import datetime
+from typing import Tuple, List, Optional
+
+
+class BadFormatError(Exception):
+    """A simple exception to be thrown if the format is incorrect."""
+
+
+class BatchJournal:
+    """A journal file which records how far each chat in a batch has got, so that an interrupted batch can be resumed.
+
+    Every chat moves through the stages in BatchJournal.stages in order. The whole journal is rewritten
+    atomically every time a chat changes stage, so a batch killed at any point leaves a readable journal.
+
+    Methods:
+        get_entry(key: str) -> dict:
+            Return a copy of the journal entry for a chat.
+
+        update(key: str, **fields) -> None:
+            Update the journal entry for a chat and save the journal.
+
+    """
+
+    stages = ('pending', 'extracted', 'text_written', 'attachments_placed', 'done')
+
+    def __init__(self, journal_file: str):
+        """Create a BatchJournal object, loading the existing journal if journal_file already exists.
+
+        Arguments:
+            journal_file: str:
+                The path of the JSON file to keep the journal in.
+
+        """
+        self._journal_file = journal_file
+        self._lock = threading.Lock()
+
+        if os.path.isfile(journal_file):
+            with open(journal_file, 'r', encoding='utf-8') as f:
+                self._entries = json.load(f)
+        else:
+            self._entries = {}
+
+    def get_entry(self, key: str) -> dict:
+        """Return a copy of the journal entry for a chat. Chats not in the journal are pending."""
+        with self._lock:
+            return dict(self._entries.get(key, {'stage': 'pending'}))
+
+    def update(self, key: str, **fields) -> None:
+        """Update the journal entry for a chat with the given fields and atomically save the journal."""
+        with self._lock:
+            self._entries.setdefault(key, {'stage': 'pending'}).update(fields)
+
+            # Write to a temporary file and then replace the journal, so a crash never leaves half a journal
+            temp_journal_file = self._journal_file + '.tmp'
+            with open(temp_journal_file, 'w', encoding='utf-8') as f:
+                json.dump(self._entries, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(temp_journal_file, self._journal_file)
+
+
+class ChatManifest:
+    """The manifest of every chat that has been formatted into one output directory, which index.html lists.
+
+    Every formatted chat appends its entry to chats.jsonl, and the same entry to chats.js, which index.html loads to
+    list the chats with sorting and filtering. Adding a chat only appends to the files, so it takes the same time
+    however many chats are already in the directory. A chat that's formatted again is appended again, and its newest
+    entry wins. When chats.jsonl has grown to twice its size after the last compaction, both files are rewritten
+    with one entry per chat, so the time is still constant on average.
+
+    Every change is made while holding a lock on .chats.lock, which works between processes as well as threads,
+    so the CLI and the watch folder daemon can add chats to the same directory at once. Lines are only appended
+    whole, and a line that was cut off by a crash is removed before the next one is appended.
+
+    Methods:
+        add(entry: dict) -> None:
+            Add or replace the entry of a chat, keyed by its html_path.
+
+        read() -> List[dict]:
+            Return the newest entry of every chat, in the order they were last added.
+
+        compact() -> None:
+            Rewrite the manifest and the data file of the page with only the newest entry of every chat.
+
+    """
+
+    manifest_filename = 'chats.jsonl'
+    data_filename = 'chats.js'
+    lock_filename = '.chats.lock'
+    page_filename = 'index.html'
+
+    # The manifest isn't compacted until it's at least this many bytes long, because rewriting a small file gains nothing
+    min_compaction_size = 64 * 1024
+
+    def __init__(self, output_dir: str):
+        """Create a ChatManifest object for the chats in output_dir. The files are created when the first chat is added."""
+        self._output_dir = output_dir
+        self._manifest_path = os.path.join(output_dir, ChatManifest.manifest_filename)
+        self._data_path = os.path.join(output_dir, ChatManifest.data_filename)
+        self._lock_path = os.path.join(output_dir, ChatManifest.lock_filename)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold the lock on the manifest, and yield the lock file.
+
+        The lock file holds the size of the manifest after it was last compacted.
+        """
+        with os.fdopen(os.open(self._lock_path, os.O_RDWR | os.O_CREAT, 0o666), 'r+b') as lock_file:
+            if os.name == 'nt':
+                import msvcrt
+
+                while True:
+                    try:
+                        lock_file.seek(0)
+                        msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:  # LK_LOCK gives up after 10 seconds, so keep trying
+                        pass
+            else:
+                import fcntl
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+
+            try:
+                yield lock_file
+            finally:
+                if os.name == 'nt':
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+                else:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def add(self, entry: dict) -> None:
+        """Add or replace the entry of a chat, keyed by its html_path, and write index.html if it doesn't exist yet."""
+        line = json.dumps(entry)
+
+        with self._locked() as lock_file:
+            _append_line(self._manifest_path, line + '\n')
+            _append_line(self._data_path, f'ChatIndex.add({line});\n')
+
+            if not os.path.isfile(page_path := os.path.join(self._output_dir, ChatManifest.page_filename)):
+                temp_page_path = f'{page_path}.{os.getpid()}.tmp'
+                with open(temp_page_path, 'w', encoding='utf-8') as f:
+                    f.write(render_index_page())
+
+                os.replace(temp_page_path, page_path)
+
+            lock_file.seek(0)
+            compacted_size = int(lock_file.read() or 0)
+
+            if os.path.getsize(self._manifest_path) > max(2 * compacted_size, ChatManifest.min_compaction_size):
+                self._compact(lock_file)
+
+    def read(self) -> List[dict]:
+        """Return the newest entry of every chat, in the order they were last added."""
+        with self._locked():
+            return self._read()
+
+    def compact(self) -> None:
+        """Rewrite the manifest and the data file of the page with only the newest entry of every chat."""
+        with self._locked() as lock_file:
+            self._compact(lock_file)
+
+    def _read(self) -> List[dict]:
+        """Return the newest entry of every chat. The lock must be held."""
+        entries = {}
+
+        if os.path.isfile(self._manifest_path):
+            with open(self._manifest_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # A line that was cut off by a crash
+                        continue
+
+                    entries.pop(entry['html_path'], None)
+                    entries[entry['html_path']] = entry
+
+        return list(entries.values())
+
+    def _compact(self, lock_file) -> None:
+        """Rewrite both files with one entry per chat, and record the new size in the lock file. The lock must be held."""
+        lines = [json.dumps(entry) for entry in self._read()]
+        temp_suffix = f'.{os.getpid()}.tmp'
+
+        for path, text in ((self._manifest_path, ''.join(f'{line}\n' for line in lines)),
+                           (self._data_path, ''.join(f'ChatIndex.add({line});\n' for line in lines))):
+            with open(path + temp_suffix, 'w', encoding='utf-8') as f:
+                f.write(text)
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(path + temp_suffix, path)
+
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(str(os.path.getsize(self._manifest_path)).encode('ascii'))
+        lock_file.flush()
+
+
+class ProgressTracker:
+    """A thread-safe counter of one chat's progress, which passes snapshots of its counters to an event sink.
+
+    The event sink is any callable that takes the chat key and a dictionary of the chat's progress. It is called
+    from the worker threads, no more often than every min_interval seconds for each chat, except when the stage
+    changes, which is always reported. The dictionary has 'title', 'stage', and every counter in ProgressTracker.counters.
+
+    Methods:
+        add(**increments) -> None:
+            Add to the counters and report the progress if enough time has passed since the last report.
+
+        set_stage(stage: str) -> None:
+            Set the stage of the chat and report the progress straight away.
+
+    """
+
+    counters = ('messages_parsed', 'messages_total', 'bytes_written', 'attachments_done', 'attachments_total', 'transcodes_queued',
+                'attachments_missing', 'attachments_unreferenced')
+
+    def __init__(self, event_sink, chat_key: str, chat_title: str, min_interval: float = 0.1):
+        """Create a ProgressTracker object.
+
+        Arguments:
+            event_sink:
+                A callable taking a chat key and a dictionary of progress, or None to not report anything.
+
+            chat_key: str:
+                The key of the chat, from make_chat_key().
+
+            chat_title: str:
+                The title of the chat, to make the events easier to display.
+
+        Keyword arguments:
+            min_interval: float:
+                The minimum number of seconds between two reports that don't change the stage.
+
+        """
+        self._event_sink = event_sink
+        self._chat_key = chat_key
+        self._min_interval = min_interval
+        self._lock = threading.Lock()
+        self._last_report_time = 0.0
+
+        self._progress = {'title': chat_title, 'stage': 'pending'}
+        self._progress.update({counter: 0 for counter in ProgressTracker.counters})
+
+    def _report(self) -> None:
+        """Pass a copy of the progress to the event sink. Must be called with self._lock held."""
+        self._last_report_time = time.monotonic()
+        self._event_sink(self._chat_key, dict(self._progress))
+
+    def add(self, **increments) -> None:
+        """Add to the counters and report the progress if enough time has passed since the last report."""
+        if self._event_sink is None:
+            return
+
+        with self._lock:
+            for counter, increment in increments.items():
+                self._progress[counter] += increment
+
+            if time.monotonic() - self._last_report_time >= self._min_interval:
+                self._report()
+
+    def set_stage(self, stage: str) -> None:
+        """Set the stage of the chat and report the progress straight away."""
+        if self._event_sink is None:
+            return
+
+        with self._lock:
+            self._progress['stage'] = stage
+            self._report()
+
+
+class ResourceGovernor:
+    """A thread-safe limiter of the disk space, transcodes, and memory that chats use at once, which holds back new work until there's room for it.
+
+    The resources are:
+        extraction_bytes:
+            The uncompressed size of the zip files that are extracted into temporary directories at once.
+
+        transcodes:
+            The number of audio conversions and ffmpeg runs at once.
+
+        memory_bytes:
+            An estimate of the memory used by work in flight, which is decoded audio and images, and chunks in the parse pool.
+
+    Work asks for all the resources it needs at once, and waits until all of them fit in their budgets, so it never
+    fails for lack of them. Work that needs more than a whole budget runs when nothing else is using that resource.
+
+    Methods:
+        acquire(**amounts) -> None:
+            Wait until the amounts of every resource fit in their budgets, and take them.
+
+        try_acquire(**amounts) -> bool:
+            Take the amounts if they fit in their budgets right now, and return whether they were taken.
+
+        release(**amounts) -> None:
+            Give back amounts that were taken.
+
+        hold(**amounts):
+            A context manager that acquires the amounts and releases them at the end.
+
+        report() -> dict:
+            Return the limits, current and peak use of every resource, and how long work was held back.
+
+    """
+
+    resources = ('extraction_bytes', 'transcodes', 'memory_bytes')
+
+    def __init__(self, extraction_bytes: int = None, transcodes: int = None, memory_bytes: int = None):
+        """Create a ResourceGovernor object.
+
+        Every budget that isn't given is worked out from this machine. The extraction budget is half of the free
+        space on the disk of the working directory, where the temporary directories go. The transcode budget
+        is the number of CPUs, and the memory budget is half of the physical memory.
+
+        Keyword arguments:
+            extraction_bytes: int:
+                The maximum total uncompressed size of the zip files being extracted and formatted at once.
+
+            transcodes: int:
+                The maximum number of audio conversions and ffmpeg runs at once.
+
+            memory_bytes: int:
+                The maximum estimated memory of the work in flight.
+
+        """
+        if extraction_bytes is None:
+            extraction_bytes = shutil.disk_usage('.').free // 2
+
+        if transcodes is None:
+            transcodes = os.cpu_count() or 1
+
+        if memory_bytes is None:
+            try:
+                memory_bytes = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2
+            except (AttributeError, ValueError, OSError):  # os.sysconf() doesn't exist on Windows
+                memory_bytes = 2 * 1024 ** 3
+
+        self.limits = {'extraction_bytes': extraction_bytes, 'transcodes': transcodes, 'memory_bytes': memory_bytes}
+
+        self._in_use = dict.fromkeys(ResourceGovernor.resources, 0)
+        self._peak = dict.fromkeys(ResourceGovernor.resources, 0)
+        self._waits = 0
+        self._wait_time = 0.0
+        self._condition = threading.Condition()
+
+    def _fits(self, amounts: dict) -> bool:
+        """Return True if the amounts fit in their budgets. Must be called with self._condition held."""
+        return all(amount <= 0 or self._in_use[resource] == 0 or self._in_use[resource] + amount <= self.limits[resource]
+                   for resource, amount in amounts.items())
+
+    def _take(self, amounts: dict) -> None:
+        """Add the amounts to the resources in use. Must be called with self._condition held."""
+        for resource, amount in amounts.items():
+            self._in_use[resource] += amount
+            self._peak[resource] = max(self._peak[resource], self._in_use[resource])
+
+    def acquire(self, **amounts) -> None:
+        """Wait until the amounts of every resource fit in their budgets, and take them."""
+        with self._condition:
+            if not self._fits(amounts):
+                self._waits += 1
+                start_time = time.monotonic()
+
+                while not self._fits(amounts):
+                    self._condition.wait()
+
+                self._wait_time += time.monotonic() - start_time
+
+            self._take(amounts)
+
+    def try_acquire(self, **amounts) -> bool:
+        """Take the amounts if they fit in their budgets right now, and return whether they were taken."""
+        with self._condition:
+            if not self._fits(amounts):
+                return False
+
+            self._take(amounts)
+            return True
+
+    def release(self, **amounts) -> None:
+        """Give back amounts that were taken."""
+        with self._condition:
+            for resource, amount in amounts.items():
+                self._in_use[resource] -= amount
+
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def hold(self, **amounts):
+        """A context manager that acquires the amounts and releases them at the end."""
+        self.acquire(**amounts)
+
+        try:
+            yield
+        finally:
+            self.release(**amounts)
+
+    def report(self) -> dict:
+        """Return the limits, current and peak use of every resource, and how long work was held back.
+
+        The keys are limits, in_use, and peak, which are dictionaries of every resource, and waits, which is the
+        number of times work was held back, and wait_seconds, which is the total time it was held back for.
+        """
+        with self._condition:
+            return {'limits': dict(self.limits), 'in_use': dict(self._in_use), 'peak': dict(self._peak),
+                    'waits': self._waits, 'wait_seconds': self._wait_time}
+
+
+class ArchiveWriter:
+    """A thread-safe writer of formatted chats into one zip or tar archive, instead of a directory tree.
+
+    The archive has the same layout as an output directory, with the HTML files and the Library folder at the top
+    and the attachments in Attachments/<html_file_name>/. Every chat reserves its own html_file_name with
+    reserve_chat_name() first, so chats with the same name don't mix up their files. In a zip archive, text files are deflated and everything
+    else is stored without recompression. Everything is written sequentially, so the archive can be a stream.
+
+    Methods:
+        reserve_chat_name(html_file_name: str) -> str:
+            Return a name for a chat's HTML file, attachments, and data that no other chat in the archive has,
+            adding a number to the end if necessary, and reserve it.
+
+        add_library() -> None:
+            Add the Library folder to the archive, unless it's already there.
+
+        add_file(path: str, arcname: str) -> None:
+            Add a file from the disk to the archive.
+
+        open_text(arcname: str):
+            Return a text file to write an entry of the archive with. The entry is finished when the file is closed.
+
+        close() -> None:
+            Finish the archive.
+
+    """
+
+    # Tuple of extensions of files that get compressed in zip archives
+    text_extensions = ('.html', '.css', '.js', '.json', '.txt')
+
+    def __init__(self, archive_file: str):
+        """Create an ArchiveWriter object, which writes a tar archive if archive_file ends with '.tar', and a zip archive otherwise."""
+        self._lock = threading.Lock()
+        self._names = set()
+        self._chat_names = set()
+        self._is_tar = archive_file.endswith('.tar')
+
+        if self._is_tar:
+            self._tar_file = tarfile.open(archive_file, 'w|')
+        else:
+            self._zip_file = zipfile.ZipFile(archive_file, 'w', compression=zipfile.ZIP_DEFLATED)
+
+    def reserve_chat_name(self, html_file_name: str) -> str:
+        """Return a name for a chat's HTML file, attachments, and data that no other chat in the archive has, adding a number to the end if necessary, and reserve it.
+
+        The chat's files are then <name>.html, Attachments/<name>/, and Data/<name>/.
+        """
+        with self._lock:
+            name = html_file_name
+            same_name_number = 1
+
+            while name in self._chat_names:
+                name = html_file_name + f' ({same_name_number})'
+                same_name_number += 1
+
+            self._chat_names.add(name)
+            return name
+
+    def add_library(self) -> None:
+        """Add the Library folder to the archive, unless it's already there."""
+        with self._lock:
+            if 'Library/' in self._names:
+                return
+
+            self._names.add('Library/')
+
+        for f in sorted(os.listdir('Library')):
+            self.add_file(os.path.join('Library', f), f'Library/{f}')
+
+    def add_file(self, path: str, arcname: str) -> None:
+        """Add a file from the disk to the archive. In a zip archive, only text files are compressed."""
+        with self._lock:
+            self._names.add(arcname)
+
+            if self._is_tar:
+                self._tar_file.add(path, arcname)
+            else:
+                compress_type = zipfile.ZIP_DEFLATED if arcname.endswith(ArchiveWriter.text_extensions) else zipfile.ZIP_STORED
+                self._zip_file.write(path, arcname, compress_type=compress_type)
+
+    def open_text(self, arcname: str):
+        """Return a text file to write an entry of the archive with. The entry is finished when the file is closed.
+
+        The entry is kept in a spooled temporary file until it's closed, and only then added to the archive, so
+        several entries can be written at once without holding up each other or the attachments. An entry that's
+        discarded instead of closed is never added.
+        """
+        return _ArchiveTextFile(self, arcname, tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024))
+
+    def _finish_text_entry(self, arcname: str, text_file: io.TextIOWrapper) -> None:
+        """Add an entry written with open_text() to the archive."""
+        text_file.flush()
+        buffer = text_file.detach()
+        size = buffer.tell()
+        buffer.seek(0)
+
+        try:
+            with self._lock:
+                self._names.add(arcname)
+
+                if self._is_tar:
+                    tar_info = tarfile.TarInfo(arcname)
+                    tar_info.size = size
+                    tar_info.mtime = int(time.time())
+                    self._tar_file.addfile(tar_info, buffer)
+                else:
+                    zip_info = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+                    zip_info.compress_type = zipfile.ZIP_DEFLATED
+                    zip_info.file_size = size  # This tells zipfile whether the entry needs ZIP64
+
+                    with self._zip_file.open(zip_info, 'w') as entry:
+                        shutil.copyfileobj(buffer, entry, 1024 * 1024)
+        finally:
+            buffer.close()
+
+    def close(self) -> None:
+        """Finish the archive."""
+        with self._lock:
+            if self._is_tar:
+                self._tar_file.close()
+            else:
+                self._zip_file.close()
+
+
+class _ArchiveTextFile:
+    """A text file being written into an archive by ArchiveWriter.open_text(). Closing it finishes the archive entry."""
+
+    def __init__(self, archive: ArchiveWriter, arcname: str, buffer):
+        """Wrap the binary buffer of the archive entry in a UTF-8 text file."""
+        self.name = arcname
+        self._archive = archive
+        self._text_file = io.TextIOWrapper(buffer, encoding='utf-8')
+        self._finished = False
+
+    def write(self, text: str) -> int:
+        """Write text to the archive entry."""
+        return self._text_file.write(text)
+
+    def close(self) -> None:
+        """Finish the archive entry."""
+        if not self._finished:
+            self._finished = True
+            self._archive._finish_text_entry(self.name, self._text_file)
+
+    def discard(self) -> None:
+        """Throw the entry away without adding it to the archive. This does nothing if it's already finished."""
+        if not self._finished:
+            self._finished = True
+            self._text_file.close()
+
+
+class ViewerDataWriter:
+    """A writer of the data files of one chat for the virtualized viewer in Library/viewer.js.
+
+    The messages are written in chunks of chunk_size messages to chunk_00000.js, chunk_00001.js, and so on,
+    and the number of messages and the first message of every day are written to index.js. Every file is a
+    JSON value wrapped in a call to the viewer, so that browsers can load them from the disk without a server.
+
+    Methods:
+        add_row(row: list) -> None:
+            Add the row of the next message, from Message.to_viewer_row().
+
+        close() -> None:
+            Write the last chunk and the index.
+
+    """
+
+    def __init__(self, open_text, chunk_size: int = 1000):
+        """Create a ViewerDataWriter object.
+
+        Arguments:
+            open_text:
+                A callable that takes the name of a data file, like 'index.js', and returns a text file to write it to.
+                The returned file's name is added to paths.
+
+        Keyword arguments:
+            chunk_size: int:
+                The number of messages in every chunk file.
+
+        """
+        self._open_text = open_text
+        self._chunk_size = chunk_size
+
+        self._rows = []
+        self._days = []  # Lists of the date, the date in ISO format, and the index of the first message of every day
+        self._total = 0
+        self._chunk_count = 0
+
+        self.bytes_written = 0
+        self.paths = []
+
+    def _write_file(self, name: str, text: str) -> None:
+        """Write one data file and record its size and path."""
+        f = self._open_text(name)
+        f.write(text)
+        f.close()
+
+        self.bytes_written += len(text.encode('utf-8'))
+        self.paths.append(f.name)
+
+    def _write_chunk(self) -> None:
+        """Write the buffered rows as the next chunk file, and start a new chunk."""
+        text = f'WhatsAppViewer.chunk({self._chunk_count}, {json.dumps(self._rows, ensure_ascii=False, separators=(",", ":"))});\n'
+        self._write_file(f'chunk_{self._chunk_count:05}.js', text)
+
+        self._chunk_count += 1
+        self._rows = []
+
+    def add_row(self, row: list) -> None:
+        """Add the row of the next message, from Message.to_viewer_row()."""
+        *row, date, iso_date = row
+
+        if not self._days or self._days[-1][0] != date:
+            self._days.append([date, iso_date, self._total])
+
+        self._rows.append(row)
+        self._total += 1
+
+        if len(self._rows) >= self._chunk_size:
+            self._write_chunk()
+
+    def close(self) -> None:
+        """Write the last chunk and the index."""
+        if self._rows:
+            self._write_chunk()
+
+        index = {'total': self._total, 'chunk_size': self._chunk_size, 'chunks': self._chunk_count, 'days': self._days}
+        self._write_file('index.js', f'WhatsAppViewer.index({json.dumps(index, ensure_ascii=False, separators=(",", ":"))});\n')
+
+
+class AttachmentIndex:
+    """An index of the attachments that the messages of one chat refer to, which the text pass builds as it goes.
+
+    The attachment pass iterates over the index while the text pass is still adding to it, so only the attachments
+    that a message refers to are converted and moved, and each one starts as soon as its message has been rendered.
+    A message that refers to an attachment that isn't in the export shows a placeholder instead.
+
+    An index can be pickled for the parse pool. The copy in a worker process only knows which attachments are
+    in the export, so render_chunk() returns the references that were added to it, for the original's add_all().
+
+    Attributes:
+        references: list:
+            The (filename, file type) of every attachment that a message refers to, in the order they were first
+            referred to. The filename is the original one in the export, and the file type is like 'PHOTO'.
+
+        missing: list:
+            The filenames of the referenced attachments that aren't in the export.
+
+        complete: bool:
+            True if the text pass got to the end of the chat before finishing the index, so that every attachment that
+            a message refers to is in references. It's False until then, and if the text pass failed.
+
+    Methods:
+        is_available(filename: str) -> bool:
+            Return True if the attachment is in the export.
+
+        add(filename: str, file_type: str) -> None:
+            Add a reference to an attachment. An attachment that's already referenced isn't added again.
+
+        add_all(references: list) -> None:
+            Add every (filename, file type) reference in order.
+
+        iter_references(before_wait=None):
+            Yield the (filename, file type) of every reference, calling before_wait() whenever it has to wait for more.
+
+        finish(complete: bool = True) -> None:
+            Record that the text pass is finished, so that iterating over the index stops after the last reference.
+
+        save(path: str) -> None:
+            Save the index as a JSON file.
+
+        load(path: str) -> AttachmentIndex:
+            Return a finished index from a JSON file written by save(). This is a class method.
+
+    """
+
+    def __init__(self, available_files):
+        """Create an empty AttachmentIndex, given the filenames of every attachment in the export."""
+        self._available = frozenset(available_files)
+        self._types = {}
+        self._finished = False
+        self._condition = threading.Condition()
+
+        self.references = []
+        self.missing = []
+        self.complete = False
+
+    def __reduce__(self):
+        """Pickle only the available attachments, so that a worker process gets a new, empty index."""
+        return AttachmentIndex, (self._available,)
+
+    def __iter__(self):
+        """Yield the (filename, file type) of every reference, waiting for more until finish() is called."""
+        return self.iter_references()
+
+    def iter_references(self, before_wait=None):
+        """Yield the (filename, file type) of every reference, waiting for more until finish() is called.
+
+        If before_wait is given, it's called without any lock held every time the index has to wait for the text pass.
+        The caller should use it to give back anything the text pass might be waiting for, or they could wait for
+        each other forever.
+        """
+        i = 0
+
+        while True:
+            if before_wait is not None:
+                with self._condition:
+                    caught_up = i == len(self.references) and not self._finished
+
+                if caught_up:
+                    before_wait()
+
+            with self._condition:
+                while i == len(self.references) and not self._finished:
+                    self._condition.wait()
+
+                if i == len(self.references):
+                    return
+
+                reference = self.references[i]
+
+            i += 1
+            yield reference
+
+    def is_available(self, filename: str) -> bool:
+        """Return True if the attachment is in the export."""
+        return filename in self._available
+
+    def add(self, filename: str, file_type: str) -> None:
+        """Add a reference to an attachment. An attachment that's already referenced isn't added again."""
+        with self._condition:
+            if filename in self._types:
+                return
+
+            self._types[filename] = file_type
+            self.references.append((filename, file_type))
+
+            if filename not in self._available:
+                self.missing.append(filename)
+
+            self._condition.notify_all()
+
+    def add_all(self, references: list) -> None:
+        """Add every (filename, file type) reference in order."""
+        for filename, file_type in references:
+            self.add(filename, file_type)
+
+    def finish(self, complete: bool = True) -> None:
+        """Record that the text pass is finished, so that iterating over the index stops after the last reference.
+
+        complete is False if the text pass failed before the end of the chat, so some references might be missing.
+        """
+        with self._condition:
+            self._finished = True
+            self.complete = complete
+            self._condition.notify_all()
+
+    def save(self, path: str) -> None:
+        """Save the index as a JSON file."""
+        with self._condition:
+            data = {'available': sorted(self._available), 'references': self.references}
+
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> 'AttachmentIndex':
+        """Return a finished index from a JSON file written by save()."""
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+
+        index = cls(data['available'])
+        index.add_all(data['references'])
+        index.finish()
+
+        return index
+
+
+class ChatSummary:
+    """A summary of the messages of one chat for the chat index page, which the text pass builds as it goes.
+
+    A summary can be pickled, so every chunk in the parse pool builds its own and the chat merges them.
+
+    Attributes:
+        participants: set:
+            The names of everyone who sent a message in the chat.
+
+        messages: int:
+            The number of messages in the chat, including group chat meta messages.
+
+        first: datetime:
+            The time of the earliest message, or None if there are no messages.
+
+        last: datetime:
+            The time of the latest message, or None if there are no messages.
+
+    Methods:
+        add(sender: Optional[str], timestamp: datetime) -> None:
+            Add a message, with a sender of None for a group chat meta message.
+
+        merge(other: ChatSummary) -> None:
+            Add every message in another summary, like one from render_chunk().
+
+        to_dict() -> dict:
+            Return the summary as a dictionary that can be saved as JSON.
+
+        save(path: str) -> None:
+            Save the summary as a JSON file.
+
+        load(path: str) -> ChatSummary:
+            Return a summary from a JSON file written by save(). This is a class method.
+
+    """
+
+    def __init__(self):
+        """Create an empty ChatSummary."""
+        self.participants = set()
+        self.messages = 0
+        self.first = None
+        self.last = None
+
+    def add(self, sender: Optional[str], timestamp: datetime) -> None:
+        """Add a message, with a sender of None for a group chat meta message."""
+        if sender is not None:
+            self.participants.add(sender)
+
+        self.messages += 1
+
+        if self.first is None or timestamp < self.first:
+            self.first = timestamp
+
+        if self.last is None or timestamp > self.last:
+            self.last = timestamp
+
+    def merge(self, other: 'ChatSummary') -> None:
+        """Add every message in another summary, like one from render_chunk()."""
+        self.participants.update(other.participants)
+        self.messages += other.messages
+
+        if other.first is not None and (self.first is None or other.first < self.first):
+            self.first = other.first
+
+        if other.last is not None and (self.last is None or other.last > self.last):
+            self.last = other.last
+
+    def to_dict(self) -> dict:
+        """Return the summary as a dictionary that can be saved as JSON, with the times in ISO 8601 format."""
+        return {
+            'participants': sorted(self.participants),
+            'messages': self.messages,
+            'first': self.first.isoformat() if self.first is not None else None,
+            'last': self.last.isoformat() if self.last is not None else None
+        }
+
+    def save(self, path: str) -> None:
+        """Save the summary as a JSON file."""
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> 'ChatSummary':
+        """Return a summary from a JSON file written by save()."""
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+
+        summary = cls()
+        summary.participants = set(data['participants'])
+        summary.messages = data['messages']
+        summary.first = datetime.fromisoformat(data['first']) if data['first'] is not None else None
+        summary.last = datetime.fromisoformat(data['last']) if data['last'] is not None else None
+
+        return summary
+
+
+class ChatFormat:
+    """One dialect of exported chats, with patterns and a timestamp parser that are specialised for it.
+
+    The exports differ between platforms and locales. An iOS message looks like '[02/11/2020, 21:47:19] Alice: Hello',
+    and an Android message looks like '02/11/2020, 21:47 - Alice: Hello'. The date can be day first or month first,
+    with a 2 or 4 digit year, and the time can use a 12 or 24 hour clock. Only one dialect is used for a whole chat,
+    so every message is matched with one precompiled pattern instead of trying every alternative.
+
+    Use get_chat_format() or detect_chat_format() to get one, so that every dialect is only compiled once.
+
+    Attributes:
+        name: str:
+            The name of the dialect, like 'ios-dmy-yyyy-24h'. get_chat_format_by_name() turns it back into a ChatFormat.
+
+        full_prefix_pattern:
+            Matches a normal message. Groups: timestamp is 1, name is 2, content is 3.
+
+        group_meta_prefix_pattern:
+            Matches a group chat meta message. Groups: timestamp is 1, content is 2.
+
+        encrypted_messages_notice_pattern:
+            Matches the notice that messages are encrypted.
+
+        boundary_pattern:
+            Matches the raw UTF-8 bytes between two messages. See split_messages().
+
+        attachment_message_pattern:
+            Matches the content of an attachment message. Groups: filename without extension is 1, file type is 2, extension is 3.
+
+        attachment_file_pattern:
+            Matches the name of an attachment file. Groups: filename without extension is 1, file type is 2, extension is 3.
+
+        display_time_format: str:
+            The strftime format of the time of every message in the HTML.
+
+    Methods:
+        parse_timestamp(timestamp: str) -> datetime:
+            Return the datetime of the timestamp of a message, from group 1 of either prefix pattern.
+
+        get_attachment_type(file_type: str) -> str:
+            Return the file type used by Message and Chat, like 'PHOTO', for a file type from an attachment pattern.
+
+    """
+
+    platforms = ('ios', 'android')
+    date_orders = ('dmy', 'mdy')
+    year_lengths = (4, 2)
+    clocks = ('24h', '12h')
+
+    # The file types of attachments from Android, which are named like IMG-20201102-WA0000.jpg
+    android_attachment_types = {'IMG': 'PHOTO', 'VID': 'VIDEO', 'AUD': 'AUDIO', 'PTT': 'AUDIO', 'STK': 'STICKER', 'DOC': 'DOCUMENT'}
+
+    encrypted_messages_notice = r'Messages and calls are end-to-end encrypted\. No one outside of this chat, not even WhatsApp, ' \
+                                r'can read or listen to them\.(?: Tap to learn more\.)?$'
+
+    def __init__(self, platform: str, date_order: str, year_length: int, clock: str):
+        """Create a ChatFormat object and compile its patterns.
+
+        Arguments:
+            platform: str:
+                'ios' or 'android'.
+
+            date_order: str:
+                'dmy' if the day comes first, or 'mdy' if the month comes first.
+
+            year_length: int:
+                The number of digits in the year, which is 4 or 2.
+
+            clock: str:
+                '24h' or '12h'.
+
+        Raises:
+            ValueError:
+                If any of the arguments isn't one of the options.
+
+        """
+        if platform not in ChatFormat.platforms or date_order not in ChatFormat.date_orders \
+                or year_length not in ChatFormat.year_lengths or clock not in ChatFormat.clocks:
+            raise ValueError(f'Unknown chat format {(platform, date_order, year_length, clock)!r}.')
+
+        self.platform = platform
+        self.date_order = date_order
+        self.year_length = year_length
+        self.clock = clock
+        self.name = f'{platform}-{date_order}-{"y" * year_length}-{clock}'
+
+        has_seconds = platform == 'ios'
+
+        # The timestamp is parsed from these named groups, which is much faster than strptime()
+        first, second = ('day', 'month') if date_order == 'dmy' else ('month', 'day')
+        timestamp = rf'(?P<{first}>\d{{1,2}})/(?P<{second}>\d{{1,2}})/(?P<year>\d{{{year_length}}}), ' \
+                    r'(?P<hour>\d{1,2}):(?P<minute>\d{2})'
+        if has_seconds:
+            timestamp += r':(?P<second>\d{2})'
+        if clock == '12h':
+            # Newer exports put a narrow no-break space before am or pm
+            # It's optional because the original formatter accepted chats with both 12 and 24 hour times
+            timestamp += '(?:(?: |\u202f)(?P<am_pm>[aApP])[mM])?'
+
+        self._timestamp_pattern = re.compile(timestamp)
+
+        # The prefix patterns only need the timestamp as a whole, so the named groups are removed from it
+        timestamp = re.sub(r'\(\?P<\w+>', '(?:', timestamp)
+        prefix = rf'\[({timestamp})] ' if platform == 'ios' else rf'({timestamp}) - '
+
+        self.full_prefix_pattern = re.compile(prefix + r'([^:]+): (.+)', re.DOTALL)
+        self.group_meta_prefix_pattern = re.compile(prefix + r'([^:]+)')
+        self.encrypted_messages_notice_pattern = re.compile(prefix + r'(?:[^:]+: )?' + ChatFormat.encrypted_messages_notice)
+
+        # This matches the newline (of any style), and any LRM, LRE, or PDF characters, before the prefix of every message except the first
+        # It works on the raw UTF-8 bytes of _chat.txt, so the file never has to be decoded all at once
+        lookahead = rf'\[{timestamp}]' if platform == 'ios' else rf'{timestamp} - '
+        self.boundary_pattern = re.compile(rb'(?:\r\n?|\n)(?:\xe2\x80[\x8e\xaa\xac])*(?=' + lookahead.encode('utf-8') + rb')')
+
+        if platform == 'ios':
+            self.attachment_message_pattern = re.compile(r'<attached: (\d{8}-(\w+)-\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2})(\.\w+)>$')
+            self.attachment_file_pattern = re.compile(r'(\d{8}-(\w+)-\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2})(\.\w+)$')
+        else:
+            android_types = '|'.join(ChatFormat.android_attachment_types)
+            self.attachment_message_pattern = re.compile(rf'(({android_types})-\d{{8}}-WA\d+)(\.\w+) \(file attached\)$')
+            self.attachment_file_pattern = re.compile(rf'(({android_types})-\d{{8}}-WA\d+)(\.\w+)$')
+
+        self.display_time_format = '%I:%M:%S %p' if has_seconds else '%I:%M %p'
+
+    def __repr__(self) -> str:
+        """Return a __repr__ of the ChatFormat instance with its name."""
+        return f'<{self.__class__.__module__}.{self.__class__.__name__} {self.name!r}>'
+
+    def __reduce__(self):
+        """Pickle the ChatFormat by its options, so that a worker process gets its own cached copy instead of the patterns."""
+        return get_chat_format, (self.platform, self.date_order, self.year_length, self.clock)
+
+    def parse_timestamp(self, timestamp: str) -> datetime:
+        """Return the datetime of the timestamp of a message, from group 1 of either prefix pattern.
+
+        Raises:
+            BadFormatError:
+                If the timestamp doesn't match this format, or isn't a real date and time, like one with 60 seconds.
+
+        """
+        match = self._timestamp_pattern.fullmatch(timestamp)
+        if match is None:
+            raise BadFormatError(f'Failed to match timestamp "{timestamp}" in format {self.name}.')
+
+        year = int(match['year'])
+        if self.year_length == 2:
+            year += 2000
+
+        hour = int(match['hour'])
+        if self.clock == '12h' and match['am_pm'] is not None:
+            hour = hour % 12 + (12 if match['am_pm'] in 'pP' else 0)
+
+        second = int(match['second']) if self.platform == 'ios' else 0
+
+        try:
+            return datetime(year, int(match['month']), int(match['day']), hour, int(match['minute']), second)
+        except ValueError as e:
+            raise BadFormatError(f'Timestamp "{timestamp}" in format {self.name} isn\'t a real date and time: {e}.') from None
+
+    def get_attachment_type(self, file_type: str) -> str:
+        """Return the file type used by Message and Chat, like 'PHOTO', for a file type from an attachment pattern."""
+        if self.platform == 'android':
+            return ChatFormat.android_attachment_types[file_type]
+
+        return file_type
+
+
+class Message:
+    """The class for each message in a chat. Every instance is a separate message.
+
+    Methods:
+        create_html(sender_name: str) -> str:
+            Return HTML representation of the Message object.
+
+        to_record() -> dict:
+            Return the parsed data of the Message object as a dictionary, for exporters.
+
+        to_viewer_row(sender_name: str) -> list:
+            Return the Message object as a compact list for the data files of the virtualized viewer.
+
+        add_to_summary(summary: ChatSummary) -> None:
+            Add the Message object to the summary of its chat, for the chat index page.
+
+    """
+
+    html_audio_formats = {'.mp3': 'mpeg', '.ogg': 'ogg', '.wav': 'wav'}  # Dict of HTML accepted audio formats
+
+    # This is a dictionary of patterns and replacement patterns for converting WhatsApp formatting to HTML tags
+    format_dict = {re.compile(r'\b_([^_]+)_\b'): r'<em>\1</em>',
+                   re.compile(r'\*\b([^*]+)\b\*'): r'<strong>\1</strong>',
+                   re.compile(r'~\b([^~]+)\b~'): r'<del>\1</del>',
+                   re.compile(r'```\b([^`]+)\b```'): r'<code>\1</code>'}
+
+    # If ffmpeg is installed, every video gets a poster image with this suffix instead of its extension,
+    # so the browser doesn't have to load the video to show it
+    video_poster_suffix = '_poster.jpg'
+
+    # Tuple of extensions that can be moved without being converted
+    non_conversion_extensions = ('jpg', 'png', 'webp', 'gif', 'mp4', 'mp3', 'ogg', 'wav')
+
+    # RegEx patterns
+    # The patterns of the prefixes and attachments depend on the dialect of the chat, so they're in ChatFormat
+
+    # Link pattern taken from urlregex.com
+    link_pattern = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*(),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
+
+    def __init__(self, original_string: str, group_chat: bool, html_file_name: str, chat_format: ChatFormat = None,
+                 attachment_index: AttachmentIndex = None, image_settings=None, video_posters: bool = False):
+        """Create a Message object.
+
+        Arguments:
+            original_string: str:
+                The original full content of the message, including all the prefix data like the date and time.
+                If chat_format is given, the LRM, LRE, and PDF Unicode characters must already have been removed,
+                like decode_message() does.
+
+            group_chat: bool:
+                A boolean representing whether the message came from a group chat.
+
+            html_file_name: str:
+                The name of the final HTML file.
+
+        Keyword arguments:
+            chat_format: ChatFormat:
+                The dialect of the chat. If it's None, it's detected from this message alone, which is much slower
+                and can get the order of the day and month wrong, so a whole chat should detect it once instead.
+                The invisible Unicode characters are then removed from original_string here.
+
+            attachment_index: AttachmentIndex:
+                An optional index to add the attachment of this message to. If it's given and the attachment isn't
+                in the export, the message shows a placeholder instead.
+
+            image_settings: images.ImageSettings:
+                The settings that photos and stickers are recompressed with, if they are. The message then links to
+                the recompressed version of its attachment.
+
+            video_posters: bool:
+                Whether videos get poster images when they're placed. If they don't, like when ffmpeg isn't
+                installed, a video's tag doesn't link to a poster.
+
+        Raises:
+            BadFormatError:
+                If the message doesn't match the format of the chat.
+
+        """
+        self._group_chat = group_chat
+        self._html_file_name = html_file_name
+
+        self._attachment_path = None
+        self._attachment_type = None
+        self._attachment_index = attachment_index
+        self._image_settings = image_settings
+        self._video_posters = video_posters
+
+        original = original_string
+
+        # A message that comes with its format was decoded with the rest of its chat, which removed the LRM, LRE, and
+        # PDF Unicode characters already
+        if chat_format is None:
+            original = original.translate(invisible_characters_table)
+            chat_format = detect_chat_format(original.encode('utf-8'))
+
+        self._chat_format = chat_format
+
+        prefix_match = chat_format.full_prefix_pattern.match(original)
+
+        if prefix_match:  # If it's a normal message
+            self._name = prefix_match.group(2)
+            self._message_content = prefix_match.group(3)
+            self._raw_content = self._message_content
+
+            if chat_format.attachment_message_pattern.match(self._message_content):
+                self._format_attachment_message()
+            else:
+                self._clean_message_content()
+                self._format_with_html_tags()
+                self._format_links()
+
+                self._message_content = self._message_content.replace('\n', '<br>\n\t\t')
+
+            self._group_chat_meta = False
+        else:  # If it's a group chat meta message
+            prefix_match = chat_format.group_meta_prefix_pattern.match(original)
+
+            if prefix_match is None:
+                raise BadFormatError('Failed to match normal message or group chat meta message.')
+
+            self._name = ''
+            self._message_content = prefix_match.group(2)
+            self._raw_content = self._message_content
+            self._clean_message_content()
+
+            self._group_chat_meta = True
+
+        try:
+            self._datetime_obj = chat_format.parse_timestamp(prefix_match.group(1))
+        except BadFormatError as e:
+            first_line = original.partition('\n')[0]
+            raise BadFormatError(f'{e} The line is "{first_line}".') from None
+
+        day = str(self._datetime_obj.day)
+
+        # Get day of the month extension
+        if day.endswith('1') and day != '11':
+            extension = 'st'
+        elif day.endswith('2') and day != '12':
+            extension = 'nd'
+        elif day.endswith('3') and day != '13':
+            extension = 'rd'
+        else:
+            extension = 'th'
+
+        self._day = day + extension
+
+        self.date = datetime.strftime(self._datetime_obj, f'%a {self._day} %B %Y')
+        self._time = datetime.strftime(self._datetime_obj, chat_format.display_time_format)
+
+        if self._time.startswith('0'):
+            self._time = self._time.replace('0', '', 1)
+
+    def __repr__(self) -> str:
+        """Return a __repr__ of the Message instance including the name, date, name, and whether it's from a group chat. Also includes the memory location in hex."""
+        # Use hex here at end to give memory location of Message object
+        if self._group_chat_meta:
+            return f'<{self.__class__.__module__}.{self.__class__.__name__} object with date="{self.date}", ' \
+                   f'time="{self._time}", and group_chat={self._group_chat}, which is a meta message at ' \
+                   f'{hex(id(self))}>'
+
+        # Else
+        return f'<{self.__class__.__module__}.{self.__class__.__name__} object with name="{self._name}", ' \
+               f'date="{self.date}", time="{self._time}", and group_chat={self._group_chat} at {hex(id(self))}>'
+
+    def _clean_message_content(self) -> None:
+        """Replace < and > in self._message_content to avoid rogue HTML tags."""
+        self._message_content = self._message_content.replace('<', '&lt;').replace('>', '&gt;')
+
+    def _format_with_html_tags(self) -> None:
+        """Replace WhatsApp format characters with their HTML tag equivalents in self._message_content."""
+        for pattern, replacement in Message.format_dict.items():
+            self._message_content = re.sub(pattern, replacement, self._message_content)
+
+    def _format_links(self) -> None:
+        """Find all the links in self._message_content and wrap them in <a> tags."""
+        links = re.findall(Message.link_pattern, self._message_content)
+
+        for link in links:
+            # Get rid of punctuation or spaces at the end of the link
+            while re.search(r'[\s.,!?]$', link):
+                link = link[:-1]
+
+            formatted_link = f'<a href="{link}" target="_blank">{link}</a>'
+            self._message_content = self._message_content.replace(link, formatted_link)
+
+    def _format_attachment_message(self) -> None:
+        """Format an attachment message to properly link to the attachment with HTML tags."""
+        match = self._chat_format.attachment_message_pattern.match(self._message_content)
+        if match is None:
+            raise BadFormatError('Failed to match attachment message.')
+
+        filename_no_ext = match.group(1)
+        file_type = self._chat_format.get_attachment_type(match.group(2))
+        extension = match.group(3)
+
+        filename = filename_no_ext + extension
+        self._attachment_type = file_type
+
+        if self._attachment_index is not None:
+            self._attachment_index.add(filename, file_type)
+
+            if not self._attachment_index.is_available(filename):
+                self._message_content = f'MISSING ATTACHMENT "{filename}"'
+                return
+
+        if file_type == 'AUDIO':
+            for ext, given_format in Message.html_audio_formats.items():
+                # If it's a standard, accepted extension, use that format
+                if extension == ext:
+                    html_format = given_format
+                    break
+
+            else:  # If none of the standard HTML audio formats broke out of the for loop, it will be converted to an mp3 file, so use that format
+                html_format = 'mpeg'
+                filename = filename_no_ext + '.mp3'
+
+            self._message_content = f'<audio controls>\n\t\t\t<source ' \
+                                    f'src="Attachments/{self._html_file_name}/{filename}" ' \
+                                    f'type="audio/{html_format}">\n\t\t</audio>'
+
+        elif file_type == 'VIDEO':
+            self._message_content = f'<video controls preload="none"{self._poster_attribute(filename_no_ext)}>' \
+                                    f'\n\t\t\t<source src="Attachments/{self._html_file_name}/{filename}">\n\t\t</video>'
+
+        elif (file_type == 'PHOTO') or (file_type == 'GIF' and extension == '.gif') or (file_type == 'STICKER'):
+            if self._image_settings is not None and \
+                    (optimised_filename := self._image_settings.get_output_filename(filename, file_type)) is not None:
+                filename = optimised_filename
+
+            self._message_content = f'<img class="small" src="Attachments/{self._html_file_name}/{filename}" ' \
+                                    f'alt="IMAGE ATTACHMENT" style="max-height: 400px; max-width: 800px; display: inline-block;">'
+
+        elif file_type == 'GIF' and extension != '.gif':  # Add gif as video that autoplays and loops like a proper gif
+            # Autoplaying videos are always loaded, so this only gets a poster to show until it starts
+            self._message_content = f'<video autoplay loop muted playsinline{self._poster_attribute(filename_no_ext)}>' \
+                                    f'\n\t\t\t<source src="Attachments/{self._html_file_name}/{filename}">\n\t\t</video>'
+
+        else:
+            self._message_content = f'UNKNOWN ATTACHMENT "{filename}"'
+
+        self._attachment_path = f'Attachments/{self._html_file_name}/{filename}'
+
+    def _poster_attribute(self, filename_no_ext: str) -> str:
+        """Return the poster attribute of a video's tag, or an empty string if videos don't get posters."""
+        if not self._video_posters:
+            return ''
+
+        return f' poster="Attachments/{self._html_file_name}/{filename_no_ext}{Message.video_poster_suffix}"'
+
+    def to_record(self) -> dict:
+        """Return the parsed data of the Message object as a dictionary, for exporters.
+
+        The keys are sender (None for group chat meta messages), timestamp (in ISO 8601 format), kind ('text',
+        'attachment', or 'meta'), raw_text, formatted_text (the HTML content), attachment_path, and attachment_type
+        (the WhatsApp type, like 'PHOTO'). The attachment keys are None if the message isn't an attachment, and the
+        path is None if the attachment is missing from the export.
+        """
+        if self._group_chat_meta:
+            kind = 'meta'
+        elif self._attachment_type is not None:
+            kind = 'attachment'
+        else:
+            kind = 'text'
+
+        return {
+            'sender': None if self._group_chat_meta else self._name,
+            'timestamp': self._datetime_obj.isoformat(),
+            'kind': kind,
+            'raw_text': self._raw_content,
+            'formatted_text': self._message_content,
+            'attachment_path': self._attachment_path,
+            'attachment_type': self._attachment_type
+        }
+
+    def to_viewer_row(self, sender_name: str) -> list:
+        """Return the Message object as a compact list for the data files of the virtualized viewer.
+
+        The list is the kind (0 for the sender, 1 for a recipient, 2 for a group chat meta message), the name to
+        show (only for recipients in group chats), the HTML content, the time, the date, and the date in ISO format.
+        ViewerDataWriter takes the dates off again. Library/viewer.js renders it the same way as create_html().
+
+        Arguments:
+            sender_name: str:
+                The sender in the chat that this message is from.
+
+        """
+        if self._group_chat_meta:
+            kind = 2
+            name = ''
+        else:
+            kind = 0 if self._name == sender_name else 1
+            name = self._name if self._group_chat and kind == 1 else ''
+
+        return [kind, name, self._message_content, self._time, self.date, self._datetime_obj.date().isoformat()]
+
+    def add_to_summary(self, summary: ChatSummary) -> None:
+        """Add the Message object to the summary of its chat, for the chat index page. Meta messages have no sender."""
+        summary.add(None if self._group_chat_meta else self._name, self._datetime_obj)
+
+    def create_html(self, sender_name: str) -> str:
+        """Return HTML representation of the Message object.
+
+        Arguments:
+            sender_name: str:
+                The sender in the chat that this message is from.
+
+        """
+        if not self._group_chat_meta:
+            if self._name == sender_name:
+                sender_type = 'sender'
+            else:
+                sender_type = 'recipient'
+
+            # If this is a group chat and this isn't the sender, add the recipient's name
+            if self._group_chat and self._name != sender_name:
+                css_formatted_name = self._name.replace('\u00a0', '-')  # Replace no-break space with dash
+                recipient_name = f'<span class="recipient-name {css_formatted_name}">{self._name}</span>'
+            else:
+                recipient_name = ''
+
+            return f'<div class="message {sender_type}">\n\t{recipient_name}\n\t<span class="message-info date">' \
+                   f'{self.date}</span>\n\t\t<p>{self._message_content}</p>\n\t<span class="message-info time">' \
+                   f'{self._time}</span>\n</div>\n\n'
+
+        # Else
+        # If it's a meta message in a group chat
+        return f'<div class="group-chat-meta">\n\t<span class="message-info date">{self.date}</span>\n\t\t' \
+               f'<p>{self._message_content}</p>\n\t<span class="message-info time">{self._time}</span>\n</div>\n\n'
+
+
+class Chat:
+    """The class for each chat to be formatted. Every instance is a separate chat.
+
+    Methods:
+        format():
+            Fully extract the zip file and format the chat.
+
+    """
+
+    # Tuple of extensions of output files that are worth precompressing
+    precompressed_extensions = ('.html', '.css', '.js')
+
+    # The virtualized viewer's data files have this many messages each
+    viewer_chunk_size = 1000
+
+    # Message records are sent to the exporters in batches of this many
+    export_batch_size = 1000
+
+    # The text pass saves the attachment index in the temporary directory under this name, so the attachment pass can resume
+    attachment_index_filename = '_attachments.json'
+
+    # The text pass saves the summary of the chat in the temporary directory under this name, for the chat index after a resume
+    summary_filename = '_summary.json'
+
+    # A _chat.txt file at least this many bytes long is parsed in chunks of about parse_chunk_size bytes in the parse pool
+    parallel_parsing_threshold = 8 * 1024 * 1024
+    parse_chunk_size = 2 * 1024 * 1024
+
+    # Estimates of the memory used by work in flight, as multiples of the size of its input, for the resource governor
+    # A chunk's HTML and Message objects are a few times bigger than its text, and decoded audio is raw PCM
+    parse_memory_factor = 4
+    audio_memory_factor = 64
+    image_memory_factor = 16
+
+    def __init__(self, input_file: str, group_chat: bool, sender_name: str, chat_title: str, html_file_name: str, output_dir: str,
+                 journal: BatchJournal = None, event_sink=None, event_interval: float = 0.1, precompress: bool = False,
+                 parallel_parsing: bool = True, archive: ArchiveWriter = None, exporters: list = None,
+                 profile: str = None, virtualized: bool = False, governor: ResourceGovernor = None, image_settings=None,
+                 index_page: bool = True):
+        """Create a Chat object with instance attributes equal to the arguments passed.
+
+        Arguments:
+            input_file:
+                The original zip file of the exported chat. It must have the '.zip' extension.
+
+            group_chat:
+                A boolean to determine whether the chat is a group chat.
+
+            sender_name:
+                The name of the sender in the chat. Typically the user's WhatsApp alias.
+
+            chat_title:
+                The title of the chat. This appears in the top bar and in the browser tab. It is not the file name.
+
+            html_file_name:
+                The intended name of the final HTML file.
+
+            output_dir:
+                The intended directory for the output. The HTML file, Attachments folder, and Library folder will go here.
+
+        Keyword arguments:
+            journal:
+                An optional BatchJournal to record the progress of this chat in. If the journal says this chat has
+                already been partly formatted, format() resumes at the first unfinished stage.
+
+            event_sink:
+                An optional callable to report this chat's progress to. See ProgressTracker.
+
+            event_interval:
+                The minimum number of seconds between two progress reports.
+
+            precompress:
+                If True, write gzip (and Brotli, if the brotli package is installed) versions of the HTML file and the
+                text files in Library next to them, so a static web server can send them without compressing them itself.
+
+            parallel_parsing:
+                If True, a very large chat is split into chunks that are parsed in parallel in a process pool.
+
+            archive:
+                An optional ArchiveWriter to write the HTML file, Library folder, and attachments into, instead of
+                output_dir. A chat written into an archive can't be resumed from a journal or precompressed.
+
+            exporters:
+                An optional list of exporters, like the ones in exporters.py, to send the record of every message to
+                while the HTML is rendered. See Message.to_record().
+
+            profile:
+                None to not profile the chat, or 'cprofile' or 'sampling' to profile every thread and process that works
+                on it, and write the profile next to the HTML file. See ChatProfiler in profiling.py.
+
+            virtualized:
+                If True, write the messages to chunked data files in Data/<html_file_name> instead of the HTML file,
+                and make the HTML file a viewer which only renders the messages that are on the screen.
+
+            governor:
+                The ResourceGovernor that holds this chat back until there's room for its extraction, transcodes, and
+                parse chunks. It defaults to the one from get_resource_governor(), which is shared by every chat.
+
+            image_settings:
+                An optional images.ImageSettings to recompress photos and stickers with, in the parse pool. The HTML
+                links to the recompressed versions instead of the originals.
+
+            index_page:
+                If True, add this chat to the ChatManifest of output_dir when it's finished, so that it's listed in
+                index.html there. A chat written into an archive is never added.
+
+        Raises:
+            ValueError:
+                If profile isn't None or one of the profile modes.
+
+        """
+        self._input_file = input_file
+        self._group_chat = group_chat
+        self._sender_name = sender_name
+        self._chat_title = chat_title
+        self._html_file_name = html_file_name
+        self._output_dir = output_dir
+        self._precompress = precompress
+        self._parallel_parsing = parallel_parsing
+        self._archive = archive
+        self._exporters = exporters or []
+        self._virtualized = virtualized
+        self._governor = governor if governor is not None else get_resource_governor()
+        self._image_settings = image_settings
+        # Videos only link to posters if ffmpeg is there to make them
+        self._video_posters = shutil.which('ffmpeg') is not None
+        self._index_page = index_page and archive is None
+
+        # The profiler is only imported if it's used, so it costs nothing otherwise
+        if profile is not None:
+            import profiling
+            self._profiler = profiling.ChatProfiler(profile, os.path.join(output_dir, html_file_name), chat_title)
+        else:
+            self._profiler = None
+
+        self._journal = journal
+        self._chat_format = None
+        self._attachment_index = None
+        self._summary = ChatSummary()
+        self._html_file_path = None
+        self._key = make_chat_key(input_file, html_file_name, output_dir)
+        self._progress = ProgressTracker(event_sink, self._key, chat_title, min_interval=event_interval)
+
+        # Threads to be used later
+        self._write_text_thread = threading.Thread(target=self._run_in_thread, args=(self._write_text,))
+        self._move_attachment_files_thread = threading.Thread(target=self._run_in_thread, args=(self._move_attachment_files,))
+        self._thread_exceptions = []
+
+        # This is a unique temporary directory for this chat, to allow for multithreading multiple chats
+        # os.path.splitext()[0] is used to remove extensions
+        # os.path.split()[1] is used to just get the name of the zip file, not the absolute path
+        self._temp_directory = f'temp_{os.path.splitext(os.path.split(self._input_file)[1])[0]}_{self._chat_title}_' \
+                               f'{os.path.splitext(self._html_file_name)[0]}'
+
+        # Make directories if they don't exist. A chat written into an archive doesn't need them
+        if archive is None:
+            if not os.path.isdir(library_path := os.path.join(self._output_dir, 'Library')):
+                shutil.copytree('Library', library_path)
+
+            # A Library folder from an older version doesn't have the virtualized viewer or the chat index
+            else:
+                for f in ('viewer.js', 'viewer.css', 'chat_index.js', 'chat_index.css'):
+                    if not os.path.isfile(os.path.join(library_path, f)):
+                        shutil.copy(os.path.join('Library', f), library_path)
+
+            if not os.path.isdir(attachments_path := os.path.join(self._output_dir, 'Attachments', self._html_file_name)):
+                os.makedirs(attachments_path)
+
+    def _get_journal_entry(self) -> dict:
+        """Return this chat's entry in the journal. Without a journal, every chat is pending."""
+        if self._journal is None:
+            return {'stage': 'pending'}
+
+        return self._journal.get_entry(self._key)
+
+    def _update_journal(self, **fields) -> None:
+        """Update this chat's entry in the journal, if there is one, and report any change of stage."""
+        if self._journal is not None:
+            self._journal.update(self._key, **fields)
+
+        if 'stage' in fields:
+            self._progress.set_stage(fields['stage'])
+
+    def _profiled(self, target):
+        """Return target, wrapped to be profiled in whatever thread calls it if the chat is being profiled."""
+        if self._profiler is None:
+            return target
+
+        return functools.partial(self._profiler.run, target)
+
+    def _run_in_thread(self, target) -> None:
+        """Run target and keep any exception it raises, so that format() can re-raise it in the calling thread."""
+        try:
+            self._profiled(target)()
+        except Exception as e:
+            self._thread_exceptions.append(e)
+
+    def _extract_zip(self) -> None:
+        """Extract the zip file into a temporary directory.
+
+        Extract the object's input_file into a unique temporary directory.
+
+        Raises:
+            OSError:
+                If the zip file doesn't exist or can't be extracted.
+
+            zipfile.BadZipFile:
+                If the zip file is corrupt.
+
+        """
+        try:
+            with zipfile.ZipFile(self._input_file) as zip_file:
+                zip_file.extractall(self._temp_directory)
+
+        except (OSError, zipfile.BadZipFile):  # If the zip file failed to extract
+            print(f'ERROR: Failed to extract {self._input_file}. It likely does not exist. This chat will be rejected.')
+            raise
+
+    def _load_chat_format(self) -> ChatFormat:
+        """Detect the format of temp/_chat.txt and record it in the journal.
+
+        If the journal already has the format, it's used instead, because _chat.txt is removed once the text is written.
+        """
+        if (name := self._get_journal_entry().get('chat_format')) is not None:
+            return get_chat_format_by_name(name)
+
+        with open(os.path.join(self._temp_directory, '_chat.txt'), 'rb') as f:
+            sample = f.read(chat_format_sample_size)
+
+        # An empty chat has no messages to detect the format from, and nothing to use it on
+        chat_format = detect_chat_format(sample) if sample else get_chat_format('ios', 'dmy', 4, '24h')
+
+        self._update_journal(chat_format=chat_format.name)
+        return chat_format
+
+    def _open_html_file(self):
+        """Open the output HTML file for writing and record its name in the journal.
+
+        If the journal already has an HTML file for this chat, it was left half-written by an interrupted run, so it gets overwritten.
+        When writing into an archive, this opens an entry in the archive instead.
+        """
+        if self._archive is not None:
+            return self._archive.open_text(self._html_file_name + '.html')
+
+        if (html_file_path := self._get_journal_entry().get('html_file')) is not None:
+            self._html_file_path = html_file_path
+            return open(html_file_path, 'w+', encoding='utf-8')
+
+        # Add number to the end of the filename if the file already exists
+        html_filename_with_directory_no_ext = os.path.join(self._output_dir, self._html_file_name)
+        if not os.path.isfile(html_filename_with_directory_no_ext + '.html'):
+            html_file_path = html_filename_with_directory_no_ext + '.html'
+        else:
+            same_name_number = 1
+
+            while os.path.isfile(html_filename_with_directory_no_ext + f' ({same_name_number}).html'):
+                same_name_number += 1
+
+            html_file_path = html_filename_with_directory_no_ext + f' ({same_name_number}).html'
+
+        self._update_journal(html_file=html_file_path)
+        self._html_file_path = html_file_path
+        return open(html_file_path, 'w+', encoding='utf-8')
+
+    def _iter_raw_messages(self):
+        """Yield every message in temp/_chat.txt as a string. See decode_message().
+
+        The file is memory-mapped and split into messages on its raw bytes, and only one message is decoded at a time.
+        """
+        chat_txt_path = os.path.join(self._temp_directory, '_chat.txt')
+
+        if os.path.getsize(chat_txt_path) == 0:  # An empty file can't be memory-mapped
+            return
+
+        with open(chat_txt_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as chat_txt:
+            spans = split_messages(chat_txt, self._chat_format)
+            self._progress.add(messages_total=len(spans))
+
+            for span in spans:
+                yield decode_message(chat_txt, span)
+
+    def _render_chunks_in_parallel(self, viewer: bool = False):
+        """Split temp/_chat.txt into chunks of whole messages, render them in the parse pool, and yield the results of render_chunk() in order.
+
+        If viewer is True, the chunks are rendered as rows for the virtualized viewer instead of HTML.
+        Chunks are only sent to the pool while the resource governor has memory for them, and a chunk's memory is
+        given back once the caller has finished with its result. At least one chunk is always in flight.
+        """
+        chat_txt_path = os.path.abspath(os.path.join(self._temp_directory, '_chat.txt'))
+
+        with open(chat_txt_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as chat_txt:
+            spans = split_messages(chat_txt, self._chat_format)
+
+        self._progress.add(messages_total=len(spans))
+
+        # Each chunk goes from the start of its first message to the end of its last message
+        chunks = []
+        chunk_start = 0
+        for i, (start, end) in enumerate(spans):
+            if end - chunk_start >= Chat.parse_chunk_size or i == len(spans) - 1:
+                chunks.append((chunk_start, end))
+
+                if i < len(spans) - 1:
+                    chunk_start = spans[i + 1][0]
+
+        executor = get_parse_executor()
+
+        def submit(start: int, end: int):
+            if self._profiler is None:
+                return executor.submit(render_chunk, chat_txt_path, start, end, self._group_chat, self._sender_name,
+                                       self._html_file_name, self._chat_format, with_records=bool(self._exporters),
+                                       viewer=viewer, attachment_index=self._attachment_index,
+                                       image_settings=self._image_settings, video_posters=self._video_posters)
+
+            # Each worker profiles its own chunk and writes it to a file for the profiler to merge
+            import profiling
+            return executor.submit(profiling.profile_call, self._profiler.mode, self._profiler.new_worker_file(),
+                                   render_chunk, chat_txt_path, start, end, self._group_chat, self._sender_name,
+                                   self._html_file_name, self._chat_format, with_records=bool(self._exporters),
+                                   viewer=viewer, attachment_index=self._attachment_index,
+                                   image_settings=self._image_settings, video_posters=self._video_posters)
+
+        in_flight = []  # The future and memory of every chunk that has been submitted but not yielded yet
+        next_chunk = 0
+
+        try:
+            while next_chunk < len(chunks) or in_flight:
+                while next_chunk < len(chunks):
+                    start, end = chunks[next_chunk]
+                    memory_bytes = (end - start) * Chat.parse_memory_factor
+
+                    # Waiting for memory with chunks in flight would never end, because only this loop gives it back
+                    if in_flight:
+                        if not self._governor.try_acquire(memory_bytes=memory_bytes):
+                            break
+                    else:
+                        self._governor.acquire(memory_bytes=memory_bytes)
+
+                    in_flight.append((submit(start, end), memory_bytes))
+                    next_chunk += 1
+
+                future, memory_bytes = in_flight[0]
+                result = future.result()
+
+                yield result
+
+                del in_flight[0]
+                self._governor.release(memory_bytes=memory_bytes)
+        finally:
+            # The chat failed or stopped early, so give back the memory of the chunks that will never be yielded
+            for future, memory_bytes in in_flight:
+                future.cancel()
+                self._governor.release(memory_bytes=memory_bytes)
+
+    def _export_records(self, records: list, finished: bool = False) -> None:
+        """Send the records to every exporter and clear the list, once there are enough of them or the chat is finished."""
+        if records and (finished or len(records) >= Chat.export_batch_size):
+            for exporter in self._exporters:
+                exporter.write_messages(self._key, self._chat_title, records)
+
+            records.clear()
+
+    def _use_parallel_parsing(self) -> bool:
+        """Return True if temp/_chat.txt is big enough to be parsed in chunks in the parse pool."""
+        return self._parallel_parsing and \
+            os.path.getsize(os.path.join(self._temp_directory, '_chat.txt')) >= Chat.parallel_parsing_threshold
+
+    def _write_viewer_data(self, html_file, records: Optional[list]) -> List[str]:
+        """Write the viewer page to html_file and close it, and then write every message to the viewer's data files.
+
+        html_file is closed first, so the page is finished before the data files are written.
+
+        Returns:
+            The paths of the data files.
+
+        """
+        # The data files are named after the HTML file, which might have had a number added to its name
+        data_name = os.path.splitext(os.path.basename(html_file.name))[0]
+
+        if self._archive is not None:
+            def open_text(name):
+                return self._archive.open_text(f'Data/{data_name}/{name}')
+        else:
+            data_directory = os.path.join(self._output_dir, 'Data', data_name)
+            os.makedirs(data_directory, exist_ok=True)
+
+            def open_text(name):
+                return open(os.path.join(data_directory, name), 'w', encoding='utf-8')
+
+        html_file.write(render_viewer_page(self._chat_title, urllib.parse.quote(f'Data/{data_name}')))
+        html_file.close()
+
+        writer = ViewerDataWriter(open_text, Chat.viewer_chunk_size)
+
+        if self._use_parallel_parsing():
+            for rows, message_count, _, _, chunk_records, attachments, summary in self._render_chunks_in_parallel(viewer=True):
+                for row in rows:
+                    writer.add_row(row)
+
+                self._attachment_index.add_all(attachments)
+                self._summary.merge(summary)
+                self._progress.add(messages_parsed=message_count)
+
+                if records is not None:
+                    records.extend(chunk_records)
+                    self._export_records(records)
+        else:
+            for row in render_viewer_rows(self._iter_raw_messages(), self._group_chat, self._sender_name, self._html_file_name,
+                                          self._chat_format, records=records, attachment_index=self._attachment_index,
+                                          image_settings=self._image_settings, video_posters=self._video_posters,
+                                          summary=self._summary):
+                if row is not None:
+                    writer.add_row(row)
+
+                self._progress.add(messages_parsed=1)
+
+                if records is not None:
+                    self._export_records(records)
+
+        writer.close()
+        self._progress.add(bytes_written=writer.bytes_written)
+
+        return writer.paths
+
+    def _write_text(self) -> None:
+        """Write the contents of temp/_chat.txt to the output directory, and add every attachment to the attachment index."""
+        complete = False
+
+        try:
+            self._write_messages()
+            complete = True
+        finally:
+            # The attachment pass waits for more attachments until the index is finished
+            self._attachment_index.finish(complete)
+
+        self._finish_text()
+
+    def _write_messages(self) -> None:
+        """Write every message to the HTML file, or to the data files of the virtualized viewer."""
+        html_file = self._open_html_file()
+
+        try:
+            self._write_html_file(html_file)
+        except BaseException:
+            # Don't leave the file open, or half of it in the archive
+            if self._archive is not None:
+                html_file.discard()
+            else:
+                html_file.close()
+
+            raise
+
+    def _write_html_file(self, html_file) -> None:
+        """Write every message to html_file and close it, or write the viewer page to it and the messages to the data files."""
+        # Records are only collected if anything is going to export them
+        records = [] if self._exporters else None
+
+        # A chat that was interrupted while it was writing its text might have exported some records already
+        for exporter in self._exporters:
+            exporter.start_chat(self._key)
+
+        if self._virtualized:
+            data_paths = self._write_viewer_data(html_file, records)
+
+            if records is not None:
+                self._export_records(records, finished=True)
+
+            if self._precompress and self._archive is None:
+                self._precompress_text_files(html_file.name, data_paths)
+
+            return
+
+        html_file.write(render_start_template(self._chat_title))
+
+        # === Write every message
+
+        if self._use_parallel_parsing():
+            for html, message_count, chunk_records, attachments, summary in join_rendered_chunks(self._render_chunks_in_parallel()):
+                html_file.write(html)
+                self._attachment_index.add_all(attachments)
+                self._summary.merge(summary)
+                self._progress.add(messages_parsed=message_count, bytes_written=len(html.encode('utf-8')))
+
+                if records is not None:
+                    records.extend(chunk_records)
+                    self._export_records(records)
+        else:
+            for html in render_messages(self._iter_raw_messages(), self._group_chat, self._sender_name, self._html_file_name,
+                                        self._chat_format, records=records, attachment_index=self._attachment_index,
+                                        image_settings=self._image_settings, video_posters=self._video_posters,
+                                        summary=self._summary):
+                html_file.write(html)
+                self._progress.add(messages_parsed=1, bytes_written=len(html.encode('utf-8')))
+
+                if records is not None:
+                    self._export_records(records)
+
+        if records is not None:
+            self._export_records(records, finished=True)
+
+        html_file.write(render_end_template())
+
+        html_file.close()
+
+        if self._precompress and self._archive is None:
+            self._precompress_text_files(html_file.name)
+
+    def _finish_text(self) -> None:
+        """Save the attachment index and the summary, record that the text is written, and remove temp/_chat.txt."""
+        if self._profiler is not None:
+            self._profiler.take_snapshot('text written')
+
+        self._attachment_index.save(os.path.join(self._temp_directory, Chat.attachment_index_filename))
+        self._summary.save(os.path.join(self._temp_directory, Chat.summary_filename))
+        self._update_journal(stage='text_written')
+        os.remove(os.path.join(self._temp_directory, '_chat.txt'))
+
+    def _place_attachment(self, path: str, filename: str) -> None:
+        """Move a finished attachment file to Attachments/<html_file_name>/filename in the output directory or the archive."""
+        if self._archive is not None:
+            self._archive.add_file(path, f'Attachments/{self._html_file_name}/{filename}')
+            os.remove(path)
+        else:
+            # os.replace() overwrites any copy left in the output by an interrupted run
+            os.replace(path, os.path.join(self._output_dir, 'Attachments', self._html_file_name, filename))
+
+    def _place_video(self, f: str) -> None:
+        """Remux a video into the output directory so it starts fast, and extract its poster image there.
+
+        If ffmpeg isn't installed or fails, the video is moved as it is, without a poster. When writing into an archive,
+        the remuxed video and the poster are made in the temporary directory and then added to the archive.
+        """
+        video_path = os.path.join(self._temp_directory, f)
+        poster_filename = os.path.splitext(f)[0] + Message.video_poster_suffix
+
+        if self._archive is None:
+            output_path = os.path.join(self._output_dir, 'Attachments', self._html_file_name, f)
+        else:
+            output_path = os.path.join(self._temp_directory, 'remuxed_' + f)
+
+        poster_path = os.path.join(os.path.dirname(output_path), poster_filename)
+
+        # ffmpeg copies the streams, so it doesn't need much memory
+        with self._governor.hold(transcodes=1):
+            if remux_fast_start(video_path, output_path):
+                os.remove(video_path)
+            else:
+                os.replace(video_path, output_path)
+
+            has_poster = extract_video_poster(output_path, poster_path)
+
+        if self._archive is not None:
+            self._place_attachment(output_path, f)
+
+            if has_poster:
+                self._place_attachment(poster_path, poster_filename)
+
+        self._progress.add(attachments_done=1)
+
+    def _add_to_chat_manifest(self) -> None:
+        """Add this chat's entry to the ChatManifest of the output directory, for its index.html.
+
+        If the text was written by an earlier run, the summary it saved in the temporary directory is used.
+        """
+        summary_path = os.path.join(self._temp_directory, Chat.summary_filename)
+
+        if self._summary.messages == 0 and os.path.isfile(summary_path):
+            self._summary = ChatSummary.load(summary_path)
+
+        if (html_file_path := self._get_journal_entry().get('html_file', self._html_file_path)) is None:
+            print(f'WARNING: Couldn\'t add {self._input_file} to the chat index, because its HTML file is unknown')
+            return
+
+        attachments_path = os.path.join(self._output_dir, 'Attachments', self._html_file_name)
+        attachment_bytes = sum(entry.stat().st_size for entry in os.scandir(attachments_path) if entry.is_file())
+
+        ChatManifest(self._output_dir).add({
+            'html_path': os.path.relpath(html_file_path, self._output_dir).replace(os.sep, '/'),
+            'title': self._chat_title,
+            'group_chat': self._group_chat,
+            **self._summary.to_dict(),
+            'attachment_bytes': attachment_bytes,
+            'virtualized': self._virtualized,
+            'updated': datetime.now().isoformat(timespec='seconds')
+        })
+
+    def _load_attachment_index(self, stage: str) -> AttachmentIndex:
+        """Return the attachment index for the attachment pass.
+
+        If the text hasn't been written yet, this is an empty index of the files in the zip file, for the text pass
+        to fill in. Otherwise, it's the index that the text pass saved in the temporary directory.
+        """
+        if stage == 'extracted':
+            with zipfile.ZipFile(self._input_file) as zip_file:
+                return AttachmentIndex(name for name in zip_file.namelist() if name != '_chat.txt' and '/' not in name)
+
+        index_path = os.path.join(self._temp_directory, Chat.attachment_index_filename)
+        if os.path.isfile(index_path):
+            return AttachmentIndex.load(index_path)
+
+        # The text was written by a version that didn't save the index, so every attachment file counts as referenced
+        files = sorted(os.listdir(self._temp_directory))
+        index = AttachmentIndex(files)
+
+        for f in files:
+            if (file_match := self._chat_format.attachment_file_pattern.match(f)) is not None:
+                index.add(f, self._chat_format.get_attachment_type(file_match.group(2)))
+
+        index.finish()
+        return index
+
+    def _move_attachment_files(self) -> None:
+        """Move every attachment that a message refers to from temp to the output directory, as the text pass finds them.
+
+        Videos are remuxed and get poster images in the shared video pool, and if image_settings was given, photos
+        and stickers are recompressed in the parse pool, while the other files are handled here. The images are
+        placed before waiting for the text pass to find more attachments, because it might be waiting for their memory.
+        Files that no message refers to are skipped, and they're reported along with any missing attachments.
+        """
+        video_futures = []
+        pending_images = collections.deque()
+
+        def place_pending_images():
+            # The text pass might be waiting for the memory of these images, so it must get it back before this
+            # thread waits for the text pass
+            while pending_images:
+                self._place_image(*pending_images.popleft())
+
+        try:
+            for f, file_type in self._attachment_index.iter_references(before_wait=place_pending_images):
+                # The file is missing from the export, or an interrupted run already moved it
+                if not os.path.isfile(os.path.join(self._temp_directory, f)):
+                    continue
+
+                self._progress.add(attachments_total=1)
+
+                if self._image_settings is not None and \
+                        (output_f := self._image_settings.get_output_filename(f, file_type)) is not None:
+                    self._progress.add(transcodes_queued=1)
+                    pending_images.append(self._submit_image(f, output_f, pending_images))
+                    continue
+
+                self._move_attachment_file(f, file_type, video_futures)
+
+            place_pending_images()
+
+        finally:
+            # Something went wrong, so give back the memory of the images that won't be placed now
+            for future, *_, memory_bytes in pending_images:
+                future.cancel()
+                self._governor.release(memory_bytes=memory_bytes)
+
+        for future in video_futures:
+            future.result()  # This re-raises any exception from the video pool
+
+        self._report_skipped_attachments()
+
+    def _move_attachment_file(self, f: str, file_type: str, video_futures: list) -> None:
+        """Move one attachment that isn't recompressed from temp to the output directory, converting it if necessary.
+
+        Videos are sent to the video pool instead, and their futures are appended to video_futures.
+        """
+        f_no_ext, extension = os.path.splitext(f)
+
+        if file_type == 'VIDEO' or (file_type == 'GIF' and extension != '.gif'):
+            self._progress.add(transcodes_queued=1)
+            video_futures.append(get_video_executor().submit(self._profiled(self._place_video), f))
+            return
+
+        # Convert audio files that can't be played in browsers with simple HTML audio tags
+        # This is necessary because all voice messages are .opus, which must be converted
+        if file_type == 'AUDIO' and extension not in Message.html_audio_formats:
+            self._progress.add(transcodes_queued=1)
+
+            # pydub looks for ffmpeg when it's imported, so only import it when a chat has audio
+            from pydub import AudioSegment
+
+            # pydub decodes the whole file into memory
+            memory_bytes = os.path.getsize(os.path.join(self._temp_directory, f)) * Chat.audio_memory_factor
+
+            # Convert old audio file into .mp3 in same directory
+            with self._governor.hold(transcodes=1, memory_bytes=memory_bytes):
+                AudioSegment.from_file(os.path.join(self._temp_directory, f)).export(
+                    os.path.join(self._temp_directory, f_no_ext) + '.mp3', format='mp3')
+
+            # Remove old audio file
+            os.remove(os.path.join(self._temp_directory, f))
+            # Set f to new file to make moving the new file easier
+            f = f_no_ext + '.mp3'
+
+        self._place_attachment(os.path.join(self._temp_directory, f), f)
+        self._progress.add(attachments_done=1)
+
+    def _submit_image(self, f: str, output_f: str, pending_images) -> tuple:
+        """Send a photo or sticker to the parse pool to be recompressed, once the resource governor has memory for it.
+
+        While the governor is out of memory, the oldest images in pending_images are placed to give theirs back,
+        and it only waits for memory when none are left.
+
+        Returns:
+            A tuple of the arguments of _place_image() for the image.
+
+        """
+        import images
+
+        source_path = os.path.join(self._temp_directory, f)
+        destination_path = os.path.join(self._temp_directory, 'optimised_' + output_f)
+
+        # A decoded image is much bigger than its compressed file
+        memory_bytes = os.path.getsize(source_path) * Chat.image_memory_factor
+
+        acquired = False
+        while pending_images and not (acquired := self._governor.try_acquire(memory_bytes=memory_bytes)):
+            self._place_image(*pending_images.popleft())
+
+        if not acquired:
+            self._governor.acquire(memory_bytes=memory_bytes)
+
+        try:
+            if self._profiler is None:
+                future = get_parse_executor().submit(images.optimise_image, source_path, destination_path, self._image_settings)
+            else:
+                import profiling
+                future = get_parse_executor().submit(profiling.profile_call, self._profiler.mode, self._profiler.new_worker_file(),
+                                                     images.optimise_image, source_path, destination_path, self._image_settings)
+        except BaseException:
+            self._governor.release(memory_bytes=memory_bytes)
+            raise
+
+        return future, f, output_f, destination_path, memory_bytes
+
+    def _place_image(self, future, f: str, output_f: str, destination_path: str, memory_bytes: int) -> None:
+        """Wait for an image from _submit_image() to be recompressed, and move it to the output directory as output_f.
+
+        If the image couldn't be read, the original is moved there under its own name instead, so that it isn't lost
+        and isn't served as a different format. Its message still links to output_f, which doesn't exist.
+        """
+        try:
+            recompressed = future.result()  # This re-raises any exception from the parse pool
+        finally:
+            self._governor.release(memory_bytes=memory_bytes)
+
+        if recompressed:
+            os.remove(os.path.join(self._temp_directory, f))
+            self._place_attachment(destination_path, output_f)
+        else:
+            print(f'WARNING: {f} in {self._input_file} couldn\'t be read, so it wasn\'t recompressed. '
+                  f'It was copied unchanged, and its message can\'t show it.')
+            self._place_attachment(os.path.join(self._temp_directory, f), f)
+
+        self._progress.add(attachments_done=1)
+
+    def _report_skipped_attachments(self) -> None:
+        """Report the attachments that are missing from the export, and the files in it that no message refers to.
+
+        The files that no message refers to are left in temp, to be removed with it. If the text pass failed, nothing is
+        reported, because the references are incomplete and the text pass reports its own error.
+        """
+        if not self._attachment_index.complete:
+            return
+
+        referenced = {f for f, _ in self._attachment_index.references}
+        unreferenced = [f for f in os.listdir(self._temp_directory)
+                        if f not in referenced and f not in ('_chat.txt', Chat.attachment_index_filename, Chat.summary_filename)]
+
+        missing = self._attachment_index.missing
+        self._progress.add(attachments_missing=len(missing), attachments_unreferenced=len(unreferenced))
+
+        if missing:
+            print(f'WARNING: {len(missing)} attachments are missing from {self._input_file}, so their messages '
+                  f'show placeholders: {", ".join(missing[:5])}{", ..." if len(missing) > 5 else ""}')
+
+        if unreferenced:
+            print(f'WARNING: {len(unreferenced)} files in {self._input_file} aren\'t referred to by any message, so they '
+                  f'were skipped: {", ".join(unreferenced[:5])}{", ..." if len(unreferenced) > 5 else ""}')
+
+    def _precompress_text_files(self, html_file_path: str, data_paths: List[str] = ()) -> None:
+        """Write precompressed versions of the HTML file, any data files, and the text files in Library, compressing them in a thread pool.
+
+        zlib and Brotli release the GIL while compressing, so threads compress several files in parallel.
+        """
+        import concurrent.futures
+
+        library_path = os.path.join(self._output_dir, 'Library')
+        paths = [html_file_path, *data_paths] + [os.path.join(library_path, f) for f in os.listdir(library_path)
+                                    if f.endswith(Chat.precompressed_extensions)]
+
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            # list() makes sure any exception gets raised here
+            list(executor.map(precompress_file, paths))
+
+    def _remove_temp_directory(self) -> None:
+        """Remove the temporary directory and anything left in it."""
+        if os.path.isdir(self._temp_directory):
+            shutil.rmtree(self._temp_directory)
+
+    def format(self) -> None:
+        """Fully extract the zip file and format the chat.
+
+        If this chat has a journal entry from an interrupted run, finished stages are skipped, and partial
+        output from the unfinished stages is cleaned up and redone.
+        """
+        if self._profiler is None:
+            self._format_stages()
+            return
+
+        self._profiler.start()
+        try:
+            self._profiler.run(self._format_stages)
+        finally:
+            self._profiler.stop()
+
+    def _get_extraction_size(self) -> int:
+        """Return the total uncompressed size of the files in the zip file, or 0 if it can't be read."""
+        try:
+            with zipfile.ZipFile(self._input_file) as zip_file:
+                return sum(info.file_size for info in zip_file.infolist())
+        except (OSError, zipfile.BadZipFile):  # _extract_zip() reports this
+            return 0
+
+    def _format_stages(self) -> None:
+        """Wait until the resource governor has room for this chat's extraction, and then run every unfinished stage."""
+        stage = self._get_journal_entry()['stage']
+
+        if stage == 'done':
+            return
+
+        # The extracted files stay on the disk until the chat is finished, so the chat holds their size until then
+        extraction_bytes = self._get_extraction_size()
+
+        if not self._governor.try_acquire(extraction_bytes=extraction_bytes):
+            self._progress.set_stage('waiting')
+            self._governor.acquire(extraction_bytes=extraction_bytes)
+
+        try:
+            self._run_stages(stage)
+        finally:
+            self._governor.release(extraction_bytes=extraction_bytes)
+
+    def _run_stages(self, stage: str) -> None:
+        """Run every stage of format() after the given one."""
+        try:
+            # The temporary directory can only be trusted if this chat got past extraction last time
+            if stage == 'pending' or (stage in ('extracted', 'text_written') and not os.path.isdir(self._temp_directory)):
+                self._remove_temp_directory()
+                self._extract_zip()
+
+                if self._archive is not None:
+                    self._archive.add_library()
+
+                    # Both threads use the name, so it's reserved before they start
+                    self._html_file_name = self._archive.reserve_chat_name(self._html_file_name)
+
+                if stage == 'pending':
+                    stage = 'extracted'
+                    self._update_journal(stage=stage)
+
+            if stage == 'text_written' and os.path.isfile(chat_txt_path := os.path.join(self._temp_directory, '_chat.txt')):
+                os.remove(chat_txt_path)
+
+            if stage in ('extracted', 'text_written'):
+                # Both threads need the format and the attachment index, so they're loaded before they start
+                self._chat_format = self._load_chat_format()
+                self._attachment_index = self._load_attachment_index(stage)
+
+                if stage == 'extracted':
+                    self._write_text_thread.start()
+
+                self._move_attachment_files_thread.start()
+
+                if stage == 'extracted':
+                    self._write_text_thread.join()
+
+                self._move_attachment_files_thread.join()
+
+                if self._thread_exceptions:
+                    raise self._thread_exceptions[0]
+
+                self._update_journal(stage='attachments_placed')
+
+            # The summary is in the temporary directory, so the chat is added to the index before it's removed
+            if self._index_page:
+                self._add_to_chat_manifest()
+
+            self._remove_temp_directory()
+            self._update_journal(stage='done')
+
+        except BaseException:
+            self._progress.set_stage('failed')
+
+            # Without a journal, nothing can resume from the temporary directory, so don't leave it lying around
+            if self._journal is None:
+                self._remove_temp_directory()
+
+            raise
+
+
+# A translation table to remove LRM, LRE, and PDF Unicode characters
+invisible_characters_table = str.maketrans('', '', '\u200e\u202a\u202c')
+
+
+@functools.lru_cache(maxsize=None)
+def get_chat_format(platform: str, date_order: str, year_length: int, clock: str) -> ChatFormat:
+    """Return the ChatFormat with the given options, compiling it the first time it's needed. See ChatFormat."""
+    return ChatFormat(platform, date_order, year_length, clock)
+
+
+def get_chat_format_by_name(name: str) -> ChatFormat:
+    """Return the ChatFormat with the given name, like 'ios-dmy-yyyy-24h'.
+
+    Raises:
+        ValueError:
+            If name isn't the name of a ChatFormat.
+
+    """
+    try:
+        platform, date_order, year, clock = name.split('-')
+    except ValueError:
+        raise ValueError(f'Unknown chat format {name!r}.') from None
+
+    return get_chat_format(platform, date_order, len(year), clock)
+
+
+# These loosely match the prefix of the first message on a line in any dialect, to detect which one a chat uses
+# Groups: first number of the date is 1, second number of the date is 2, year is 3, am or pm is 4
+ios_detection_pattern = re.compile(r'^\[(\d{1,2})/(\d{1,2})/(\d{2}|\d{4}), \d{1,2}:\d{2}:\d{2}(?:(?: |\u202f)([aApP][mM]))?] ',
+                                   re.MULTILINE)
+android_detection_pattern = re.compile(r'^(\d{1,2})/(\d{1,2})/(\d{2}|\d{4}), \d{1,2}:\d{2}(?:(?: |\u202f)([aApP][mM]))? - ',
+                                       re.MULTILINE)
+
+# This many bytes from the start of _chat.txt are enough to detect its format
+chat_format_sample_size = 64 * 1024
+
+
+def detect_chat_format(chat_txt) -> ChatFormat:
+    """Detect the dialect of a chat from the first chat_format_sample_size bytes of its _chat.txt file.
+
+    chat_txt can be bytes or any other bytes-like object, like an mmap. The platform is the one whose prefix
+    starts the most lines. If a number in the dates is bigger than 12, it must be the day. If that doesn't decide
+    it, dates with a 2 digit year are taken to be month first, like in the US, and dates with a 4 digit year are
+    taken to be day first.
+
+    Raises:
+        BadFormatError:
+            If no line in the sample starts with the prefix of a message.
+
+    """
+    sample = bytes(chat_txt[:chat_format_sample_size]).decode('utf-8', errors='ignore').translate(invisible_characters_table)
+
+    ios_matches = ios_detection_pattern.findall(sample)
+    android_matches = android_detection_pattern.findall(sample)
+
+    if not ios_matches and not android_matches:
+        raise BadFormatError('Failed to detect the format of the chat.')
+
+    platform, matches = ('ios', ios_matches) if len(ios_matches) >= len(android_matches) else ('android', android_matches)
+
+    year_length = len(matches[0][2])
+    clock = '12h' if any(am_pm for *_, am_pm in matches) else '24h'
+
+    if any(int(first) > 12 for first, *_ in matches):
+        date_order = 'dmy'
+    elif any(int(second) > 12 for _, second, *_ in matches):
+        date_order = 'mdy'
+    else:
+        date_order = 'mdy' if year_length == 2 else 'dmy'
+
+    return get_chat_format(platform, date_order, year_length, clock)
+
+
+def split_messages(chat_txt, chat_format: ChatFormat) -> List[Tuple[int, int]]:
+    """Return the (start, end) byte offsets of every message in the raw UTF-8 bytes of a _chat.txt file.
+
+    chat_txt can be bytes or any other bytes-like object, like an mmap. The boundaries between messages are left out.
+    """
+    # Every message ends where a boundary starts, and the next message starts where that boundary ends
+    starts = [0]
+    ends = []
+    for boundary in chat_format.boundary_pattern.finditer(chat_txt):
+        ends.append(boundary.start())
+        starts.append(boundary.end())
+    ends.append(len(chat_txt))
+
+    return list(zip(starts, ends))
+
+
+def decode_message(chat_txt, span: Tuple[int, int]) -> str:
+    """Decode one message from the raw bytes of a _chat.txt file, given its span from split_messages().
+
+    LRM, LRE, and PDF Unicode characters are removed, and newlines are converted like opening the file in text mode would.
+    """
+    raw_message = chat_txt[span[0]:span[1]].decode('utf-8').translate(invisible_characters_table)
+
+    if '\r' in raw_message:
+        raw_message = raw_message.replace('\r\n', '\n').replace('\r', '\n')
+
+    return raw_message
+
+
+def render_viewer_page(chat_title: str, data_path: str) -> str:
+    """Return the HTML page of the virtualized viewer, from viewer_template.txt, with the chat title and the path of its data files filled in."""
+    with open('viewer_template.txt', 'r', encoding='utf-8') as f:
+        return f.read().replace('%chat_title%', chat_title).replace('%data_path%', data_path)
+
+
+def render_index_page() -> str:
+    """Return the HTML page of the chat index, from index_template.txt. See ChatManifest."""
+    with open('index_template.txt', 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def render_start_template(chat_title: str) -> str:
+    """Return the start of the HTML file, from start_template.txt, with the chat title filled in."""
+    with open('start_template.txt', 'r', encoding='utf-8') as f:
+        return f.read().replace('%chat_title%', chat_title)
+
+
+def render_end_template() -> str:
+    """Return the end of the HTML file, from end_template.txt."""
+    with open('end_template.txt', 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def render_messages(raw_messages, group_chat: bool, sender_name: str, html_file_name: str, chat_format: ChatFormat,
+                    records: list = None, attachment_index: AttachmentIndex = None, image_settings=None,
+                    video_posters: bool = False, summary: ChatSummary = None):
+    """Yield the HTML of every raw message, with a date separator before the first message of each day.
+
+    Exactly one string is yielded for every raw message, so the caller can count them. The notice that
+    messages are encrypted is rendered as an empty string.
+
+    Arguments:
+        raw_messages:
+            An iterable of raw message strings, like the ones from decode_message().
+
+        group_chat: bool:
+            A boolean to determine whether the chat is a group chat.
 
-import concurrent.futures
-import os
-import re
-import threading
-import shutil
-import zipfile
+        sender_name: str:
+            The name of the sender in the chat. Typically the user's WhatsApp alias.
 
-from datetime import datetime
-from typing import Tuple, List
-from pydub import AudioSegment
+        html_file_name: str:
+            The name of the final HTML file, which is used in the paths of attachments.
 
+        chat_format: ChatFormat:
+            The dialect of the chat, from detect_chat_format().
 
+    Keyword arguments:
+        records: list:
+            An optional list to append the record of every message to, as it's rendered. See Message.to_record().
 
-class BadFormatError(Exception):
-    """A simple exception to be thrown if the format is incorrect."""
+        attachment_index: AttachmentIndex:
+            An optional index to add every attachment to, as it's rendered. Attachments that aren't in the index's
+            export are rendered as placeholders.
 
+        image_settings: images.ImageSettings:
+            The settings that photos and stickers are recompressed with, if they are, so that they link to the
+            recompressed versions.
 
-class Message:
-    """The class for each message in a chat. Every instance is a separate message.
+        video_posters: bool:
+            Whether videos link to poster images. Only pass True if the posters will be made, like Chat does when
+            ffmpeg is installed.
 
-    Methods:
-        create_html(sender_name: str) -> str:
-            Return HTML representation of the Message object.
+        summary: ChatSummary:
+            An optional summary to add every message to, as it's rendered.
 
     """
+    date_separator = ''
 
-    html_audio_formats = {'.mp3': 'mpeg', '.ogg': 'ogg', '.wav': 'wav'}  # Dict of HTML accepted audio formats
-
-    # This is a dictionary of patterns and replacement patterns for converting WhatsApp formatting to HTML tags
-    format_dict = {re.compile(r'\b_([^_]+)_\b'): r'<em>\1</em>',
-                   re.compile(r'\*\b([^*]+)\b\*'): r'<strong>\1</strong>',
-                   re.compile(r'~\b([^~]+)\b~'): r'<del>\1</del>',
-                   re.compile(r'```\b([^`]+)\b```'): r'<code>\1</code>'}
+    for raw_message in raw_messages:
+        msg, html = _render_message(raw_message, group_chat, sender_name, html_file_name, chat_format, attachment_index,
+                                    image_settings, video_posters)
 
-    # Tuple of extensions that can be moved without being converted
-    non_conversion_extensions = ('jpg', 'png', 'webp', 'gif', 'mp4', 'mp3', 'ogg', 'wav')
+        if msg is not None:
+            if msg.date != date_separator:
+                date_separator = msg.date
+                html = _render_date_separator(date_separator) + html
 
-    # RegEx patterns
+            if records is not None:
+                records.append(msg.to_record())
 
-    full_prefix_pattern = re.compile(
-        r'\[(\d{2}/\d{2}/\d{4}, (\d{1,2}:\d{2}:\d{2} [ap]m|\d{2}:\d{2}:\d{2}))] ([^:]+): ((.|\n)+)')
-    # Groups: full prefix is 1, time is 2, name is 3, content is 4
+            if summary is not None:
+                msg.add_to_summary(summary)
 
-    group_meta_prefix_pattern = re.compile(r'\[(\d{2}/\d{2}/\d{4}, (\d{1,2}:\d{2}:\d{2} [ap]m|\d{2}:\d{2}:\d{2}))] ([^:]+)')
-    # Groups: full prefix is 1, time is 2, content is 3
+        yield html
 
-    attachment_message_pattern = re.compile(r'<attached: (\d{8}-(\w+)-\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2})(\.\w+)>$')
-    # Groups: filename without extension is 1, file type is 2, extension is 3
 
-    # Link pattern taken from urlregex.com
-    link_pattern = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*(),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
+def _render_date_separator(date: str) -> str:
+    """Return the HTML of the separator before the first message of a day."""
+    return f'<div class="date-separator">{date}</div>\n\n'
 
-    encrypted_messages_notice_pattern = re.compile(
-        r'\[(\d{2}/\d{2}/\d{4}, (\d{1,2}:\d{2}:\d{2} [ap]m|\d{2}:\d{2}:\d{2}))] ([^:]+): '
-        r'Messages and calls are end-to-end encrypted\. No one outside of this chat, not even WhatsApp, can read or listen to them\.$')
 
-    def __init__(self, original_string: str, group_chat: bool, html_file_name: str):
-        """Create a Message object.
+def _parse_message(raw_message: str, group_chat: bool, html_file_name: str, chat_format: ChatFormat,
+                   attachment_index: AttachmentIndex = None, image_settings=None,
+                   video_posters: bool = False) -> Optional[Message]:
+    """Return the Message object of one raw message, or None if it's the notice that messages are encrypted, which is skipped."""
+    if chat_format.encrypted_messages_notice_pattern.match(raw_message):
+        return None
 
-        Arguments:
-            original_string: str:
-                The original full content of the message, including all the prefix data in square brackets.
+    return Message(raw_message, group_chat, html_file_name, chat_format, attachment_index, image_settings, video_posters)
 
-            group_chat: bool:
-                A boolean representing whether the message came from a group chat.
 
-            html_file_name: str:
-                The name of the final HTML file.
+def _render_message(raw_message: str, group_chat: bool, sender_name: str, html_file_name: str, chat_format: ChatFormat,
+                    attachment_index: AttachmentIndex = None, image_settings=None,
+                    video_posters: bool = False) -> Tuple[Optional[Message], str]:
+    """Return the Message object and HTML of one raw message, without a date separator.
 
-        """
-        self._group_chat = group_chat
-        self._html_file_name = html_file_name
+    The notice that messages are encrypted is skipped, so its Message is None and its HTML is empty.
+    """
+    if (msg := _parse_message(raw_message, group_chat, html_file_name, chat_format, attachment_index, image_settings,
+                              video_posters)) is None:
+        return None, ''
 
-        # Remove LRM, LRE, and PDF Unicode characters from original_string
-        original = original_string.replace('\u200e', '').replace('\u202a', '').replace('\u202c', '')
+    return msg, msg.create_html(sender_name)
 
-        prefix_match = re.match(Message.full_prefix_pattern, original)
 
-        if prefix_match:  # If it's a normal message
-            self._name = prefix_match.group(3)
-            self._message_content = prefix_match.group(4)
+def render_viewer_rows(raw_messages, group_chat: bool, sender_name: str, html_file_name: str, chat_format: ChatFormat,
+                       records: list = None, attachment_index: AttachmentIndex = None, image_settings=None,
+                       video_posters: bool = False, summary: ChatSummary = None):
+    """Yield the row of every raw message for the virtualized viewer. See Message.to_viewer_row().
 
-            if re.match(Message.attachment_message_pattern, self._message_content):
-                self._format_attachment_message()
-            else:
-                self._clean_message_content()
-                self._format_with_html_tags()
-                self._format_links()
+    Like render_messages(), exactly one item is yielded for every raw message. It's None for the notice that
+    messages are encrypted. The arguments are the same as render_messages().
+    """
+    for raw_message in raw_messages:
+        msg = _parse_message(raw_message, group_chat, html_file_name, chat_format, attachment_index, image_settings,
+                             video_posters)
 
-                self._message_content = self._message_content.replace('\n', '<br>\n\t\t')
+        if msg is None:
+            yield None
+            continue
 
-            self._group_chat_meta = False
-        else:  # If it's a group chat meta message
-            prefix_match = re.match(Message.group_meta_prefix_pattern, original)
+        if records is not None:
+            records.append(msg.to_record())
 
-            if prefix_match is None:
-                raise BadFormatError('Failed to match normal message or group chat meta message.')
+        if summary is not None:
+            msg.add_to_summary(summary)
 
-            self._name = ''
-            self._message_content = prefix_match.group(3)
-            self._clean_message_content()
+        yield msg.to_viewer_row(sender_name)
 
-            self._group_chat_meta = True
 
-        date_raw = prefix_match.group(1)
-        time = prefix_match.group(2)
+def render_chunk(chat_txt_path: str, start: int, end: int, group_chat: bool, sender_name: str, html_file_name: str,
+                 chat_format: ChatFormat, with_records: bool = False, viewer: bool = False,
+                 attachment_index: AttachmentIndex = None, image_settings=None,
+                 video_posters: bool = False) -> Tuple[object, int, Optional[str], Optional[str], list, list, ChatSummary]:
+    """Render the messages between two byte offsets of a _chat.txt file. This is run in the parse pool.
 
-        # Use a ternary operator to get datetime object whether the message is in 12 hour or 24 hour format
-        self._datetime_obj = datetime.strptime(date_raw, '%d/%m/%Y, %I:%M:%S %p') if ' am' in time or ' pm' in time \
-            else datetime.strptime(date_raw, '%d/%m/%Y, %H:%M:%S')
+    start must be the start of a message and end must be the end of one. The chunk is rendered as if it were the
+    whole chat, so it always starts with a date separator. join_rendered_chunks() removes it again if the
+    previous chunk ended on the same day.
 
-        day = str(self._datetime_obj.day)
+    Returns:
+        A tuple of the HTML, the number of messages, the dates of the first and last messages, the records of
+        the messages if with_records is True (or an empty list if not), the references that were added to
+        attachment_index (or an empty list if it's None), and the ChatSummary of the messages. The dates are None if the chunk only has the notice that
+        messages are encrypted. If viewer is True, the HTML is a list of the rows of the messages for the
+        virtualized viewer instead, and the dates are None, because the rows have their own dates.
 
-        # Get day of the month extension
-        if day.endswith('1') and day != '11':
-            extension = 'st'
-        elif day.endswith('2') and day != '12':
-            extension = 'nd'
-        elif day.endswith('3') and day != '13':
-            extension = 'rd'
-        else:
-            extension = 'th'
+    """
+    with open(chat_txt_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as chat_txt:
+        chunk = chat_txt[start:end]
 
-        self._day = day + extension
+    spans = split_messages(chunk, chat_format)
+    summary = ChatSummary()
 
-        self.date = datetime.strftime(self._datetime_obj, f'%a {self._day} %B %Y')
-        self._time = datetime.strftime(self._datetime_obj, '%I:%M:%S %p')
+    if viewer:
+        records = [] if with_records else None
+        rows = render_viewer_rows((decode_message(chunk, span) for span in spans), group_chat, sender_name,
+                                  html_file_name, chat_format, records=records, attachment_index=attachment_index,
+                                  image_settings=image_settings, video_posters=video_posters, summary=summary)
+        rows = [row for row in rows if row is not None]
 
-        if self._time.startswith('0'):
-            self._time = self._time.replace('0', '', 1)
+        return rows, len(spans), None, None, records or [], \
+            attachment_index.references if attachment_index is not None else [], summary
 
-    def __repr__(self) -> str:
-        """Return a __repr__ of the Message instance including the name, date, name, and whether it's from a group chat. Also includes the memory location in hex."""
-        # Use hex here at end to give memory location of Message object
-        if self._group_chat_meta:
-            return f'<{self.__class__.__module__}.{self.__class__.__name__} object with date="{self.date}", ' \
-                   f'time="{self._time}", and group_chat={self._group_chat}, which is a meta message at ' \
-                   f'{hex(id(self))}>'
+    first_date = None
+    last_date = None
+    html_list = []
+    records = []
 
-        # Else
-        return f'<{self.__class__.__module__}.{self.__class__.__name__} object with name="{self._name}", ' \
-               f'date="{self.date}", time="{self._time}", and group_chat={self._group_chat} at {hex(id(self))}>'
+    # This is the same as render_messages(), but it keeps track of the first and last dates
+    for span in spans:
+        msg, html = _render_message(decode_message(chunk, span), group_chat, sender_name, html_file_name, chat_format,
+                                    attachment_index, image_settings, video_posters)
 
-    def _clean_message_content(self) -> None:
-        """Replace < and > in self._message_content to avoid rogue HTML tags."""
-        self._message_content = self._message_content.replace('<', '&lt;').replace('>', '&gt;')
+        if msg is not None:
+            if msg.date != last_date:
+                html = _render_date_separator(msg.date) + html
 
-    def _format_with_html_tags(self) -> None:
-        """Replace WhatsApp format characters with their HTML tag equivalents in self._message_content."""
-        for pattern, replacement in Message.format_dict.items():
-            self._message_content = re.sub(pattern, replacement, self._message_content)
+            if first_date is None:
+                first_date = msg.date
 
-    def _format_links(self) -> None:
-        """Find all the links in self._message_content and wrap them in <a> tags."""
-        links = re.findall(Message.link_pattern, self._message_content)
+            last_date = msg.date
 
-        for link in links:
-            # Get rid of punctuation or spaces at the end of the link
-            while re.search(r'[\s.,!?]$', link):
-                link = link[:-1]
+            if with_records:
+                records.append(msg.to_record())
 
-            formatted_link = f'<a href="{link}" target="_blank">{link}</a>'
-            self._message_content = self._message_content.replace(link, formatted_link)
+            msg.add_to_summary(summary)
 
-    def _format_attachment_message(self) -> None:
-        """Format an attachment message to properly link to the attachment with HTML tags."""
-        match = re.match(Message.attachment_message_pattern, self._message_content)
-        if match is None:
-            raise BadFormatError('Failed to match attachment message.')
+        html_list.append(html)
 
-        filename_no_ext = match.group(1)
-        file_type = match.group(2)
-        extension = match.group(3)
+    return ''.join(html_list), len(spans), first_date, last_date, records, \
+        attachment_index.references if attachment_index is not None else [], summary
 
-        filename = filename_no_ext + extension
 
-        if file_type == 'AUDIO':
-            for ext, given_format in Message.html_audio_formats.items():
-                # If it's a standard, accepted extension, use that format
-                if extension == ext:
-                    html_format = given_format
-                    break
+def join_rendered_chunks(rendered_chunks):
+    """Yield the HTML, number of messages, records, attachment references, and summary of every chunk from render_chunk(), in order.
 
-            else:  # If none of the standard HTML audio formats broke out of the for loop, it will be converted to an mp3 file, so use that format
-                html_format = 'mpeg'
-                filename = filename_no_ext + '.mp3'
+    The date separator at the start of a chunk is removed if the previous chunk ended on the same day,
+    so the joined HTML is exactly the same as rendering the whole chat in one go.
+    """
+    previous_date = None
 
-            self._message_content = f'<audio controls>\n\t\t\t<source ' \
-                                    f'src="Attachments/{self._html_file_name}/{filename}" ' \
-                                    f'type="audio/{html_format}">\n\t\t</audio>'
+    for html, message_count, first_date, last_date, records, attachments, summary in rendered_chunks:
+        if first_date is not None and first_date == previous_date:
+            html = html[len(_render_date_separator(first_date)):]
 
-        elif file_type == 'VIDEO':
-            self._message_content = f'<video controls>\n\t\t\t<source ' \
-                                    f'src="Attachments/{self._html_file_name}/{filename}">\n\t\t</video>'
+        if last_date is not None:
+            previous_date = last_date
 
-        elif (file_type == 'PHOTO') or (file_type == 'GIF' and extension == '.gif') or (file_type == 'STICKER'):
-            self._message_content = f'<img class="small" src="Attachments/{self._html_file_name}/{filename}" ' \
-                                    f'alt="IMAGE ATTACHMENT" style="max-height: 400px; max-width: 800px; display: inline-block;">'
+        yield html, message_count, records, attachments, summary
 
-        elif file_type == 'GIF' and extension != '.gif':  # Add gif as video that autoplays and loops like a proper gif
-            self._message_content = f'<video autoplay loop muted playsinline>\n\t\t\t<source ' \
-                                    f'src="Attachments/{self._html_file_name}/{filename}">\n\t\t</video>'
 
-        else:
-            self._message_content = f'UNKNOWN ATTACHMENT "{filename}"'
+def _append_line(path: str, line: str) -> None:
+    """Append one whole line to a text file, creating it if necessary, and make sure it's on the disk.
 
-    def create_html(self, sender_name: str) -> str:
-        """Return HTML representation of the Message object.
+    If the file doesn't end with a newline, the last line was cut off by a crash, so it's removed first. Only the end
+    of the file is read to find it, so this takes the same time however long the file is.
+    """
+    with os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o666), 'r+b') as f:
+        end = f.seek(0, os.SEEK_END)
 
-        Arguments:
-            sender_name: str:
-                The sender in the chat that this message is from.
+        if end > 0:
+            f.seek(end - 1)
 
-        """
-        if not self._group_chat_meta:
-            if self._name == sender_name:
-                sender_type = 'sender'
-            else:
-                sender_type = 'recipient'
+            if f.read(1) != b'\n':
+                # Read backwards in blocks until the newline before the partial line is found
+                start = end
+                while start > 0:
+                    block_start = max(0, start - 64 * 1024)
+                    f.seek(block_start)
+                    block = f.read(start - block_start)
 
-            # If this is a group chat and this isn't the sender, add the recipient's name
-            if self._group_chat and self._name != sender_name:
-                css_formatted_name = self._name.replace('\u00a0', '-')  # Replace no-break space with dash
-                recipient_name = f'<span class="recipient-name {css_formatted_name}">{self._name}</span>'
-            else:
-                recipient_name = ''
+                    if (newline := block.rfind(b'\n')) != -1:
+                        start = block_start + newline + 1
+                        break
 
-            return f'<div class="message {sender_type}">\n\t{recipient_name}\n\t<span class="message-info date">' \
-                   f'{self.date}</span>\n\t\t<p>{self._message_content}</p>\n\t<span class="message-info time">' \
-                   f'{self._time}</span>\n</div>\n\n'
+                    start = block_start
 
-        # Else
-        # If it's a meta message in a group chat
-        return f'<div class="group-chat-meta">\n\t<span class="message-info date">{self.date}</span>\n\t\t' \
-               f'<p>{self._message_content}</p>\n\t<span class="message-info time">{self._time}</span>\n</div>\n\n'
+                f.truncate(start)
+                end = start
 
+        f.seek(end)
+        f.write(line.encode('utf-8'))
+        f.flush()
+        os.fsync(f.fileno())
 
-class Chat:
-    """The class for each chat to be formatted. Every instance is a separate chat.
 
-    Methods:
-        format():
-            Fully extract the zip file and format the chat.
+def precompress_file(path: str) -> None:
+    """Write path.gz, and path.br if the brotli package is installed, next to path.
 
+    Compressed files that are newer than path are left alone, because the Library files are shared by every chat in
+    an output directory. Each compressed file is written to a temporary file first and then moved into place, so
+    a web server never sees half a file and two chats compressing the same file at once don't clash.
     """
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
 
-    attachment_file_pattern = re.compile(r'(\d{8}-(\w+)-\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2})(\.\w+)$')
-    # Groups: filename without extension is 1, file type is 2, extension is 3
+    source_mtime = os.path.getmtime(path)
+    temp_suffix = f'.{os.getpid()}.{threading.get_ident()}.tmp'
 
-    def __init__(self, input_file: str, group_chat: bool, sender_name: str, chat_title: str, html_file_name: str, output_dir: str):
-        """Create a Chat object with instance attributes equal to the arguments passed.
-
-        Arguments:
-            input_file:
-                The original zip file of the exported chat. It must have the '.zip' extension.
+    if not os.path.isfile(path + '.gz') or os.path.getmtime(path + '.gz') < source_mtime:
+        with open(path, 'rb') as source, open(path + '.gz' + temp_suffix, 'wb') as f:
+            with gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=f, mtime=int(source_mtime)) as gzip_file:
+                shutil.copyfileobj(source, gzip_file)
 
-            group_chat:
-                A boolean to determine whether the chat is a group chat.
+        os.replace(path + '.gz' + temp_suffix, path + '.gz')
 
-            sender_name:
-                The name of the sender in the chat. Typically the user's WhatsApp alias.
+    if brotli is not None and (not os.path.isfile(path + '.br') or os.path.getmtime(path + '.br') < source_mtime):
+        compressor = brotli.Compressor(quality=11)
 
-            chat_title:
-                The title of the chat. This appears in the top bar and in the browser tab. It is not the file name.
+        with open(path, 'rb') as source, open(path + '.br' + temp_suffix, 'wb') as f:
+            while chunk := source.read(1024 * 1024):
+                f.write(compressor.process(chunk))
 
-            html_file_name:
-                The intended name of the final HTML file.
+            f.write(compressor.finish())
 
-            output_dir:
-                The intended directory for the output. The HTML file, Attachments folder, and Library folder will go here.
+        os.replace(path + '.br' + temp_suffix, path + '.br')
 
-        """
-        self._input_file = input_file
-        self._group_chat = group_chat
-        self._sender_name = sender_name
-        self._chat_title = chat_title
-        self._html_file_name = html_file_name
-        self._output_dir = output_dir
 
-        # Threads to be used later
-        self._write_text_thread = threading.Thread(target=self._write_text)
-        self._move_attachment_files_thread = threading.Thread(target=self._move_attachment_files)
+# Every chat shares one pool for ffmpeg, so formatting lots of chats at once never runs too many ffmpeg processes
+_video_executor = None
+_video_executor_lock = threading.Lock()
 
-        # This is a unique temporary directory for this chat, to allow for multithreading multiple chats
-        # os.path.splitext()[0] is used to remove extensions
-        # os.path.split()[1] is used to just get the name of the zip file, not the absolute path
-        self._temp_directory = f'temp_{os.path.splitext(os.path.split(self._input_file)[1])[0]}_{self._chat_title}_' \
-                               f'{os.path.splitext(self._html_file_name)[0]}'
+# Every chat that isn't given its own governor shares one, so chats formatted at the same time share its budgets
+_resource_governor = None
+_resource_governor_lock = threading.Lock()
 
-        # Make directories if they don't exist
-        if not os.path.isdir(library_path := os.path.join(self._output_dir, 'Library')):
-            shutil.copytree('Library', library_path)
+# Every chat also shares one pool of processes for parsing very large chats in chunks
+_parse_executor = None
+_parse_executor_lock = threading.Lock()
 
-        if not os.path.isdir(attachments_path := os.path.join(self._output_dir, 'Attachments', self._html_file_name)):
-            os.makedirs(attachments_path)
+# Tuple of video extensions whose containers can be remuxed to start fast
+fast_start_extensions = ('.mp4', '.m4v', '.mov', '.3gp')
 
-    def _extract_zip(self) -> bool:
-        """Extract the zip file into a temporary directory.
 
-        Extract the object's input_file into a unique temporary directory. If the extraction fails, the method returns False and skips the file.
+def _init_parse_worker() -> None:
+    """Set up a new parse worker.
 
-        Returns:
-            True if the zip file was successfully extracted, False if not.
+    Ctrl+C is ignored, because the workers are shut down by the process that owns the pool.
+    tracemalloc is stopped if the worker was forked from a process that was profiling a chat, because otherwise
+    the worker would trace every allocation for the rest of its life, even for chats that aren't profiled.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-        """
-        try:
-            with zipfile.ZipFile(self._input_file) as zip_file:
-                zip_file.extractall(self._temp_directory)
+    if (tracemalloc := sys.modules.get('tracemalloc')) is not None and tracemalloc.is_tracing():
+        tracemalloc.stop()
 
-            return True
 
-        except OSError:  # If the zip file failed to extract
-            print(f'ERROR: Failed to extract {self._input_file}. It likely does not exist. This chat will be skipped.')
-            return False
+def get_resource_governor() -> ResourceGovernor:
+    """Return the resource governor shared by every chat that isn't given its own, creating it with the default budgets if necessary."""
+    global _resource_governor
 
-    def _write_text(self) -> None:
-        """Write the contents of temp/_chat.txt to the output directory."""
-        with open(os.path.join(self._temp_directory, '_chat.txt'), 'r', encoding='utf-8') as f:
-            # Read file and remove LRM, LRE, and PDF Unicode characters
-            chat_txt = f.read().replace('\u200e', '').replace('\u202a', '').replace('\u202c', '')
+    with _resource_governor_lock:
+        if _resource_governor is None:
+            _resource_governor = ResourceGovernor()
 
-        # Add number to the end of the filename if the file already exists
-        html_filename_with_directory_no_ext = os.path.join(self._output_dir, self._html_file_name)
-        if not os.path.isfile(html_filename_with_directory_no_ext + '.html'):
-            html_file = open(html_filename_with_directory_no_ext + '.html', 'w+', encoding='utf-8')
-        else:
-            same_name_number = 1
+        return _resource_governor
 
-            while os.path.isfile(html_filename_with_directory_no_ext + f' ({same_name_number}).html'):
-                same_name_number += 1
 
-            html_file = open(html_filename_with_directory_no_ext + f' ({same_name_number}).html', 'w+', encoding='utf-8')
+def get_parse_executor():
+    """Return the process pool shared by every chat for parsing chunks of very large chats and recompressing images, creating it if necessary."""
+    global _parse_executor
 
-        start_template = open('start_template.txt', 'r', encoding='utf-8').readlines()  # .readlines() preserves \n characters
+    with _parse_executor_lock:
+        if _parse_executor is None:
+            import concurrent.futures
+            _parse_executor = concurrent.futures.ProcessPoolExecutor(initializer=_init_parse_worker)
 
-        # Replace chat title in start template
-        for line in start_template:
-            if '%chat_title%' in line:
-                line = line.replace('%chat_title%', self._chat_title)
+        return _parse_executor
 
-            html_file.write(line)
 
-        # Use a re.sub to place LRMs between each message and then create a list by splitting by LRM
-        chat_txt = re.sub(r'\n\[(?=\d{2}/\d{2}/\d{4}, (\d{1,2}:\d{2}:\d{2} [ap]m|\d{2}:\d{2}:\d{2})])', '\u200e[', chat_txt)
-        chat_txt_list = chat_txt.split('\u200e')
+def get_video_executor():
+    """Return the thread pool shared by every chat for running ffmpeg on videos, creating it if necessary.
 
-        date_separator = ''
+    Each thread just waits for an ffmpeg process, so half the CPUs is enough to keep the machine busy without
+    starving the text and audio work.
+    """
+    global _video_executor
 
-        # === Write every message
+    with _video_executor_lock:
+        if _video_executor is None:
+            import concurrent.futures
+            _video_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, (os.cpu_count() or 2) // 2),
+                                                                    thread_name_prefix='video')
 
-        for raw_message in chat_txt_list:
-            # If it's the notice that messages are encrypted, skip it
-            if re.match(Message.encrypted_messages_notice_pattern, raw_message):
-                continue
+        return _video_executor
 
-            msg = Message(raw_message, self._group_chat, self._html_file_name)
 
-            if msg.date != date_separator:
-                date_separator = msg.date
-                html_file.write(f'<div class="date-separator">{date_separator}</div>\n\n')
+def remux_fast_start(source_path: str, destination_path: str) -> bool:
+    """Remux a video to destination_path so that its moov atom comes first and browsers can start playing it straight away.
 
-            html_file.write(msg.create_html(self._sender_name))
+    The streams are copied, not re-encoded. Returns True if the video was remuxed, and False if ffmpeg isn't installed,
+    the container doesn't support it, or ffmpeg failed, in which case nothing is written.
+    """
+    root, extension = os.path.splitext(destination_path)
 
-        end_template = open('end_template.txt', 'r', encoding='utf-8')
+    if (ffmpeg := shutil.which('ffmpeg')) is None or extension.lower() not in fast_start_extensions:
+        return False
 
-        for line in end_template:
-            html_file.write(line)
+    # ffmpeg picks the container from the extension, so the temporary file has to keep it
+    temp_path = f'{root}.tmp{extension}'
+    result = subprocess.run([ffmpeg, '-v', 'error', '-y', '-i', source_path, '-map', '0', '-c', 'copy',
+                             '-movflags', '+faststart', temp_path], stdin=subprocess.DEVNULL, capture_output=True)
 
-        html_file.close()
+    if result.returncode != 0:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
 
-        os.remove(os.path.join(self._temp_directory, '_chat.txt'))
+        return False
 
-    def _move_attachment_files(self) -> None:
-        """Move the attachment files in temp to the output directory."""
-        files = os.listdir(self._temp_directory)
-        for f in files:
-            if f != '_chat.txt':
-                try:
-                    # Get the file type and the name without an extension
-                    file_match = re.match(Chat.attachment_file_pattern, f)
-                    if file_match is None:
-                        raise BadFormatError('Failed to match format of attachment file.')
+    os.replace(temp_path, destination_path)
+    return True
 
-                    file_type = file_match.group(2)
 
-                    f_no_ext = os.path.splitext(f)[0]
+def extract_video_poster(video_path: str, poster_path: str) -> bool:
+    """Save the first frame of a video as a JPEG at poster_path.
 
-                    if file_type == 'AUDIO':
-                        # Convert audio files that can't be played in browsers with simple HTML audio tags
-                        # This is necessary because all voice messages are .opus, which must be converted
-                        if file_type not in Message.html_audio_formats.keys():
-                            # Convert old audio file into .mp3 in same directory
-                            AudioSegment.from_file(os.path.join(self._temp_directory, f)).export(
-                                os.path.join(self._temp_directory, f_no_ext) + '.mp3', format='mp3')
+    Returns True if the poster was saved, and False if ffmpeg isn't installed or failed.
+    """
+    if (ffmpeg := shutil.which('ffmpeg')) is None:
+        return False
 
-                            # Remove old audio file
-                            os.remove(os.path.join(self._temp_directory, f))
-                            # Set f to new file to make moving the new file easier
-                            f = f_no_ext + '.mp3'
-                except AttributeError:  # File is named weird and doesn't match the RegEx
-                    pass
+    temp_poster_path = poster_path + '.tmp.jpg'
+    result = subprocess.run([ffmpeg, '-v', 'error', '-y', '-i', video_path, '-frames:v', '1', '-an', '-q:v', '4',
+                             temp_poster_path], stdin=subprocess.DEVNULL, capture_output=True)
 
-                os.rename(os.path.join(self._temp_directory, f), os.path.join(self._output_dir, 'Attachments', self._html_file_name, f))
+    if result.returncode != 0:
+        if os.path.isfile(temp_poster_path):
+            os.remove(temp_poster_path)
 
-    def _start_formatting_threads(self) -> None:
-        """Start two threads to fully format the chat after it's been extracted."""
-        self._write_text_thread.start()
-        self._move_attachment_files_thread.start()
+        return False
 
-    def format(self) -> None:
-        """Fully extract the zip file and format the chat."""
-        self._extract_zip()
-        self._start_formatting_threads()
+    os.replace(temp_poster_path, poster_path)
+    return True
 
-        # Wait until directory is empty, then rmdir it
-        while len(os.listdir(self._temp_directory)) > 0:
-            pass
 
-        os.rmdir(self._temp_directory)
+def make_chat_key(input_file: str, html_file_name: str, output_dir: str) -> str:
+    """Return the key that identifies a chat in a batch journal and in progress events."""
+    return f'{os.path.abspath(input_file)} -> {os.path.join(os.path.abspath(output_dir), html_file_name)}'
 
 
-def process_chat(input_file: str, group_chat: bool, sender_name: str, chat_title: str, html_file_name: str, output_dir: str) -> None:
+def process_chat(input_file: str, group_chat: bool, sender_name: str, chat_title: str, html_file_name: str, output_dir: str,
+                 journal: BatchJournal = None, event_sink=None, event_interval: float = 0.1, precompress: bool = False,
+                 parallel_parsing: bool = True, archive: ArchiveWriter = None, exporters: list = None,
+                 profile: str = None, virtualized: bool = False, governor: ResourceGovernor = None, image_settings=None,
+                 index_page: bool = True) -> None:
     """Process one chat completely.
 
     This function also checks that all arguments are of the right type before using them. If they're not, raise TypeError.
@@ -484,6 +2972,54 @@ def process_chat(input_file: str, group_chat: bool, sender_name: str, chat_title
         output_dir: str:
             The intended directory for the output. The HTML file, Attachments folder, and Library folder will go here.
 
+    Keyword arguments:
+        journal: BatchJournal:
+            An optional journal to record the progress of the chat in, and to resume it from.
+
+        event_sink:
+            An optional thread-safe callable to report the chat's progress to. See ProgressTracker.
+
+        event_interval: float:
+            The minimum number of seconds between two progress reports for the chat.
+
+        precompress: bool:
+            If True, write .gz (and .br, if the brotli package is installed) versions of the HTML file and the
+            text files in Library next to them, for a static web server to send directly.
+
+        parallel_parsing: bool:
+            If True, a very large chat is split into chunks at message boundaries, which are parsed in parallel
+            in a process pool and then joined back together in order.
+
+        archive: ArchiveWriter:
+            An optional archive to write the HTML file, Library folder, and attachments into, instead of output_dir.
+
+        exporters: list:
+            An optional list of thread-safe exporters, like the ones in exporters.py. The records of the messages are
+            sent to them in batches, in the same pass that renders the HTML. The caller has to close them.
+
+        profile: str:
+            None to not profile the chat, or 'cprofile' or 'sampling' to profile it and write <html_file_name>.prof or
+            <html_file_name>.samples.txt and a summary in <html_file_name>.profile.txt to output_dir.
+
+        virtualized: bool:
+            If True, write the messages to chunked data files in Data/<html_file_name>, and make the HTML file a
+            viewer which only keeps the messages on the screen in the page. This is much faster to open and scroll
+            for very long chats.
+
+        governor: ResourceGovernor:
+            The governor that limits the disk space, transcodes, and memory that chats use at once. It defaults to
+            the one from get_resource_governor(), which is shared by every chat that isn't given its own.
+
+        image_settings: images.ImageSettings:
+            Optional settings to recompress photos and stickers with, like ImageSettings('webp', quality=80). They're
+            cached by their contents, and the HTML links to them instead of the originals. Pillow is needed to
+            recompress them, and without it they're copied unchanged.
+
+        index_page: bool:
+            If True, add the chat to chats.jsonl in output_dir when it's finished, and make sure index.html there
+            lists it, with its participants, number of messages, dates, and size of attachments. Only the new entry
+            is written, so it's just as fast with thousands of chats in output_dir. See ChatManifest.
+
     Raises:
         TypeError:
             If the arguments aren't all of the correct type.
@@ -499,33 +3035,140 @@ def process_chat(input_file: str, group_chat: bool, sender_name: str, chat_title
 
     # If all the arguments are of the correct type, format the chat
     if arg_types == required_types:
-        chat = Chat(input_file, group_chat, sender_name, chat_title, html_file_name, output_dir)
+        chat = Chat(input_file, group_chat, sender_name, chat_title, html_file_name, output_dir,
+                    journal=journal, event_sink=event_sink, event_interval=event_interval, precompress=precompress,
+                    parallel_parsing=parallel_parsing, archive=archive, exporters=exporters, profile=profile,
+                    virtualized=virtualized, governor=governor, image_settings=image_settings, index_page=index_page)
         chat.format()
     else:
         raise TypeError(f'Expected arg types of {printable_required_types}. Got {printable_arg_types} instead.')
 
 
-def process_list_of_chats(list_of_chats: List[Tuple[str, bool, str, str, str, str]]) -> List[Tuple[str, bool, str, str, str, str]]:
+def process_list_of_chats(list_of_chats: List[Tuple[str, bool, str, str, str, str]],
+                          journal_file: str = None, event_sink=None, event_interval: float = 0.1,
+                          precompress: bool = False, parallel_parsing: bool = True,
+                          archive_file: str = None, exporters: list = None,
+                          profile: str = None, virtualized: bool = False,
+                          governor: ResourceGovernor = None, image_settings=None,
+                          index_page: bool = True) -> List[Tuple[str, bool, str, str, str, str]]:
     """Fully format a list of tuples, where each tuple is a list of arguments to be passed to process_chat().
 
+    Keyword arguments:
+        journal_file: str:
+            An optional path to a batch journal. Every chat's progress is recorded in it, and running the same
+            batch again with the same journal skips the chats that are done and resumes the rest.
+
+        event_sink:
+            An optional thread-safe callable to report the progress of every chat to. It is called from the worker
+            threads with the key from make_chat_key() and a dictionary of progress. See ProgressTracker.
+
+        event_interval: float:
+            The minimum number of seconds between two progress reports for the same chat.
+
+        precompress: bool:
+            If True, write precompressed .gz (and .br) versions of every HTML file and Library text file.
+
+        parallel_parsing: bool:
+            If True, very large chats are parsed in chunks in a shared process pool.
+
+        archive_file: str:
+            An optional path of a zip (or .tar) archive to write every chat into, instead of their output directories.
+            It can't be used with a journal, because a half-written archive can't be resumed.
+
+        exporters: list:
+            An optional list of thread-safe exporters, like the ones in exporters.py, shared by every chat.
+            The caller has to close them.
+
+        profile: str:
+            None to not profile anything, or 'cprofile' or 'sampling' to profile every chat separately and write
+            the profiles next to their HTML files. See process_chat().
+
+        virtualized: bool:
+            If True, write every chat for the virtualized viewer. See process_chat().
+
+        governor: ResourceGovernor:
+            The governor that holds chats back until there's room for them, instead of letting them fill the disk or
+            the memory. Pass one to set its budgets, and call its report() afterwards to see its limits and how
+            much of them was used. It defaults to the one from get_resource_governor().
+
+        image_settings: images.ImageSettings:
+            Optional settings to recompress the photos and stickers of every chat with. See process_chat().
+
+        index_page: bool:
+            If True, add every chat to the index.html of its output directory. See process_chat().
+
+    Raises:
+        ValueError:
+            If both journal_file and archive_file are given, or journal_file already exists and one of the
+            exporters isn't resumable. See exporters.py.
+
     Returns:
         rejected_chats:
-            A list of all the argument tuples that couldn't be processed properly. It is an empty list if no tuples failed.
+            A list of all the argument tuples that couldn't be processed properly, including the chats whose zip
+            files couldn't be extracted, or that failed for any other reason. It is an empty list if no tuples failed.
 
     """
+    import concurrent.futures
+
+    if journal_file is not None and archive_file is not None:
+        raise ValueError('A batch written into an archive can\'t be resumed from a journal.')
+
+    if journal_file is not None and os.path.isfile(journal_file) and \
+            (exporter_names := [type(exporter).__name__ for exporter in exporters or [] if not exporter.resumable]):
+        raise ValueError(f'A batch can\'t be resumed with exporters that aren\'t resumable: {", ".join(exporter_names)}. '
+                         f'Start a new journal, or use an SQLiteExporter.')
+
     rejected_chats = []
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        # Create a dictionary with the Future object of the method call as the key and the list of args as the value
-        # This allows us to return the args of the rejected chats
-        futures = {executor.submit(process_chat, *chat_data): chat_data for chat_data in list_of_chats}
+    journal = BatchJournal(journal_file) if journal_file is not None else None
 
-        for future in concurrent.futures.as_completed(futures):
+    if journal is not None:
+        unfinished_chats = []
+
+        for chat_data in list_of_chats:
             try:
-                future.result()
-            except TypeError:
-                # Get the value from the dictionary using the Future object as the key
-                # This is the arguments passed
-                rejected_chats.append(futures[future])
+                key = make_chat_key(chat_data[0], chat_data[4], chat_data[5])
+            except TypeError:  # process_chat() will reject this chat
+                unfinished_chats.append(chat_data)
+                continue
+
+            stage = journal.get_entry(key)['stage']
+
+            if stage != 'done':
+                journal.update(key, stage=stage)
+                unfinished_chats.append(chat_data)
+            else:
+                ProgressTracker(event_sink, key, chat_data[3]).set_stage(stage)
+
+        list_of_chats = unfinished_chats
+
+    archive = ArchiveWriter(archive_file) if archive_file is not None else None
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            # Create a dictionary with the Future object of the method call as the key and the list of args as the value
+            # This allows us to return the args of the rejected chats
+            futures = {executor.submit(process_chat, *chat_data, journal=journal, event_sink=event_sink,
+                                       event_interval=event_interval, precompress=precompress,
+                                       parallel_parsing=parallel_parsing, archive=archive, exporters=exporters,
+                                       profile=profile, virtualized=virtualized, governor=governor,
+                                       image_settings=image_settings, index_page=index_page): chat_data
+                       for chat_data in list_of_chats}
+
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    # One chat going wrong, for whatever reason, mustn't stop the others or lose the rejected chats
+                    if not isinstance(e, (TypeError, BadFormatError)):
+                        print(f'ERROR: Failed to format {futures[future][0]}: {type(e).__name__}: {e}')
+
+                    # Get the value from the dictionary using the Future object as the key
+                    # This is the arguments passed
+                    rejected_chats.append(futures[future])
+    finally:
+        # Even if something went wrong, finish the archive, so that the chats that are done can still be read
+        if archive is not None:
+            archive.close()
 
     return rejected_chats
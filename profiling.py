@@ -0,0 +1,389 @@
+# WhatsApp-Formatter is a program that takes exported WhatsApp chats and
+# formats them into more readable HTML files, with embedded attachments.
+#
+# Copyright (C) 2020 Doctor Dalek <https://github.com/DoctorDalek1963>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""This module has the profiler that is used when a chat is formatted with the profile option.
+
+library only imports this module when profiling is turned on, so it costs nothing otherwise.
+
+Classes:
+    Sampler:
+        A thread which samples the call stacks of some other threads at a fixed interval.
+
+    ChatProfiler:
+        The profiler of one chat. It profiles every thread and worker process that works on the chat.
+
+Functions:
+    profile_call(mode: str, profile_file: str, function, *args, **kwargs):
+        Call function in a worker process, profile it, and write the results to profile_file.
+
+"""
+
+import collections
+import cProfile
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+# tracemalloc is shared by every chat in the process, so it's only stopped when the last chat using it is finished
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+_tracemalloc_started = False
+
+
+def _start_tracemalloc() -> None:
+    """Start tracemalloc for one more chat, unless it's already running."""
+    global _tracemalloc_users, _tracemalloc_started
+
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracemalloc_started = True
+
+        _tracemalloc_users += 1
+
+
+def _stop_tracemalloc() -> None:
+    """Stop tracemalloc when the last chat using it is finished, if it was started by _start_tracemalloc()."""
+    global _tracemalloc_users, _tracemalloc_started
+
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+
+        # Don't stop tracemalloc if something else started it
+        if _tracemalloc_users == 0 and _tracemalloc_started:
+            tracemalloc.stop()
+            _tracemalloc_started = False
+
+
+class Sampler(threading.Thread):
+    """A thread which samples the call stacks of some other threads at a fixed interval.
+
+    Every sample is a stack of 'file:function' frames from the outermost to the innermost,
+    which are counted like the collapsed stacks used to make flame graphs.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        """Create a Sampler which samples every interval seconds once it's started."""
+        super().__init__(daemon=True)
+
+        self.interval = interval
+        self.counts = collections.Counter()
+
+        self._thread_ids = set()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def add_thread(self, thread_id: int) -> None:
+        """Start sampling the thread with the given ident."""
+        with self._lock:
+            self._thread_ids.add(thread_id)
+
+    def remove_thread(self, thread_id: int) -> None:
+        """Stop sampling the thread with the given ident."""
+        with self._lock:
+            self._thread_ids.discard(thread_id)
+
+    def run(self) -> None:
+        """Sample the stacks until stop() is called."""
+        while not self._stop_event.wait(self.interval):
+            frames = sys._current_frames()
+
+            with self._lock:
+                thread_ids = list(self._thread_ids)
+
+            for thread_id in thread_ids:
+                if (frame := frames.get(thread_id)) is None:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    stack.append(f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}')
+                    frame = frame.f_back
+
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def stop(self) -> None:
+        """Stop sampling and wait for the thread to finish."""
+        self._stop_event.set()
+        self.join()
+
+
+def _write_collapsed_stacks(counts: collections.Counter, path: str) -> None:
+    """Write the counts of some stacks to path as collapsed stacks, one 'stack count' line each, most common first."""
+    with open(path, 'w', encoding='utf-8') as f:
+        for stack, count in counts.most_common():
+            f.write(f'{stack} {count}\n')
+
+
+def _read_collapsed_stacks(path: str) -> collections.Counter:
+    """Read a file written by _write_collapsed_stacks() back into a Counter of stacks."""
+    counts = collections.Counter()
+
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            counts[stack] += int(count)
+
+    return counts
+
+
+def profile_call(mode: str, profile_file: str, function, *args, **kwargs):
+    """Call function in a worker process, profile it, and write the results to profile_file.
+
+    ChatProfiler.stop() merges profile_file into the chat's profile. The function must be picklable.
+
+    Returns:
+        The result of calling function with args and kwargs.
+
+    """
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+
+        try:
+            return profiler.runcall(function, *args, **kwargs)
+        finally:
+            profiler.dump_stats(profile_file)
+
+    sampler = Sampler()
+    sampler.add_thread(threading.get_ident())
+    sampler.start()
+
+    try:
+        return function(*args, **kwargs)
+    finally:
+        sampler.stop()
+        _write_collapsed_stacks(sampler.counts, profile_file)
+
+
+class ChatProfiler:
+    """The profiler of one chat. It profiles every thread and worker process that works on the chat.
+
+    The profile and a summary are written next to the output when the profiler is stopped:
+        <output_prefix>.prof:
+            The cProfile statistics of every thread and worker process, in the format read by pstats (cprofile mode only).
+
+        <output_prefix>.samples.txt:
+            The sampled call stacks of every thread and worker process, collapsed for flame graphs (sampling mode only).
+
+        <output_prefix>.profile.txt:
+            A readable summary, with the slowest functions and the tracemalloc peak and top allocation sites.
+
+    tracemalloc is shared by the whole process, so the memory numbers include any other chats formatted at the same
+    time, and they don't include the parse worker processes.
+
+    Methods:
+        start() -> None:
+            Start the profiler. This must be called before anything else.
+
+        run(target, *args, **kwargs):
+            Call target in the current thread and profile it.
+
+        new_worker_file() -> str:
+            Return a new path for profile_call() in a worker process to write its results to.
+
+        take_snapshot(label: str) -> None:
+            Record the top allocation sites at this point, with the given label.
+
+        stop() -> None:
+            Stop the profiler and write the profile and summary.
+
+    """
+
+    modes = ('cprofile', 'sampling')
+
+    def __init__(self, mode: str, output_prefix: str, title: str):
+        """Create a ChatProfiler object.
+
+        Arguments:
+            mode: str:
+                'cprofile' to trace every function call, or 'sampling' to sample the call stacks, which is less
+                precise but slows the chat down much less.
+
+            output_prefix: str:
+                The path of the profile files without their extensions.
+
+            title: str:
+                The title to put at the top of the summary.
+
+        Raises:
+            ValueError:
+                If mode isn't one of ChatProfiler.modes.
+
+        """
+        if mode not in ChatProfiler.modes:
+            raise ValueError(f'Expected a profile mode in {ChatProfiler.modes}. Got {mode!r} instead.')
+
+        self.mode = mode
+        self._output_prefix = output_prefix
+        self._title = title
+
+        self._lock = threading.Lock()
+        self._profiles = []
+        self._unprofiled_threads = 0
+        self._snapshots = []
+        self._sampler = None
+        self._worker_directory = None
+        self._worker_file_count = 0
+        self._start_time = None
+
+    def start(self) -> None:
+        """Start the profiler. This must be called before anything else."""
+        self._start_time = time.perf_counter()
+        self._worker_directory = tempfile.mkdtemp(prefix='profile_')
+
+        _start_tracemalloc()
+
+        if self.mode == 'sampling':
+            self._sampler = Sampler()
+            self._sampler.start()
+
+    def run(self, target, *args, **kwargs):
+        """Call target in the current thread and profile it.
+
+        Returns:
+            The result of calling target with args and kwargs.
+
+        """
+        if self.mode == 'sampling':
+            thread_id = threading.get_ident()
+            self._sampler.add_thread(thread_id)
+
+            try:
+                return target(*args, **kwargs)
+            finally:
+                self._sampler.remove_thread(thread_id)
+
+        profiler = cProfile.Profile()
+
+        try:
+            profiler.enable()
+        except ValueError:  # Newer versions of Python only allow one cProfile profiler to be enabled at once
+            with self._lock:
+                self._unprofiled_threads += 1
+
+            return target(*args, **kwargs)
+
+        try:
+            return target(*args, **kwargs)
+        finally:
+            profiler.disable()
+
+            with self._lock:
+                self._profiles.append(profiler)
+
+    def new_worker_file(self) -> str:
+        """Return a new path for profile_call() in a worker process to write its results to."""
+        with self._lock:
+            self._worker_file_count += 1
+            return os.path.join(self._worker_directory, f'{self._worker_file_count}.prof')
+
+    def take_snapshot(self, label: str) -> None:
+        """Record the top allocation sites at this point, with the given label."""
+        statistics = tracemalloc.take_snapshot().statistics('lineno')
+        traced_memory = sum(statistic.size for statistic in statistics)
+
+        with self._lock:
+            self._snapshots.append((label, traced_memory, statistics[:10]))
+
+    def stop(self) -> None:
+        """Stop the profiler and write the profile and summary."""
+        wall_time = time.perf_counter() - self._start_time
+
+        if self._sampler is not None:
+            self._sampler.stop()
+
+        self.take_snapshot('finished')
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        _stop_tracemalloc()
+
+        worker_files = [os.path.join(self._worker_directory, f) for f in sorted(os.listdir(self._worker_directory))]
+
+        os.makedirs(os.path.dirname(self._output_prefix) or '.', exist_ok=True)
+
+        with open(self._output_prefix + '.profile.txt', 'w', encoding='utf-8') as summary:
+            summary.write(f'Profile of {self._title}\n')
+            summary.write(f'Mode: {self.mode}\n')
+            summary.write(f'Wall time: {wall_time:.3f} s\n')
+            summary.write(f'Worker processes profiled: {len(worker_files)} chunks\n')
+            summary.write(f'Peak traced memory: {peak_memory / 1024 / 1024:.1f} MiB\n')
+
+            for label, traced_memory, statistics in self._snapshots:
+                summary.write(f'\nTop allocation sites when {label} ({traced_memory / 1024 / 1024:.1f} MiB traced):\n')
+                for statistic in statistics:
+                    summary.write(f'    {statistic}\n')
+
+            summary.write('\n')
+
+            if self.mode == 'cprofile':
+                self._write_cprofile(summary, worker_files)
+            else:
+                self._write_samples(summary, worker_files)
+
+        shutil.rmtree(self._worker_directory, ignore_errors=True)
+
+    def _write_cprofile(self, summary, worker_files: list) -> None:
+        """Merge the cProfile statistics, dump them to the .prof file, and write the slowest functions to the summary."""
+        if self._unprofiled_threads:
+            summary.write(f'{self._unprofiled_threads} threads couldn\'t be profiled, '
+                          f'because another cProfile profiler was already enabled\n\n')
+
+        sources = self._profiles + worker_files
+        if not sources:
+            summary.write('Nothing was profiled\n')
+            return
+
+        stats = pstats.Stats(*sources, stream=summary)
+        stats.dump_stats(self._output_prefix + '.prof')
+        stats.sort_stats('cumulative').print_stats(40)
+
+    def _write_samples(self, summary, worker_files: list) -> None:
+        """Merge the sampled stacks, write them to the .samples.txt file, and write the hottest functions to the summary."""
+        counts = self._sampler.counts
+        for worker_file in worker_files:
+            counts.update(_read_collapsed_stacks(worker_file))
+
+        _write_collapsed_stacks(counts, self._output_prefix + '.samples.txt')
+
+        total = sum(counts.values())
+        summary.write(f'Samples: {total} (every {self._sampler.interval * 1000:.0f} ms in each thread)\n')
+
+        if not total:
+            return
+
+        self_counts = collections.Counter()
+        cumulative_counts = collections.Counter()
+        for stack, count in counts.items():
+            frames = stack.split(';')
+            self_counts[frames[-1]] += count
+
+            # Recursive functions are only counted once per sample
+            for frame in set(frames):
+                cumulative_counts[frame] += count
+
+        summary.write('\nMost samples in the function itself:\n')
+        for frame, count in self_counts.most_common(40):
+            summary.write(f'    {count / total:7.1%}  {frame}\n')
+
+        summary.write('\nMost samples in the function or anything it called:\n')
+        for frame, count in cumulative_counts.most_common(40):
+            summary.write(f'    {count / total:7.1%}  {frame}\n')
@@ -0,0 +1,616 @@
+#!/usr/bin/env python
+
+# WhatsApp-Formatter is a program that takes exported WhatsApp chats and
+# formats them into more readable HTML files, with embedded attachments.
+#
+# Copyright (C) 2020 Doctor Dalek <https://github.com/DoctorDalek1963>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""This module serves exported chats over HTTP, straight from their zip files, rendering each chat when it's first opened.
+
+Every zip file in the chats directory is a chat. The page for chat.zip is at /chat/, and its attachments are streamed
+straight out of the zip file, with support for HTTP range requests. Rendered pages are kept in an in-memory LRU cache,
+and in an on-disk cache so that they survive a restart. The on-disk cache keeps a limited number of pages too, and forgets
+the least recently used ones first, because every change to a chat or its settings renders a new page.
+
+A chat's settings come from the defaults given to the server, and can be overridden by a JSON sidecar file next to
+the zip file, so chat.zip can have a chat.json like {"group_chat": true, "sender_name": "Alice", "chat_title": "Friends"}.
+
+Classes:
+    PageCache:
+        A thread-safe in-memory LRU cache of rendered pages, backed by an on-disk cache.
+
+    ChatServer:
+        The HTTP server. It subclasses http.server.ThreadingHTTPServer.
+
+    ChatRequestHandler:
+        The request handler for ChatServer.
+
+Functions:
+    load_chat_settings(zip_path: str, defaults: dict) -> dict:
+        Return the settings of the chat in zip_path, from its sidecar JSON file and the defaults.
+
+    parse_range_header(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+        Return the first and last byte of a single HTTP byte range.
+
+    run_server(chats_dir: str, host: str = '127.0.0.1', port: int = 8000, **keyword_arguments) -> None:
+        Serve the chats in chats_dir until interrupted.
+
+"""
+
+import argparse
+import hashlib
+import html
+import json
+import mimetypes
+import os
+import re
+import threading
+import traceback
+import zipfile
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Tuple
+from urllib.parse import quote, unquote, urlsplit
+
+from library import AttachmentIndex, BadFormatError, Message, decode_message, detect_chat_format, render_end_template, \
+    render_messages, render_start_template, split_messages
+
+
+def load_chat_settings(zip_path: str, defaults: dict) -> dict:
+    """Return the settings of the chat in zip_path, from its sidecar JSON file and the defaults.
+
+    The settings are group_chat, sender_name, chat_title, and html_file_name. The title and HTML file name default to
+    the name of the zip file without its extension.
+    """
+    name = os.path.splitext(os.path.basename(zip_path))[0]
+    settings = {'group_chat': False, 'sender_name': '', 'chat_title': name, 'html_file_name': name}
+    settings.update(defaults)
+
+    if os.path.isfile(sidecar_path := os.path.splitext(zip_path)[0] + '.json'):
+        with open(sidecar_path, 'r', encoding='utf-8') as f:
+            settings.update(json.load(f))
+
+    return settings
+
+
+def parse_range_header(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Return the first and last byte of a single HTTP byte range, like 'bytes=0-499', 'bytes=500-', or 'bytes=-500'.
+
+    It returns None for a header that it doesn't support, like one with several ranges, which RFC 9110 lets a server
+    ignore by sending the whole file.
+
+    Raises:
+        ValueError:
+            If the range can't be satisfied.
+
+    """
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', range_header.strip())
+    if match is None or match.group(1) == match.group(2) == '':
+        return None
+
+    if match.group(1) == '':  # A suffix range, which is the last n bytes
+        first = max(size - int(match.group(2)), 0)
+        last = size - 1
+    else:
+        first = int(match.group(1))
+        last = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+
+    if first > last or first >= size:
+        raise ValueError(f'Unsatisfiable range {range_header!r} for {size} bytes')
+
+    return first, last
+
+
+class PageCache:
+    """A thread-safe in-memory LRU cache of rendered pages, backed by an on-disk cache.
+
+    Methods:
+        get(key: str) -> Optional[bytes]:
+            Return the cached page for key, or None if it isn't in either cache.
+
+        put(key: str, page: bytes) -> None:
+            Add a page to both caches.
+
+    """
+
+    def __init__(self, cache_dir: str, max_pages: int = 16, max_disk_pages: int = 256):
+        """Create a PageCache object.
+
+        Arguments:
+            cache_dir: str:
+                The directory for the on-disk cache. It's created if it doesn't exist.
+
+        Keyword arguments:
+            max_pages: int:
+                The maximum number of pages to keep in memory.
+
+            max_disk_pages: int:
+                The maximum number of pages to keep in the on-disk cache.
+
+        """
+        self._cache_dir = cache_dir
+        self._max_pages = max_pages
+        self._max_disk_pages = max_disk_pages
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _disk_path(self, key: str) -> str:
+        """Return the path of the page for key in the on-disk cache."""
+        return os.path.join(self._cache_dir, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.html')
+
+    def _remember(self, key: str, page: bytes) -> None:
+        """Add a page to the in-memory cache, evicting the least recently used pages. Must be called with self._lock held."""
+        self._pages[key] = page
+        self._pages.move_to_end(key)
+
+        while len(self._pages) > self._max_pages:
+            self._pages.popitem(last=False)
+
+    def _prune_disk(self) -> None:
+        """Remove the least recently used pages from the on-disk cache until there are at most self._max_disk_pages."""
+        pages = []
+
+        for entry in os.scandir(self._cache_dir):
+            if entry.name.endswith('.html'):
+                try:
+                    pages.append((entry.stat().st_mtime_ns, entry.path))
+                except FileNotFoundError:  # Another thread has just removed it
+                    pass
+
+        if len(pages) <= self._max_disk_pages:
+            return
+
+        pages.sort()
+
+        for _, path in pages[:len(pages) - self._max_disk_pages]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Return the cached page for key, or None if it isn't in either cache."""
+        with self._lock:
+            if key in self._pages:
+                self._pages.move_to_end(key)
+                return self._pages[key]
+
+        disk_path = self._disk_path(key)
+
+        try:
+            with open(disk_path, 'rb') as f:
+                page = f.read()
+
+            # The modification time is when it was last used, so it's pruned last
+            os.utime(disk_path)
+        except FileNotFoundError:
+            return None
+
+        with self._lock:
+            self._remember(key, page)
+
+        return page
+
+    def put(self, key: str, page: bytes) -> None:
+        """Add a page to the in-memory cache and atomically write it to the on-disk cache."""
+        with self._lock:
+            self._remember(key, page)
+
+        disk_path = self._disk_path(key)
+        temp_path = f'{disk_path}.{threading.get_ident()}.tmp'
+
+        with open(temp_path, 'wb') as f:
+            f.write(page)
+
+        os.replace(temp_path, disk_path)
+        self._prune_disk()
+
+
+class ChatServer(ThreadingHTTPServer):
+    """The HTTP server, which renders and serves the chats in a directory of exported zip files.
+
+    Methods:
+        list_chats() -> list:
+            Return the names of all the chats, which are the zip files without their extension.
+
+        get_page(name: str) -> bytes:
+            Return the rendered page of a chat, rendering it if it isn't cached.
+
+        open_attachment(name: str, filename: str):
+            Return an open binary file and its size for an attachment of a chat.
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, server_address: Tuple[str, int], chats_dir: str, cache_dir: str, defaults: dict, max_pages: int = 16,
+                 max_disk_pages: int = 256):
+        """Create a ChatServer object and bind it to server_address.
+
+        Arguments:
+            server_address: Tuple[str, int]:
+                The host and port to listen on. Use port 0 to pick any free port.
+
+            chats_dir: str:
+                The directory of exported zip files to serve.
+
+            cache_dir: str:
+                The directory for the on-disk page cache and for converted audio.
+
+            defaults: dict:
+                The default settings for every chat. See load_chat_settings().
+
+        Keyword arguments:
+            max_pages: int:
+                The maximum number of rendered pages to keep in memory.
+
+            max_disk_pages: int:
+                The maximum number of rendered pages to keep in the on-disk cache.
+
+        """
+        super().__init__(server_address, ChatRequestHandler)
+
+        self.chats_dir = chats_dir
+        self._cache_dir = cache_dir
+        self._defaults = defaults
+        self._page_cache = PageCache(os.path.join(cache_dir, 'pages'), max_pages=max_pages, max_disk_pages=max_disk_pages)
+
+        # Each chat is only rendered once at a time, however many requests come in for it. A chat's lock is
+        # only kept while a request is using it, as [lock, number of requests], so there's never more than one per request
+        self._render_locks = {}
+        self._render_locks_lock = threading.Lock()
+
+    @contextmanager
+    def _render_lock(self, name: str):
+        """Hold the render lock of a chat, and forget it when no other request is waiting for it."""
+        with self._render_locks_lock:
+            entry = self._render_locks.setdefault(name, [threading.Lock(), 0])
+            entry[1] += 1
+
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._render_locks_lock:
+                entry[1] -= 1
+
+                if entry[1] == 0:
+                    del self._render_locks[name]
+
+    def _zip_path(self, name: str) -> str:
+        """Return the path of the zip file of a chat.
+
+        Raises:
+            FileNotFoundError:
+                If there's no such chat.
+
+        """
+        zip_path = os.path.join(self.chats_dir, name + '.zip')
+
+        if '/' in name or '\\' in name or name.startswith('.') or not os.path.isfile(zip_path):
+            raise FileNotFoundError(f'No chat called {name!r}')
+
+        return zip_path
+
+    def list_chats(self) -> list:
+        """Return the names of all the chats, which are the zip files without their extension."""
+        return sorted(os.path.splitext(f)[0] for f in os.listdir(self.chats_dir) if f.endswith('.zip'))
+
+    def get_page(self, name: str) -> bytes:
+        """Return the rendered page of a chat, rendering it if it isn't cached.
+
+        The cache key includes the size and modification time of the zip file and the chat's settings,
+        so changing either of them renders the chat again.
+
+        Raises:
+            FileNotFoundError:
+                If there's no such chat, or its zip file has no _chat.txt.
+
+            BadFormatError:
+                If the chat doesn't match any known format.
+
+            zipfile.BadZipFile:
+                If the zip file is corrupt.
+
+        """
+        zip_path = self._zip_path(name)
+        settings = load_chat_settings(zip_path, self._defaults)
+        stat = os.stat(zip_path)
+        key = f'{os.path.abspath(zip_path)}|{stat.st_size}|{stat.st_mtime_ns}|{json.dumps(settings, sort_keys=True)}'
+
+        if (page := self._page_cache.get(key)) is not None:
+            return page
+
+        with self._render_lock(name):
+            # Another thread might have rendered it while this one was waiting
+            if (page := self._page_cache.get(key)) is not None:
+                return page
+
+            with zipfile.ZipFile(zip_path) as zip_file:
+                try:
+                    chat_txt = zip_file.read('_chat.txt')
+                except KeyError:
+                    raise FileNotFoundError(f'No _chat.txt in {name!r}') from None
+
+                # Attachments that aren't in the zip file are rendered as placeholders instead of broken links
+                attachment_index = AttachmentIndex(os.path.basename(info.filename) for info in zip_file.infolist()
+                                                   if not info.is_dir())
+
+            chat_format = detect_chat_format(chat_txt)
+            raw_messages = (decode_message(chat_txt, span) for span in split_messages(chat_txt, chat_format))
+
+            page = ''.join([
+                render_start_template(settings['chat_title']),
+                *render_messages(raw_messages, settings['group_chat'], settings['sender_name'], settings['html_file_name'],
+                                 chat_format, attachment_index=attachment_index),
+                render_end_template()
+            ]).encode('utf-8')
+
+            self._page_cache.put(key, page)
+
+        return page
+
+    def _convert_audio(self, zip_file: zipfile.ZipFile, info: zipfile.ZipInfo, mp3_path: str) -> None:
+        """Convert an audio attachment that browsers can't play into an mp3 file at mp3_path."""
+        # pydub looks for ffmpeg when it's imported, so only import it when a chat has audio
+        from pydub import AudioSegment
+
+        temp_path = f'{mp3_path}.{threading.get_ident()}.tmp'
+
+        try:
+            with zip_file.open(info) as source:
+                AudioSegment.from_file(source, format=os.path.splitext(info.filename)[1][1:]).export(temp_path, format='mp3')
+        except BaseException:
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
+
+            raise
+
+        os.replace(temp_path, mp3_path)
+
+    def open_attachment(self, name: str, filename: str):
+        """Return an open binary file and its size for an attachment of a chat.
+
+        The file is streamed straight out of the zip file. Audio that was rendered as an mp3 file but is stored in
+        another format is converted once and kept in the cache directory.
+
+        Raises:
+            FileNotFoundError:
+                If there's no such chat or attachment.
+
+        """
+        zip_path = self._zip_path(name)
+        zip_file = zipfile.ZipFile(zip_path)
+
+        try:
+            members = {os.path.basename(info.filename): info for info in zip_file.infolist() if not info.is_dir()}
+
+            if filename in members and filename != '_chat.txt':
+                info = members[filename]
+                attachment = zip_file.open(info)
+
+                # The open attachment keeps the underlying file open until it's closed itself
+                zip_file.close()
+                return attachment, info.file_size
+
+            # The page links to an mp3 file for audio in formats that browsers can't play
+            filename_no_ext, extension = os.path.splitext(filename)
+            if extension == '.mp3':
+                for member_name, info in members.items():
+                    if os.path.splitext(member_name)[0] == filename_no_ext and \
+                            os.path.splitext(member_name)[1] not in Message.html_audio_formats:
+                        audio_dir = os.path.join(self._cache_dir, 'audio', hashlib.sha256(zip_path.encode('utf-8')).hexdigest())
+                        os.makedirs(audio_dir, exist_ok=True)
+
+                        if not os.path.isfile(mp3_path := os.path.join(audio_dir, filename)):
+                            self._convert_audio(zip_file, info, mp3_path)
+
+                        zip_file.close()
+                        return open(mp3_path, 'rb'), os.path.getsize(mp3_path)
+        except BaseException:
+            zip_file.close()
+            raise
+
+        zip_file.close()
+        raise FileNotFoundError(f'No attachment called {filename!r} in {name!r}')
+
+
+class ChatRequestHandler(BaseHTTPRequestHandler):
+    """The request handler for ChatServer.
+
+    URLs:
+        /:
+            An index of all the chats.
+
+        /<chat>/:
+            The rendered page of a chat.
+
+        /<chat>/Library/<file>:
+            A file from the Library folder.
+
+        /<chat>/Attachments/<html_file_name>/<file>:
+            An attachment, streamed from the chat's zip file. Range requests are supported.
+
+    """
+
+    server: ChatServer
+
+    def do_GET(self) -> None:
+        """Handle a GET request."""
+        self._handle(send_body=True)
+
+    def do_HEAD(self) -> None:
+        """Handle a HEAD request."""
+        self._handle(send_body=False)
+
+    def _handle(self, send_body: bool) -> None:
+        """Route a request to the right handler, and send 404 if there's nothing there, or 500 if it fails."""
+        parts = [unquote(part) for part in urlsplit(self.path).path.split('/')[1:]]
+
+        try:
+            if parts == ['']:
+                self._send_index(send_body)
+            elif len(parts) == 1:
+                self.send_response(HTTPStatus.MOVED_PERMANENTLY)
+                self.send_header('Location', f'/{quote(parts[0])}/')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            elif len(parts) == 2 and parts[1] in ('', 'index.html'):
+                self._send_bytes(self.server.get_page(parts[0]), 'text/html; charset=utf-8', send_body)
+            elif len(parts) == 3 and parts[1] == 'Library' and re.fullmatch(r'[\w-][\w.-]*', parts[2]):
+                path = os.path.join('Library', parts[2])
+                self._send_file(open(path, 'rb'), os.path.getsize(path), parts[2], send_body)
+            elif len(parts) == 4 and parts[1] == 'Attachments':
+                attachment, size = self.server.open_attachment(parts[0], parts[3])
+                self._send_file(attachment, size, parts[3], send_body)
+            else:
+                raise FileNotFoundError(self.path)
+
+        except FileNotFoundError:
+            self.send_error(HTTPStatus.NOT_FOUND)
+
+        except ConnectionError:  # The client went away, so there's no one to send an error to
+            pass
+
+        except (BadFormatError, zipfile.BadZipFile) as error:
+            self.log_error('Couldn\'t read the chat for %s: %s', self.path, error)
+            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, explain=f'The chat couldn\'t be read: {error}')
+
+        except Exception:
+            self.log_error('Error while handling %s:\n%s', self.path, traceback.format_exc())
+            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR)
+
+    def _send_bytes(self, body: bytes, content_type: str, send_body: bool) -> None:
+        """Send a whole response body."""
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if send_body:
+            self.wfile.write(body)
+
+    def _send_index(self, send_body: bool) -> None:
+        """Send an index page with a link to every chat."""
+        links = ''.join(f'\t<li><a href="{quote(name)}/">{html.escape(name)}</a></li>\n' for name in self.server.list_chats())
+        body = f'<!DOCTYPE html>\n<html>\n<head>\n\t<title>WhatsApp</title>\n</head>\n<body>\n<ul>\n{links}</ul>\n</body>\n</html>\n'
+        self._send_bytes(body.encode('utf-8'), 'text/html; charset=utf-8', send_body)
+
+    def _send_file(self, file, size: int, filename: str, send_body: bool) -> None:
+        """Send an open binary file, or just the byte range asked for in the Range header, and then close it."""
+        with file:
+            content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            first, last = 0, size - 1
+
+            byte_range = None
+
+            if (range_header := self.headers.get('Range')) is not None:
+                try:
+                    byte_range = parse_range_header(range_header, size)
+                except ValueError:
+                    self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                    self.send_header('Content-Range', f'bytes */{size}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+            if byte_range is not None:
+                first, last = byte_range
+                self.send_response(HTTPStatus.PARTIAL_CONTENT)
+                self.send_header('Content-Range', f'bytes {first}-{last}/{size}')
+            else:
+                self.send_response(HTTPStatus.OK)
+
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(last - first + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+
+            if not send_body:
+                return
+
+            file.seek(first)
+            remaining = last - first + 1
+
+            while remaining > 0 and (chunk := file.read(min(remaining, 64 * 1024))):
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+
+def run_server(chats_dir: str, host: str = '127.0.0.1', port: int = 8000, cache_dir: str = None,
+               sender_name: str = '', group_chat: bool = False, max_pages: int = 16, max_disk_pages: int = 256) -> None:
+    """Serve the chats in chats_dir until interrupted.
+
+    Arguments:
+        chats_dir: str:
+            The directory of exported zip files to serve.
+
+    Keyword arguments:
+        host: str:
+            The host to listen on. By default, only this machine can connect.
+
+        port: int:
+            The port to listen on.
+
+        cache_dir: str:
+            The directory for the on-disk cache. It defaults to .cache in chats_dir.
+
+        sender_name: str:
+            The default name of the sender, for chats without a sidecar JSON file.
+
+        group_chat: bool:
+            Whether chats without a sidecar JSON file are group chats.
+
+        max_pages: int:
+            The maximum number of rendered pages to keep in memory.
+
+        max_disk_pages: int:
+            The maximum number of rendered pages to keep in the on-disk cache.
+
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(chats_dir, '.cache')
+
+    with ChatServer((host, port), chats_dir, cache_dir, {'sender_name': sender_name, 'group_chat': group_chat},
+                    max_pages=max_pages, max_disk_pages=max_disk_pages) as server:
+        print(f'Serving the chats in {chats_dir} at http://{host}:{server.server_address[1]}/')
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve exported WhatsApp chats straight from their zip files.')
+    parser.add_argument('chats_dir', help='the directory of exported zip files')
+    parser.add_argument('--host', default='127.0.0.1', help='the host to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8000, help='the port to listen on (default: 8000)')
+    parser.add_argument('--cache-dir', help='the directory for the on-disk cache (default: CHATS_DIR/.cache)')
+    parser.add_argument('--sender-name', default='', help='the default sender name (your WhatsApp alias)')
+    parser.add_argument('--group-chat', action='store_true', help='treat chats without a sidecar file as group chats')
+    parser.add_argument('--max-pages', type=int, default=16, help='the number of rendered pages to keep in memory (default: 16)')
+    parser.add_argument('--max-disk-pages', type=int, default=256,
+                        help='the number of rendered pages to keep in the on-disk cache (default: 256)')
+    args = parser.parse_args()
+
+    run_server(args.chats_dir, args.host, args.port, args.cache_dir, args.sender_name, args.group_chat, args.max_pages,
+               args.max_disk_pages)
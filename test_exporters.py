@@ -0,0 +1,158 @@
+# WhatsApp-Formatter is a program that takes exported WhatsApp chats and
+# formats them into more readable HTML files, with embedded attachments.
+#
+# Copyright (C) 2020 Doctor Dalek <https://github.com/DoctorDalek1963>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""This module tests the exporters in exporters.py. Run it with python -m unittest or pytest.
+
+Classes:
+    JSONLinesExporterTest:
+        Check the file that JSONLinesExporter writes.
+
+    SQLiteExporterTest:
+        Check the database that SQLiteExporter writes.
+
+Functions:
+    make_record(number: int, **changes) -> dict:
+        Return a record of a text message, like the ones from Message.to_record().
+
+"""
+
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from exporters import JSONLinesExporter, SQLiteExporter
+from library import process_list_of_chats
+
+
+def make_record(number: int, **changes) -> dict:
+    """Return a record of a text message, like the ones from Message.to_record(), with any keys in changes replaced."""
+    record = {'sender': 'Alice', 'timestamp': f'2020-11-02T21:{number:02}:00', 'kind': 'text',
+              'raw_text': f'Message {number} \u00e9', 'formatted_text': f'Message {number} \u00e9',
+              'attachment_path': None, 'attachment_type': None}
+    record.update(changes)
+    return record
+
+
+class JSONLinesExporterTest(unittest.TestCase):
+    """Check the file that JSONLinesExporter writes."""
+
+    def setUp(self) -> None:
+        """Make a temporary directory for the file."""
+        self.directory = tempfile.mkdtemp()
+        self.output_file = os.path.join(self.directory, 'messages.jsonl')
+
+    def tearDown(self) -> None:
+        """Remove the temporary directory."""
+        shutil.rmtree(self.directory)
+
+    def test_records_written(self) -> None:
+        """Every record is one line of JSON with its chat, in the order that the batches were written."""
+        exporter = JSONLinesExporter(self.output_file)
+        exporter.start_chat('a')
+        exporter.write_messages('a', 'First', [make_record(0), make_record(1)])
+        exporter.write_messages('b', 'Second', [make_record(2, kind='attachment', attachment_path='Attachments/b/photo.jpg',
+                                                            attachment_type='PHOTO')])
+        exporter.close()
+
+        with open(self.output_file, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+
+        self.assertEqual([json.loads(line) for line in lines],
+                         [{'chat_key': 'a', 'chat_title': 'First', **make_record(0)},
+                          {'chat_key': 'a', 'chat_title': 'First', **make_record(1)},
+                          {'chat_key': 'b', 'chat_title': 'Second', **make_record(2, kind='attachment', attachment_type='PHOTO',
+                                                                                  attachment_path='Attachments/b/photo.jpg')}])
+
+        # Text isn't escaped, so the file stays readable
+        self.assertIn('Message 0 \u00e9', lines[0])
+
+    def test_not_resumable(self) -> None:
+        """A batch can't be resumed from an existing journal with an exporter that can't take lines back out."""
+        journal_file = os.path.join(self.directory, 'journal.json')
+        with open(journal_file, 'w') as f:
+            f.write('{}')
+
+        exporter = JSONLinesExporter(self.output_file)
+
+        try:
+            with self.assertRaisesRegex(ValueError, 'JSONLinesExporter'):
+                process_list_of_chats([], journal_file=journal_file, exporters=[exporter], index_page=False)
+        finally:
+            exporter.close()
+
+
+class SQLiteExporterTest(unittest.TestCase):
+    """Check the database that SQLiteExporter writes."""
+
+    def setUp(self) -> None:
+        """Make a temporary directory for the database."""
+        self.directory = tempfile.mkdtemp()
+        self.database_file = os.path.join(self.directory, 'messages.db')
+
+    def tearDown(self) -> None:
+        """Remove the temporary directory."""
+        shutil.rmtree(self.directory)
+
+    def test_chat_key_index_made_with_table(self) -> None:
+        """Starting a chat deletes its rows with the chat_key index, which exists before the exporter is closed."""
+        exporter = SQLiteExporter(self.database_file)
+
+        try:
+            connection = sqlite3.connect(self.database_file)
+            plan = connection.execute('EXPLAIN QUERY PLAN DELETE FROM messages WHERE chat_key = ?', ('a',)).fetchall()
+            connection.close()
+
+            self.assertIn('messages_chat_key', ' '.join(str(row[-1]) for row in plan))
+        finally:
+            exporter.close()
+
+    def test_restarted_chat_replaces_its_rows(self) -> None:
+        """A chat that starts again replaces its own rows, and the rows of other chats and earlier runs are kept."""
+        exporter = SQLiteExporter(self.database_file)
+        exporter.start_chat('a')
+        exporter.write_messages('a', 'First', [make_record(0), make_record(1)])
+        exporter.close()
+
+        # The next run is resumed, and chat a was interrupted, so it starts again
+        exporter = SQLiteExporter(self.database_file)
+        exporter.start_chat('b')
+        exporter.write_messages('b', 'Second', [make_record(2, sender=None, kind='meta')])
+        exporter.start_chat('a')
+        exporter.write_messages('a', 'First', [make_record(0), make_record(1)])
+        exporter.close()
+
+        connection = sqlite3.connect(self.database_file)
+
+        try:
+            rows = connection.execute('SELECT chat_key, chat_title, sender, timestamp, kind, raw_text FROM messages '
+                                      'ORDER BY chat_key, timestamp').fetchall()
+            indexes = {row[0] for row in connection.execute('SELECT name FROM sqlite_master WHERE type = \'index\'')}
+        finally:
+            connection.close()
+
+        self.assertEqual(rows, [('a', 'First', 'Alice', '2020-11-02T21:00:00', 'text', 'Message 0 \u00e9'),
+                                ('a', 'First', 'Alice', '2020-11-02T21:01:00', 'text', 'Message 1 \u00e9'),
+                                ('b', 'Second', None, '2020-11-02T21:02:00', 'meta', 'Message 2 \u00e9')])
+        self.assertLessEqual({'messages_chat_key', 'messages_sender', 'messages_timestamp'}, indexes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+# WhatsApp-Formatter is a program that takes exported WhatsApp chats and
+# formats them into more readable HTML files, with embedded attachments.
+#
+# Copyright (C) 2020 Doctor Dalek <https://github.com/DoctorDalek1963>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""This module tests recompressing images with images.py. Run it with python -m unittest or pytest.
+
+The tests are skipped if Pillow isn't installed, except the one that checks that it's needed.
+
+Classes:
+    ImageSettingsTest:
+        Check the settings that images are recompressed with.
+
+    OptimiseImageTest:
+        Check the images that optimise_image() writes.
+
+"""
+
+import importlib.util
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+from images import ImageSettings, optimise_image
+
+has_pillow = importlib.util.find_spec('PIL') is not None
+
+
+class ImageSettingsTest(unittest.TestCase):
+    """Check the settings that images are recompressed with."""
+
+    def test_pillow_is_needed(self) -> None:
+        """ImageSettings refuses to be made without Pillow, because the HTML would link to images that are never made."""
+        with unittest.mock.patch('importlib.util.find_spec', return_value=None):
+            with self.assertRaises(ImportError):
+                ImageSettings()
+
+    @unittest.skipUnless(has_pillow, 'Pillow is needed to recompress images')
+    def test_output_filename(self) -> None:
+        """Photos are always recompressed, and stickers only to WebP."""
+        self.assertEqual(ImageSettings('webp').get_output_filename('photo.jpg', 'PHOTO'), 'photo.webp')
+        self.assertEqual(ImageSettings('jpeg').get_output_filename('photo.png', 'PHOTO'), 'photo.jpg')
+        self.assertEqual(ImageSettings('webp').get_output_filename('sticker.webp', 'STICKER'), 'sticker.webp')
+        self.assertIsNone(ImageSettings('jpeg').get_output_filename('sticker.webp', 'STICKER'))
+        self.assertIsNone(ImageSettings('webp').get_output_filename('video.mp4', 'VIDEO'))
+
+
+@unittest.skipUnless(has_pillow, 'Pillow is needed to recompress images')
+class OptimiseImageTest(unittest.TestCase):
+    """Check the images that optimise_image() writes."""
+
+    def setUp(self) -> None:
+        """Make a temporary directory for the images and the cache."""
+        self.directory = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.directory, 'cache')
+
+    def tearDown(self) -> None:
+        """Remove the temporary directory."""
+        shutil.rmtree(self.directory)
+
+    def _save_image(self, name: str, size: tuple, **kwargs) -> str:
+        """Save an image with a gradient in it, and return its path."""
+        from PIL import Image
+
+        image = Image.linear_gradient('L').resize(size).convert('RGB')
+        path = os.path.join(self.directory, name)
+        image.save(path, **kwargs)
+        return path
+
+    def test_recompress_and_scale_down(self) -> None:
+        """A big JPEG photo is scaled down and recompressed to WebP, and the second time it's copied from the cache."""
+        from PIL import Image
+
+        source_path = self._save_image('photo.jpg', (3000, 1500), quality=100)
+        settings = ImageSettings('webp', max_size=1000, cache_dir=self.cache_dir)
+
+        for name in ('first.webp', 'second.webp'):
+            destination_path = os.path.join(self.directory, name)
+            self.assertTrue(optimise_image(source_path, destination_path, settings))
+
+            with Image.open(destination_path) as image:
+                self.assertEqual(image.format, 'WEBP')
+                self.assertEqual(image.size, (1000, 500))
+
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+    def test_animated_image_keeps_its_frames(self) -> None:
+        """An animated image recompressed to WebP keeps all of its frames."""
+        from PIL import Image
+
+        frames = [Image.new('RGB', (32, 32), colour) for colour in ('red', 'green', 'blue')]
+        source_path = os.path.join(self.directory, 'animated.png')
+        frames[0].save(source_path, save_all=True, append_images=frames[1:], duration=100, loop=0)
+
+        destination_path = os.path.join(self.directory, 'animated.webp')
+        self.assertTrue(optimise_image(source_path, destination_path, ImageSettings(cache_dir=self.cache_dir)))
+
+        with Image.open(destination_path) as image:
+            self.assertEqual(image.format, 'WEBP')
+            self.assertEqual(image.n_frames, 3)
+
+    def test_unreadable_image(self) -> None:
+        """An image that can't be read isn't written under a name for a different format."""
+        source_path = os.path.join(self.directory, 'broken.jpg')
+        with open(source_path, 'wb') as f:
+            f.write(b'not really a photo')
+
+        destination_path = os.path.join(self.directory, 'broken.webp')
+
+        self.assertFalse(optimise_image(source_path, destination_path, ImageSettings(cache_dir=self.cache_dir)))
+        self.assertFalse(os.path.exists(destination_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,673 @@
+# WhatsApp-Formatter is a program that takes exported WhatsApp chats and
+# formats them into more readable HTML files, with embedded attachments.
+#
+# Copyright (C) 2020 Doctor Dalek <https://github.com/DoctorDalek1963>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""This module tests formatting whole chats with library.py, using small chats that it generates. Run it with python -m unittest or pytest.
+
+Classes:
+    PoliteResourceGovernor:
+        A ResourceGovernor that lets the other threads go first after anything is given back.
+
+    ChatTestCase:
+        The base class of the tests, which makes a temporary directory to put chats and their output in.
+
+    ChatFormatTest:
+        Check that chats are parsed with the right format.
+
+    BatchTest:
+        Check that a batch carries on past chats that fail, and that it can be resumed from its journal.
+
+    ParallelParsingTest:
+        Check that chats parsed in chunks in the parse pool come out the same as chats parsed in one go.
+
+    ArchiveTest:
+        Check the archives that chats are written into.
+
+    ImageTest:
+        Check the photos of chats that are formatted with image_settings.
+
+    ChatManifestTest:
+        Check the manifest of formatted chats that index.html lists.
+
+    ResourceGovernorTest:
+        Check the budgets of the resource governor, and that chats finish with tiny budgets.
+
+Functions:
+    make_chat_zip(path: str, lines: list, attachments: dict = None) -> None:
+        Write an exported chat with the given lines of _chat.txt and attachments to a zip file.
+
+    make_photo(seed: int) -> bytes:
+        Return a small JPEG of random pixels. This needs Pillow.
+
+    make_simple_chat(path: str) -> None:
+        Write a short iOS chat with a photo to a zip file.
+
+"""
+
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import random
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+import warnings
+import zipfile
+
+import library
+from exporters import JSONLinesExporter
+from library import BadFormatError, BatchJournal, ChatManifest, ResourceGovernor, get_chat_format, make_chat_key
+
+# The chats read the templates and the Library folder from the working directory
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+has_pillow = importlib.util.find_spec('PIL') is not None
+
+first_photo = '00000001-PHOTO-2020-11-02-21-49-51.jpg'
+second_photo = '00000002-PHOTO-2020-11-03-08-00-00.jpg'
+
+
+def make_chat_zip(path: str, lines: list, attachments: dict = None) -> None:
+    """Write an exported chat with the given lines of _chat.txt and attachments to a zip file.
+
+    attachments is a dictionary of filenames and their contents.
+    """
+    with zipfile.ZipFile(path, 'w') as zip_file:
+        zip_file.writestr('_chat.txt', ''.join(line + '\n' for line in lines))
+
+        for filename, data in (attachments or {}).items():
+            zip_file.writestr(filename, data)
+
+
+def make_photo(seed: int) -> bytes:
+    """Return a small JPEG of random pixels. This needs Pillow."""
+    from PIL import Image
+
+    generator = random.Random(seed)
+    image = Image.frombytes('RGB', (64, 64), bytes(generator.randrange(256) for _ in range(64 * 64 * 3)))
+
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=95)
+    return buffer.getvalue()
+
+
+def make_simple_chat(path: str) -> None:
+    """Write a short iOS chat with a photo to a zip file."""
+    make_chat_zip(path, ['[02/11/2020, 21:47:19] Alice: Hello',
+                         '[02/11/2020, 21:48:03] Bob: Hi, *how* are you?',
+                         '[02/11/2020, 21:49:51] Bob: \u200e<attached: 00000010-PHOTO-2020-11-02-21-49-51.jpg>',
+                         '[03/11/2020, 08:00:00] Alice: Good morning'],
+                  {'00000010-PHOTO-2020-11-02-21-49-51.jpg': b'not really a photo'})
+
+
+class PoliteResourceGovernor(ResourceGovernor):
+    """A ResourceGovernor that lets the other threads go first after anything is given back.
+
+    This makes the worst interleavings of the threads of a chat happen every time, instead of only now and then.
+    """
+
+    def release(self, **amounts) -> None:
+        """Give back amounts that were taken, and wait a moment for other threads to take them."""
+        super().release(**amounts)
+        time.sleep(0.01)
+
+
+class ChatTestCase(unittest.TestCase):
+    """The base class of the tests, which makes a temporary directory to put chats and their output in."""
+
+    def setUp(self) -> None:
+        """Make the temporary directory and go to the repository, where the templates are."""
+        self._old_cwd = os.getcwd()
+        os.chdir(repo_dir)
+
+        self.directory = tempfile.mkdtemp()
+        self.output_dir = os.path.join(self.directory, 'output')
+
+    def tearDown(self) -> None:
+        """Remove the temporary directory."""
+        shutil.rmtree(self.directory)
+        os.chdir(self._old_cwd)
+
+    def format_chats(self, list_of_chats: list, timeout: float = 120, **kwargs) -> list:
+        """Run process_list_of_chats() in a thread and return the rejected chats, failing if it takes longer than timeout."""
+        result = []
+        thread = threading.Thread(target=lambda: result.append(library.process_list_of_chats(list_of_chats, **kwargs)),
+                                  daemon=True)
+        thread.start()
+        thread.join(timeout)
+
+        self.assertFalse(thread.is_alive(), 'The chats never finished')
+        self.assertEqual(len(result), 1, 'process_list_of_chats() raised an exception')
+        return result[0]
+
+
+class ChatFormatTest(ChatTestCase):
+    """Check that chats are parsed with the right format."""
+
+    def test_impossible_timestamp(self) -> None:
+        """A timestamp that matches the format but isn't a real date and time is a BadFormatError that names the line."""
+        chat_format = get_chat_format('ios', 'dmy', 4, '24h')
+
+        with self.assertRaisesRegex(BadFormatError, 'real date and time'):
+            chat_format.parse_timestamp('02/11/2020, 21:47:60')
+
+        with self.assertRaisesRegex(BadFormatError, 'Alice: Too late'):
+            library.Message('[31/02/2020, 21:47:19] Alice: Too late', False, 'Chat', chat_format)
+
+    def test_invisible_characters_removed(self) -> None:
+        """The invisible characters are removed once when a chat is decoded, or by a Message without a format."""
+        chat_txt = f'[02/11/2020, 21:47:19] \u202aAlice\u202c: \u200e<attached: {first_photo}>\r\n'.encode('utf-8')
+        chat_format = library.detect_chat_format(chat_txt)
+        spans = library.split_messages(chat_txt, chat_format)
+
+        self.assertEqual(len(spans), 1)
+        self.assertEqual(library.decode_message(chat_txt, spans[0]),
+                         f'[02/11/2020, 21:47:19] Alice: <attached: {first_photo}>\n')
+
+        # Without a format, the message can't have been decoded with its chat
+        message = library.Message(chat_txt.decode('utf-8').rstrip(), False, 'Chat', None)
+        self.assertEqual(message.to_record()['attachment_type'], 'PHOTO')
+        self.assertEqual(message.to_record()['sender'], 'Alice')
+
+    def _parse_chat(self, lines: list) -> tuple:
+        """Detect the format of a _chat.txt with the given lines, and return it with the records of its messages."""
+        chat_txt = ''.join(line + '\n' for line in lines).encode('utf-8')
+        chat_format = library.detect_chat_format(chat_txt)
+
+        records = [library.Message(library.decode_message(chat_txt, span), False, 'Chat', chat_format).to_record()
+                   for span in library.split_messages(chat_txt, chat_format)]
+        return chat_format, records
+
+    def test_detect_ios(self) -> None:
+        """An iOS chat has its timestamps in brackets with seconds, and a message can go over several lines."""
+        chat_format, records = self._parse_chat(['[02/11/2020, 21:47:19] Alice: Hello',
+                                                 '[13/11/2020, 08:00:05] Bob: Two',
+                                                 'lines',
+                                                 f'[13/11/2020, 08:01:00] Bob: \u200e<attached: {first_photo}>'])
+
+        self.assertEqual(chat_format.name, 'ios-dmy-yyyy-24h')
+        self.assertEqual([record['timestamp'] for record in records],
+                         ['2020-11-02T21:47:19', '2020-11-13T08:00:05', '2020-11-13T08:01:00'])
+        self.assertEqual(records[1]['raw_text'], 'Two\nlines')
+        self.assertEqual(records[2]['attachment_type'], 'PHOTO')
+
+    def test_detect_android(self) -> None:
+        """An Android chat has a dash after its timestamps, without seconds, and its own names for attachments."""
+        chat_format, records = self._parse_chat(['02/11/2020, 21:47 - Alice: Hello',
+                                                 '13/11/2020, 08:00 - Bob: IMG-20201113-WA0000.jpg (file attached)'])
+
+        self.assertEqual(chat_format.name, 'android-dmy-yyyy-24h')
+        self.assertEqual([record['timestamp'] for record in records], ['2020-11-02T21:47:00', '2020-11-13T08:00:00'])
+        self.assertEqual([record['sender'] for record in records], ['Alice', 'Bob'])
+        self.assertEqual(records[1]['attachment_type'], 'PHOTO')
+
+    def test_detect_us(self) -> None:
+        """A US chat has the month first, a 2 digit year, and a 12 hour clock, sometimes with a narrow no-break space."""
+        chat_format, records = self._parse_chat(['11/2/20, 9:47 PM - Alice: Hello', '11/13/20, 12:05 AM - Bob: Hi'])
+
+        self.assertEqual(chat_format.name, 'android-mdy-yy-12h')
+        self.assertEqual([record['timestamp'] for record in records], ['2020-11-02T21:47:00', '2020-11-13T00:05:00'])
+
+        chat_format, records = self._parse_chat(['[11/2/20, 9:47:19\u202fPM] Alice: Hello'])
+
+        self.assertEqual(chat_format.name, 'ios-mdy-yy-12h')
+        self.assertEqual(records[0]['timestamp'], '2020-11-02T21:47:19')
+
+    def test_undetectable_format(self) -> None:
+        """A chat without a single message prefix is a BadFormatError."""
+        with self.assertRaises(BadFormatError):
+            library.detect_chat_format(b'This line has no date or sender\n')
+
+    def test_chat_with_impossible_timestamp_is_rejected(self) -> None:
+        """A chat with a timestamp that isn't a real date and time is rejected."""
+        zip_path = os.path.join(self.directory, 'Chat.zip')
+        make_chat_zip(zip_path, ['[02/11/2020, 21:47:19] Alice: Hello', '[02/11/2020, 21:47:60] Bob: Hi'])
+        chat = (zip_path, False, 'Alice', 'Chat', 'Chat', self.output_dir)
+
+        self.assertEqual(self.format_chats([chat], index_page=False), [chat])
+
+
+class BatchTest(ChatTestCase):
+    """Check that a batch carries on past chats that fail, and that it can be resumed from its journal."""
+
+    def test_failed_chats_are_rejected(self) -> None:
+        """Chats that can't be extracted or written are rejected, and the rest of the batch is still formatted."""
+        good_zip = os.path.join(self.directory, 'Good.zip')
+        make_simple_chat(good_zip)
+
+        corrupt_zip = os.path.join(self.directory, 'Corrupt.zip')
+        with open(corrupt_zip, 'wb') as f:
+            f.write(b'This is not a zip file')
+
+        # The output directory can't be made, because there's a file in the way
+        blocked_dir = os.path.join(self.directory, 'blocked')
+        with open(blocked_dir, 'w') as f:
+            f.write('in the way')
+
+        bad_chats = [(os.path.join(self.directory, 'Nothing.zip'), False, 'Alice', 'Nothing', 'Nothing', self.output_dir),
+                     (corrupt_zip, False, 'Alice', 'Corrupt', 'Corrupt', self.output_dir),
+                     (good_zip, False, 'Alice', 'Blocked', 'Blocked', os.path.join(blocked_dir, 'output'))]
+        good_chat = (good_zip, False, 'Alice', 'Good', 'Good', self.output_dir)
+
+        rejected_chats = self.format_chats(bad_chats + [good_chat], index_page=False)
+
+        self.assertCountEqual(rejected_chats, bad_chats)
+        self.assertTrue(os.path.isfile(os.path.join(self.output_dir, 'Good.html')))
+
+    def test_failed_text_pass_reports_no_skipped_attachments(self) -> None:
+        """If the text pass fails, the attachments that it never got to aren't reported as unreferenced."""
+        zip_path = os.path.join(self.directory, 'Chat.zip')
+        make_chat_zip(zip_path, [f'[02/11/2020, 21:47:19] Alice: \u200e<attached: {first_photo}>',
+                                 '[02/11/2020, 21:47:60] Bob: This timestamp is impossible',
+                                 f'[03/11/2020, 08:00:00] Bob: \u200e<attached: {second_photo}>'],
+                      {first_photo: b'first', second_photo: b'second'})
+        chat = (zip_path, False, 'Alice', 'Chat', 'Chat', self.output_dir)
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertEqual(self.format_chats([chat], index_page=False), [chat])
+
+        self.assertNotIn('aren\'t referred to', output.getvalue())
+
+    def test_resume_from_journal(self) -> None:
+        """A chat that failed part of the way through is finished by running the batch again with the same journal."""
+        zip_path = os.path.join(self.directory, 'Chat.zip')
+        make_simple_chat(zip_path)
+
+        chat = (zip_path, False, 'Alice', 'Chat', 'Chat', self.output_dir)
+        journal_file = os.path.join(self.directory, 'journal.json')
+        key = make_chat_key(zip_path, 'Chat', self.output_dir)
+
+        original_move = library.Chat._move_attachment_files
+
+        def fail(_):
+            raise OSError('The disk is full')
+
+        library.Chat._move_attachment_files = fail
+        try:
+            self.assertEqual(self.format_chats([chat], journal_file=journal_file, index_page=False), [chat])
+        finally:
+            library.Chat._move_attachment_files = original_move
+
+        self.assertEqual(BatchJournal(journal_file).get_entry(key)['stage'], 'text_written')
+
+        self.assertEqual(self.format_chats([chat], journal_file=journal_file, index_page=False), [])
+        self.assertEqual(BatchJournal(journal_file).get_entry(key)['stage'], 'done')
+
+        with open(os.path.join(self.output_dir, 'Chat.html'), encoding='utf-8') as f:
+            resumed_html = f.read()
+
+        self.assertTrue(os.path.isfile(os.path.join(self.output_dir, 'Attachments', 'Chat',
+                                                    '00000010-PHOTO-2020-11-02-21-49-51.jpg')))
+
+        # A finished chat isn't formatted again
+        os.remove(os.path.join(self.output_dir, 'Chat.html'))
+        self.assertEqual(self.format_chats([chat], journal_file=journal_file, index_page=False), [])
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, 'Chat.html')))
+
+        # The resumed chat is the same as one formatted in one go
+        fresh_dir = os.path.join(self.directory, 'fresh')
+        self.format_chats([(zip_path, False, 'Alice', 'Chat', 'Chat', fresh_dir)], index_page=False)
+
+        with open(os.path.join(fresh_dir, 'Chat.html'), encoding='utf-8') as f:
+            self.assertEqual(resumed_html, f.read())
+
+
+class ParallelParsingTest(ChatTestCase):
+    """Check that chats parsed in chunks in the parse pool come out the same as chats parsed in one go."""
+
+    def _format(self, zip_path: str, name: str, parallel_parsing: bool) -> tuple:
+        """Format a group chat into its own output directory, and return its HTML and the records that it exported.
+
+        The chat keys are left out of the records, because they include the output directory.
+        """
+        output_dir = os.path.join(self.directory, name)
+        jsonl_file = os.path.join(self.directory, f'{name}.jsonl')
+        exporter = JSONLinesExporter(jsonl_file)
+
+        try:
+            rejected_chats = self.format_chats([(zip_path, True, 'Alice', 'Chat', 'Chat', output_dir)],
+                                               parallel_parsing=parallel_parsing, exporters=[exporter], index_page=False)
+        finally:
+            exporter.close()
+
+        self.assertEqual(rejected_chats, [])
+
+        with open(os.path.join(output_dir, 'Chat.html'), 'rb') as f:
+            html = f.read()
+
+        with open(jsonl_file, encoding='utf-8') as f:
+            records = [json.loads(line) for line in f]
+
+        for record in records:
+            del record['chat_key']
+
+        return html, records
+
+    def test_chunks_joined_byte_for_byte(self) -> None:
+        """Small chunks that split days, multi-line messages, and attachments between them are joined into the same page."""
+        lines = ['[01/11/2020, 09:00:00] Alice: Messages and calls are end-to-end encrypted. No one outside of this chat, '
+                 'not even WhatsApp, can read or listen to them.',
+                 '[01/11/2020, 09:00:01] Alice created group "Chat"']
+
+        for i in range(400):
+            day = 1 + i // 50
+            lines.append(f'[{day:02}/11/2020, {10 + i % 12:02}:{i % 60:02}:00] {"Alice" if i % 3 else "Bob"}: '
+                         f'Message {i} with _some_ *formatting* and a link to https://example.com/{i}')
+
+            if i % 7 == 0:
+                lines.append(f'which goes on to line {i} and \u00e9mojis \U0001f600')
+
+            if i % 97 == 0:
+                lines.append(f'[{day:02}/11/2020, 23:00:00] Bob: \u200e<attached: {i:08}-PHOTO-2020-11-{day:02}-23-00-00.jpg>')
+
+        # Only some of the photos are in the zip file, so the others are rendered as missing
+        zip_path = os.path.join(self.directory, 'Chat.zip')
+        make_chat_zip(zip_path, lines, {f'{i:08}-PHOTO-2020-11-{1 + i // 50:02}-23-00-00.jpg': b'not really a photo'
+                                        for i in range(0, 400, 194)})
+
+        serial_html, serial_records = self._format(zip_path, 'serial', parallel_parsing=False)
+
+        old_threshold, old_chunk_size = library.Chat.parallel_parsing_threshold, library.Chat.parse_chunk_size
+        library.Chat.parallel_parsing_threshold = 0
+        library.Chat.parse_chunk_size = 1024
+
+        try:
+            # The chat is split into dozens of chunks
+            self.assertGreater(sum(len(line) for line in lines), 30 * library.Chat.parse_chunk_size)
+            parallel_html, parallel_records = self._format(zip_path, 'parallel', parallel_parsing=True)
+        finally:
+            library.Chat.parallel_parsing_threshold, library.Chat.parse_chunk_size = old_threshold, old_chunk_size
+
+        self.assertEqual(parallel_html, serial_html)
+        self.assertEqual(parallel_records, serial_records)
+
+
+class ArchiveTest(ChatTestCase):
+    """Check the archives that chats are written into."""
+
+    def _check_archive(self, names: list, read) -> None:
+        """Check an archive of the chats in test_zip_archive() and test_tar_archive(), given its names and a function to read an entry."""
+        self.assertEqual(len(names), len(set(names)))
+        self.assertIn('Library/style.css', names)
+
+        # Whichever chat is second to start gets a number, and each page links to its own attachments
+        titles = []
+
+        for folder in ('Chat', 'Chat (1)'):
+            html = read(f'{folder}.html')
+            title = 'first' if '<title>first - WhatsApp</title>' in html else 'second'
+            own_photo, other_photo = (first_photo, second_photo) if title == 'first' else (second_photo, first_photo)
+            titles.append(title)
+
+            self.assertIn(f'Attachments/{folder}/{own_photo}', html)
+            self.assertNotIn(other_photo, html)
+            self.assertEqual(read(f'Attachments/{folder}/{own_photo}'), own_photo)
+
+        self.assertCountEqual(titles, ['first', 'second'])
+
+    def _format_two_chats_called_chat(self, archive_file: str) -> None:
+        """Format two different chats with the same html_file_name into archive_file, failing on any warning."""
+        chats = []
+
+        for name, photo in (('first', first_photo), ('second', second_photo)):
+            zip_path = os.path.join(self.directory, f'{name}.zip')
+            # Each photo's contents are its own name, to tell them apart
+            make_chat_zip(zip_path, [f'[02/11/2020, 21:47:19] Alice: \u200e<attached: {photo}>'], {photo: photo.encode()})
+            chats.append((zip_path, False, 'Alice', name, 'Chat', self.output_dir))
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')  # zipfile warns about duplicate names
+            self.assertEqual(self.format_chats(chats, archive_file=archive_file), [])
+
+    def test_zip_archive(self) -> None:
+        """Chats with the same name get their own pages and attachments in a zip archive."""
+        archive_file = os.path.join(self.directory, 'chats.zip')
+        self._format_two_chats_called_chat(archive_file)
+
+        with zipfile.ZipFile(archive_file) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self._check_archive(zip_file.namelist(), lambda name: zip_file.read(name).decode('utf-8'))
+
+    def test_tar_archive(self) -> None:
+        """Chats with the same name get their own pages and attachments in a tar archive."""
+        archive_file = os.path.join(self.directory, 'chats.tar')
+        self._format_two_chats_called_chat(archive_file)
+
+        with tarfile.open(archive_file) as tar_file:
+            self._check_archive(tar_file.getnames(), lambda name: tar_file.extractfile(name).read().decode('utf-8'))
+
+    def test_archive_finished_when_batch_stops(self) -> None:
+        """An exception that stops the whole batch still leaves a readable archive."""
+        class Stop(BaseException):
+            pass
+
+        def event_sink(_, progress):
+            if progress['stage'] == 'done':
+                raise Stop
+
+        zip_path = os.path.join(self.directory, 'Chat.zip')
+        make_simple_chat(zip_path)
+        archive_file = os.path.join(self.directory, 'chats.zip')
+
+        # The traceback is kept until the archive has been checked, because it keeps the ArchiveWriter alive, and a
+        # ZipFile that's garbage collected finishes itself
+        try:
+            library.process_list_of_chats([(zip_path, False, 'Alice', 'Chat', 'Chat', self.output_dir)],
+                                          archive_file=archive_file, event_sink=event_sink)
+        except Stop as e:
+            stop = e
+        else:
+            self.fail('The batch didn\'t stop')
+
+        self.assertIsNotNone(stop.__traceback__)
+
+        with zipfile.ZipFile(archive_file) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertIn('Chat.html', zip_file.namelist())
+
+
+@unittest.skipUnless(has_pillow, 'Pillow is needed to recompress images')
+class ImageTest(ChatTestCase):
+    """Check the photos of chats that are formatted with image_settings."""
+
+    def test_photos_recompressed(self) -> None:
+        """Photos are recompressed and linked under their new names, and one that can't be read keeps its own name."""
+        import images
+
+        zip_path = os.path.join(self.directory, 'Chat.zip')
+        make_chat_zip(zip_path, [f'[02/11/2020, 21:47:19] Alice: \u200e<attached: {first_photo}>',
+                                 f'[03/11/2020, 08:00:00] Bob: \u200e<attached: {second_photo}>'],
+                      {first_photo: make_photo(1), second_photo: b'not really a photo'})
+
+        rejected_chats = self.format_chats([(zip_path, False, 'Alice', 'Chat', 'Chat', self.output_dir)], index_page=False,
+                                           image_settings=images.ImageSettings(cache_dir=os.path.join(self.directory, 'cache')))
+        self.assertEqual(rejected_chats, [])
+
+        first_webp = first_photo.replace('.jpg', '.webp')
+        self.assertCountEqual(os.listdir(os.path.join(self.output_dir, 'Attachments', 'Chat')), [first_webp, second_photo])
+
+        with open(os.path.join(self.output_dir, 'Chat.html'), encoding='utf-8') as f:
+            self.assertIn(f'src="Attachments/Chat/{first_webp}"', f.read())
+
+        with open(os.path.join(self.output_dir, 'Attachments', 'Chat', first_webp), 'rb') as f:
+            self.assertEqual(f.read(12)[8:], b'WEBP')
+
+
+class ChatManifestTest(ChatTestCase):
+    """Check the manifest of formatted chats that index.html lists."""
+
+    def test_entries_after_formatting(self) -> None:
+        """Every formatted chat has an entry with a summary of its messages and attachments."""
+        first_zip = os.path.join(self.directory, 'First.zip')
+        make_simple_chat(first_zip)
+
+        second_zip = os.path.join(self.directory, 'Second.zip')
+        make_chat_zip(second_zip, ['[05/11/2020, 10:00:00] Carol created group "Friends"',
+                                   '[05/11/2020, 10:01:00] Carol: Welcome',
+                                   '[06/11/2020, 11:00:00] Dave: Thanks'])
+
+        first_chat = (first_zip, False, 'Alice', 'First', 'First', self.output_dir)
+        second_chat = (second_zip, True, 'Carol', 'Friends', 'Second', self.output_dir)
+
+        self.assertEqual(self.format_chats([first_chat, second_chat]), [])
+
+        # The chats finish in any order
+        entries = sorted(ChatManifest(self.output_dir).read(), key=lambda entry: entry['html_path'])
+        self.assertEqual([entry['html_path'] for entry in entries], ['First.html', 'Second.html'])
+
+        first_entry, second_entry = entries
+        self.assertEqual((first_entry['title'], first_entry['group_chat'], first_entry['participants']),
+                         ('First', False, ['Alice', 'Bob']))
+        self.assertEqual((first_entry['messages'], first_entry['first'], first_entry['last']),
+                         (4, '2020-11-02T21:47:19', '2020-11-03T08:00:00'))
+        self.assertEqual(first_entry['attachment_bytes'], len(b'not really a photo'))
+
+        self.assertEqual((second_entry['title'], second_entry['group_chat'], second_entry['participants']),
+                         ('Friends', True, ['Carol', 'Dave']))
+        self.assertEqual((second_entry['messages'], second_entry['attachment_bytes']), (3, 0))
+
+        # index.html loads chats.js, which has every entry that chats.jsonl has
+        self.assertTrue(os.path.isfile(os.path.join(self.output_dir, 'index.html')))
+
+        with open(os.path.join(self.output_dir, 'chats.js'), encoding='utf-8') as f:
+            data_lines = f.read().splitlines()
+
+        self.assertEqual(len(data_lines), 2)
+        self.assertTrue(all(line.startswith('ChatIndex.add({') for line in data_lines))
+
+    def test_compaction_and_cut_off_lines(self) -> None:
+        """A line cut off by a crash is dropped, and a manifest that keeps growing is compacted to the newest entry of every chat."""
+        os.makedirs(self.output_dir)
+        manifest = ChatManifest(self.output_dir)
+        manifest.add({'html_path': 'First.html', 'title': 'First'})
+
+        with open(os.path.join(self.output_dir, 'chats.jsonl'), 'a', encoding='utf-8') as f:
+            f.write('{"html_path": "Cut')
+
+        old_min_compaction_size = ChatManifest.min_compaction_size
+        ChatManifest.min_compaction_size = 0
+
+        try:
+            for number in range(50):
+                manifest.add({'html_path': 'Second.html', 'title': f'Second {number}'})
+        finally:
+            ChatManifest.min_compaction_size = old_min_compaction_size
+
+        self.assertEqual(manifest.read(), [{'html_path': 'First.html', 'title': 'First'},
+                                           {'html_path': 'Second.html', 'title': 'Second 49'}])
+
+        for filename in ('chats.jsonl', 'chats.js'):
+            with open(os.path.join(self.output_dir, filename), encoding='utf-8') as f:
+                self.assertLess(len(f.read().splitlines()), 10, f'{filename} was never compacted')
+
+
+class ResourceGovernorTest(ChatTestCase):
+    """Check the budgets of the resource governor, and that chats finish with tiny budgets."""
+
+    def test_budgets(self) -> None:
+        """Work waits until it fits in the budget, except work bigger than the whole budget, which runs on its own."""
+        governor = ResourceGovernor(extraction_bytes=1000, transcodes=1, memory_bytes=100)
+
+        governor.acquire(memory_bytes=60, transcodes=1)
+        self.assertFalse(governor.try_acquire(memory_bytes=60))
+        self.assertFalse(governor.try_acquire(transcodes=1))
+        self.assertTrue(governor.try_acquire(memory_bytes=40))
+
+        acquired = threading.Event()
+        thread = threading.Thread(target=lambda: (governor.acquire(memory_bytes=500), acquired.set()), daemon=True)
+        thread.start()
+
+        governor.release(memory_bytes=40)
+        self.assertFalse(acquired.wait(0.2), 'Work bigger than the budget ran alongside other work')
+
+        governor.release(memory_bytes=60, transcodes=1)
+        self.assertTrue(acquired.wait(10), 'Work bigger than the budget never ran')
+        thread.join()
+
+        governor.release(memory_bytes=500)
+        report = governor.report()
+
+        self.assertEqual(report['limits'], {'extraction_bytes': 1000, 'transcodes': 1, 'memory_bytes': 100})
+        self.assertEqual(report['in_use'], {'extraction_bytes': 0, 'transcodes': 0, 'memory_bytes': 0})
+        self.assertEqual(report['peak'], {'extraction_bytes': 0, 'transcodes': 1, 'memory_bytes': 500})
+        self.assertEqual(report['waits'], 1)
+
+    def test_extraction_budget_smaller_than_every_chat(self) -> None:
+        """Chats that are each bigger than the extraction budget are formatted one at a time, and all of them finish."""
+        list_of_chats = []
+
+        for name in ('First', 'Second', 'Third'):
+            zip_path = os.path.join(self.directory, f'{name}.zip')
+            make_simple_chat(zip_path)
+            list_of_chats.append((zip_path, False, 'Alice', name, name, self.output_dir))
+
+        with zipfile.ZipFile(zip_path) as zip_file:
+            chat_size = sum(info.file_size for info in zip_file.infolist())
+
+        governor = ResourceGovernor(extraction_bytes=1)
+
+        self.assertEqual(self.format_chats(list_of_chats, governor=governor, index_page=False), [])
+
+        for name in ('First', 'Second', 'Third'):
+            self.assertTrue(os.path.isfile(os.path.join(self.output_dir, f'{name}.html')))
+
+        report = governor.report()
+        self.assertEqual(report['in_use']['extraction_bytes'], 0)
+        self.assertEqual(report['peak']['extraction_bytes'], chat_size)
+
+    @unittest.skipUnless(has_pillow, 'Pillow is needed to recompress images')
+    def test_recompressed_images_with_tiny_memory_budget(self) -> None:
+        """The attachment thread gives back the memory of its images before it waits for the text pass, which might need it."""
+        import images
+
+        photos = {f'{i:08}-PHOTO-2020-11-02-21-49-51.jpg': make_photo(i) for i in range(10)}
+        lines = []
+
+        # Every chunk of the text refers to one photo, so the attachment thread runs out of references while the
+        # memory of the photo is still held
+        for i, filename in enumerate(photos):
+            lines.extend(f'[02/11/2020, 21:{i:02}:19] Alice: Message {j} before photo {i} ' + 'x' * 100
+                         for j in range(300))
+            lines.append(f'[02/11/2020, 21:{i:02}:20] Bob: \u200e<attached: {filename}>')
+
+        zip_path = os.path.join(self.directory, 'Photos.zip')
+        make_chat_zip(zip_path, lines, photos)
+
+        old_threshold, old_chunk_size = library.Chat.parallel_parsing_threshold, library.Chat.parse_chunk_size
+        library.Chat.parallel_parsing_threshold = 0
+        library.Chat.parse_chunk_size = 40 * 1024
+
+        try:
+            rejected_chats = self.format_chats(
+                [(zip_path, False, 'Alice', 'Photos', 'Photos', self.output_dir)],
+                governor=PoliteResourceGovernor(memory_bytes=100000), index_page=False,
+                image_settings=images.ImageSettings(cache_dir=os.path.join(self.directory, 'cache')))
+        finally:
+            library.Chat.parallel_parsing_threshold, library.Chat.parse_chunk_size = old_threshold, old_chunk_size
+
+        self.assertEqual(rejected_chats, [])
+        self.assertEqual(len(os.listdir(os.path.join(self.output_dir, 'Attachments', 'Photos'))), len(photos))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,228 @@
+# WhatsApp-Formatter is a program that takes exported WhatsApp chats and
+# formats them into more readable HTML files, with embedded attachments.
+#
+# Copyright (C) 2020 Doctor Dalek <https://github.com/DoctorDalek1963>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""This module tests server.py against a real ChatServer on localhost. Run it with python -m unittest or pytest.
+
+Classes:
+    ChatServerTest:
+        Start a ChatServer on a free port with the example chat and some broken ones, and check what it sends back.
+
+    PageCacheTest:
+        Check that the on-disk page cache stays within its limit.
+
+"""
+
+import http.client
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import zipfile
+
+from server import ChatServer, PageCache
+
+# The server reads the templates and the Library folder from the working directory
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+photo_name = '00000010-PHOTO-2020-11-02-21-49-51.jpg'
+video_name = '00000001-VIDEO-2020-11-02-21-48-19.mp4'
+
+
+class ChatServerTest(unittest.TestCase):
+    """Start a ChatServer on a free port with the example chat and some broken ones, and check what it sends back."""
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """Make a directory of chats and start serving it in a background thread."""
+        cls._old_cwd = os.getcwd()
+        os.chdir(repo_dir)
+
+        cls._chats_dir = tempfile.mkdtemp()
+        shutil.copy(os.path.join('Example', 'Example.zip'), cls._chats_dir)
+
+        with zipfile.ZipFile(os.path.join(cls._chats_dir, 'NoChat.zip'), 'w') as zip_file:
+            zip_file.writestr(photo_name, b'not really a photo')
+
+        with zipfile.ZipFile(os.path.join(cls._chats_dir, 'BadFormat.zip'), 'w') as zip_file:
+            zip_file.writestr('_chat.txt', 'This line has no date or sender\n')
+
+        with zipfile.ZipFile(os.path.join(cls._chats_dir, 'Video.zip'), 'w') as zip_file:
+            zip_file.writestr('_chat.txt', f'[02/11/2020, 21:48:19] Bob: \u200e<attached: {video_name}>\n')
+            zip_file.writestr(video_name, b'not really a video')
+
+        with open(os.path.join(cls._chats_dir, 'Corrupt.zip'), 'wb') as f:
+            f.write(b'This is not a zip file')
+
+        with zipfile.ZipFile(os.path.join('Example', 'Example.zip')) as zip_file:
+            cls._photo = zip_file.read(photo_name)
+
+        cls._server = ChatServer(('127.0.0.1', 0), cls._chats_dir, os.path.join(cls._chats_dir, '.cache'),
+                                 {'sender_name': 'Alice'})
+        cls._thread = threading.Thread(target=cls._server.serve_forever, daemon=True)
+        cls._thread.start()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        """Stop the server and remove the directory of chats."""
+        cls._server.shutdown()
+        cls._server.server_close()
+        shutil.rmtree(cls._chats_dir)
+        os.chdir(cls._old_cwd)
+
+    def _get(self, path: str, headers: dict = None):
+        """Send a GET request to the server and return the response and its body."""
+        connection = http.client.HTTPConnection('127.0.0.1', self._server.server_address[1], timeout=30)
+
+        try:
+            connection.request('GET', path, headers=headers or {})
+            response = connection.getresponse()
+            return response, response.read()
+        finally:
+            connection.close()
+
+    def test_index(self) -> None:
+        """The index links to every chat."""
+        response, body = self._get('/')
+
+        self.assertEqual(response.status, 200)
+        self.assertIn(b'href="Example/"', body)
+
+    def test_page(self) -> None:
+        """A chat's page is rendered with its messages and links to its attachments."""
+        response, body = self._get('/Example/')
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader('Content-Type'), 'text/html; charset=utf-8')
+        self.assertIn(f'src="Attachments/Example/{photo_name}"'.encode('utf-8'), body)
+
+    def test_video_without_poster(self) -> None:
+        """The server doesn't make posters, so a video's tag doesn't link to one."""
+        response, body = self._get('/Video/')
+
+        self.assertEqual(response.status, 200)
+        self.assertIn(f'<source src="Attachments/Video/{video_name}">'.encode('utf-8'), body)
+        self.assertNotIn(b'poster=', body)
+
+    def test_attachment(self) -> None:
+        """An attachment is streamed whole out of the zip file."""
+        response, body = self._get(f'/Example/Attachments/Example/{photo_name}')
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader('Content-Type'), 'image/jpeg')
+        self.assertEqual(body, self._photo)
+
+    def test_range_request(self) -> None:
+        """A range request only gets the bytes it asked for."""
+        response, body = self._get(f'/Example/Attachments/Example/{photo_name}', {'Range': 'bytes=100-199'})
+
+        self.assertEqual(response.status, 206)
+        self.assertEqual(response.getheader('Content-Range'), f'bytes 100-199/{len(self._photo)}')
+        self.assertEqual(body, self._photo[100:200])
+
+    def test_unsatisfiable_range(self) -> None:
+        """A range past the end of the attachment is rejected."""
+        response, _ = self._get(f'/Example/Attachments/Example/{photo_name}', {'Range': f'bytes={len(self._photo)}-'})
+
+        self.assertEqual(response.status, 416)
+
+    def test_multiple_ranges(self) -> None:
+        """A request for several ranges gets the whole attachment, because the server ignores ranges it doesn't support."""
+        response, body = self._get(f'/Example/Attachments/Example/{photo_name}', {'Range': 'bytes=0-99,200-299'})
+
+        self.assertEqual(response.status, 200)
+        self.assertIsNone(response.getheader('Content-Range'))
+        self.assertEqual(body, self._photo)
+
+    def test_missing_chat(self) -> None:
+        """A chat that doesn't exist is 404."""
+        response, _ = self._get('/Nothing/')
+
+        self.assertEqual(response.status, 404)
+
+    def test_missing_attachment(self) -> None:
+        """An attachment that isn't in the zip file is 404."""
+        response, _ = self._get('/Example/Attachments/Example/nothing.jpg')
+
+        self.assertEqual(response.status, 404)
+
+    def test_missing_chat_txt(self) -> None:
+        """A zip file without _chat.txt is 404."""
+        response, _ = self._get('/NoChat/')
+
+        self.assertEqual(response.status, 404)
+
+    def test_bad_format(self) -> None:
+        """A chat that doesn't match any format is 500, and the server carries on."""
+        response, _ = self._get('/BadFormat/')
+
+        self.assertEqual(response.status, 500)
+        self.assertEqual(self._get('/Example/')[0].status, 200)
+
+    def test_corrupt_zip(self) -> None:
+        """A corrupt zip file is 500, for its page and its attachments."""
+        self.assertEqual(self._get('/Corrupt/')[0].status, 500)
+        self.assertEqual(self._get(f'/Corrupt/Attachments/Corrupt/{photo_name}')[0].status, 500)
+
+    def test_render_locks_forgotten(self) -> None:
+        """A chat's render lock is only kept while its page is being fetched, however many requests there were."""
+        threads = [threading.Thread(target=self._get, args=(f'/{name}/',)) for name in ('Example', 'Video', 'BadFormat') * 4]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self._server._render_locks, {})
+
+
+class PageCacheTest(unittest.TestCase):
+    """Check that the on-disk page cache stays within its limit."""
+
+    def setUp(self) -> None:
+        """Make a temporary directory for the cache."""
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        """Remove the temporary directory."""
+        shutil.rmtree(self.directory)
+
+    def test_disk_cache_pruned(self) -> None:
+        """The least recently used pages are removed from the disk, and the rest survive a restart."""
+        cache = PageCache(self.directory, max_pages=1, max_disk_pages=3)
+
+        for number in range(3):
+            cache.put(f'page {number}', f'Page {number}'.encode('utf-8'))
+            os.utime(cache._disk_path(f'page {number}'), ns=(number, number))
+
+        # Reading page 0 from the disk makes it the most recently used one, so page 1 is removed instead
+        self.assertEqual(cache.get('page 0'), b'Page 0')
+        cache.put('page 3', b'Page 3')
+
+        self.assertEqual(len(os.listdir(self.directory)), 3)
+
+        restarted_cache = PageCache(self.directory)
+        self.assertIsNone(restarted_cache.get('page 1'))
+
+        for number in (0, 2, 3):
+            self.assertEqual(restarted_cache.get(f'page {number}'), f'Page {number}'.encode('utf-8'))
+
+
+if __name__ == '__main__':
+    unittest.main()
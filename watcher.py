@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+
+# WhatsApp-Formatter is a program that takes exported WhatsApp chats and
+# formats them into more readable HTML files, with embedded attachments.
+#
+# Copyright (C) 2020 Doctor Dalek <https://github.com/DoctorDalek1963>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""This module runs the WhatsApp Formatter as a daemon, which formats every zip file that's dropped into an inbox directory.
+
+The daemon stays running, so its chat threads and the shared parse and video pools in library are only started once,
+instead of once per batch. Every new zip file in the inbox is formatted as soon as it has been completely written,
+and then it's moved to the done directory, or to the failed directory with a .error.txt file explaining why.
+
+A chat's settings come from the defaults given to the daemon, then from an optional JSON defaults file, and then from
+a JSON sidecar file next to the zip file, like with server.py. The sidecar has to be in the inbox before the zip file
+is finished. As well as the settings of load_chat_settings() in server.py, a sidecar or defaults file can set
+output_dir, precompress, and virtualized.
+
+The inbox is watched with inotify on Linux, and polled everywhere else.
+
+Classes:
+    InboxWatcher:
+        A watcher of a directory, which returns the zip files in it once they've been completely written.
+
+    WatchDaemon:
+        The daemon, which formats every zip file that arrives in its inbox in a long-lived pool of chat threads.
+
+Functions:
+    run_daemon(inbox_dir: str, output_dir: str, **keyword_arguments) -> None:
+        Watch inbox_dir and format every chat that arrives in it until interrupted.
+
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import select
+import shutil
+import signal
+import struct
+import sys
+import threading
+import time
+import traceback
+from typing import List, Optional
+
+from cli import print_resource_report
+from library import ResourceGovernor, get_parse_executor, get_resource_governor, make_chat_key, process_chat
+from server import load_chat_settings
+
+# The inotify constants from <sys/inotify.h>
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = 0o2000000
+
+# The header of every struct inotify_event, which is followed by a name of the given length
+_inotify_event_header = struct.Struct('iIII')
+
+
+def _open_inotify(directory: str) -> Optional[int]:
+    """Return an inotify file descriptor watching directory for finished files, or None if inotify isn't available."""
+    if not sys.platform.startswith('linux'):
+        return None
+
+    try:
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+
+        if (fd := libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)) < 0:
+            return None
+    except (OSError, AttributeError):
+        return None
+
+    if libc.inotify_add_watch(fd, os.fsencode(directory), _IN_CLOSE_WRITE | _IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+
+    return fd
+
+
+def _unique_path(directory: str, filename: str) -> str:
+    """Return the path of filename in directory, with a number added to its name if that file already exists."""
+    filename_no_ext, extension = os.path.splitext(filename)
+    path = os.path.join(directory, filename)
+    number = 1
+
+    while os.path.exists(path):
+        path = os.path.join(directory, f'{filename_no_ext} ({number}){extension}')
+        number += 1
+
+    return path
+
+
+class InboxWatcher:
+    """A watcher of a directory, which returns the zip files in it once they've been completely written.
+
+    A zip file is finished when inotify reports that it was closed after writing or moved into the directory.
+    Without inotify, or for files that were already there, it's finished when it hasn't been modified for
+    settle_time seconds. Hidden files are ignored, so a copy to a hidden temporary name that's renamed when it's
+    done is safe as well.
+
+    Methods:
+        wait_for_chats() -> List[str]:
+            Wait up to poll_interval seconds and return the paths of any newly finished zip files.
+
+        forget(path: str) -> None:
+            Forget a zip file after it has been moved out of the directory.
+
+        close() -> None:
+            Stop watching the directory.
+
+    """
+
+    def __init__(self, directory: str, poll_interval: float = 2.0, settle_time: float = 2.0, use_inotify: bool = True):
+        """Create an InboxWatcher object.
+
+        Arguments:
+            directory: str:
+                The directory to watch. Only the zip files directly in it are returned.
+
+        Keyword arguments:
+            poll_interval: float:
+                The maximum number of seconds between two scans of the directory.
+
+            settle_time: float:
+                The number of seconds a zip file has to be left alone before it counts as finished, if inotify
+                didn't report it.
+
+            use_inotify: bool:
+                If False, always poll the directory, even on Linux.
+
+        """
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+
+        self._inotify_fd = _open_inotify(directory) if use_inotify else None
+        self._finished_names = set()
+        self._returned_paths = set()
+
+    @property
+    def using_inotify(self) -> bool:
+        """True if the directory is watched with inotify, and False if it's polled."""
+        return self._inotify_fd is not None
+
+    def _read_inotify_events(self) -> None:
+        """Read every waiting inotify event and remember the names of the files that were finished."""
+        while True:
+            try:
+                data = os.read(self._inotify_fd, 64 * 1024)
+            except BlockingIOError:
+                return
+
+            offset = 0
+            while offset < len(data):
+                _, _, _, length = _inotify_event_header.unpack_from(data, offset)
+                offset += _inotify_event_header.size
+
+                if (name := os.fsdecode(data[offset:offset + length].rstrip(b'\0'))).lower().endswith('.zip'):
+                    self._finished_names.add(name)
+
+                offset += length
+
+    def wait_for_chats(self) -> List[str]:
+        """Wait up to poll_interval seconds and return the paths of any newly finished zip files, in name order.
+
+        Every zip file is only returned once, until forget() is called with its path.
+        """
+        if self._inotify_fd is not None:
+            if select.select([self._inotify_fd], [], [], self.poll_interval)[0]:
+                self._read_inotify_events()
+        else:
+            time.sleep(self.poll_interval)
+
+        now = time.time()
+        finished_paths = []
+
+        for entry in sorted(os.scandir(self.directory), key=lambda e: e.name):
+            if entry.name.startswith('.') or not entry.name.lower().endswith('.zip') or \
+                    entry.path in self._returned_paths:
+                continue
+
+            try:
+                if not entry.is_file():
+                    continue
+
+                settled = now - entry.stat().st_mtime >= self.settle_time
+            except FileNotFoundError:  # It was moved or deleted since the scan
+                continue
+
+            if settled or entry.name in self._finished_names:
+                self._finished_names.discard(entry.name)
+                self._returned_paths.add(entry.path)
+                finished_paths.append(entry.path)
+
+        return finished_paths
+
+    def forget(self, path: str) -> None:
+        """Forget a zip file after it has been moved out of the directory, so a new file with the same name is returned."""
+        self._returned_paths.discard(path)
+
+    def close(self) -> None:
+        """Stop watching the directory."""
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
+
+
+class WatchDaemon:
+    """The daemon, which formats every zip file that arrives in its inbox in a long-lived pool of chat threads.
+
+    Attributes:
+        using_inotify: bool:
+            True if the inbox is watched with inotify, and False if it's polled.
+
+        governor: ResourceGovernor:
+            The governor shared by every chat that the daemon formats.
+
+    Methods:
+        warm_up() -> None:
+            Start the shared parse pool's processes and import pydub, so that the first chat doesn't wait for them.
+
+        run() -> None:
+            Watch the inbox and format every chat that arrives until stop() is called.
+
+        stop() -> None:
+            Make run() return once the chats that have already started are finished. This is safe to call from
+            a signal handler or another thread.
+
+    """
+
+    def __init__(self, inbox_dir: str, output_dir: str, done_dir: str = None, failed_dir: str = None,
+                 defaults: dict = None, workers: int = 2, poll_interval: float = 2.0, settle_time: float = 2.0,
+                 use_inotify: bool = True, governor: ResourceGovernor = None):
+        """Create a WatchDaemon object.
+
+        Arguments:
+            inbox_dir: str:
+                The directory to watch for exported zip files.
+
+            output_dir: str:
+                The default output directory for every chat.
+
+        Keyword arguments:
+            done_dir: str:
+                The directory to move the zip files of finished chats to. It defaults to inbox_dir/done.
+
+            failed_dir: str:
+                The directory to move the zip files of failed chats to. It defaults to inbox_dir/failed.
+
+            defaults: dict:
+                The default settings for every chat, which are overridden by sidecar files.
+                See load_chat_settings() in server.py.
+
+            workers: int:
+                The number of chats to format at once.
+
+            poll_interval, settle_time, use_inotify:
+                Passed to InboxWatcher.
+
+            governor: ResourceGovernor:
+                The governor that limits the disk space, transcodes, and memory that the chats use at once.
+                It defaults to the one from get_resource_governor().
+
+        """
+        self.inbox_dir = inbox_dir
+        self.done_dir = done_dir if done_dir is not None else os.path.join(inbox_dir, 'done')
+        self.failed_dir = failed_dir if failed_dir is not None else os.path.join(inbox_dir, 'failed')
+
+        self._defaults = {'output_dir': output_dir, 'precompress': False, 'virtualized': False}
+        self._defaults.update(defaults or {})
+
+        self.governor = governor if governor is not None else get_resource_governor()
+
+        self._watcher = InboxWatcher(inbox_dir, poll_interval=poll_interval, settle_time=settle_time,
+                                     use_inotify=use_inotify)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='chat')
+        self._stop_event = threading.Event()
+
+        # The last stage that every chat in progress reported, to tell whether it finished
+        self._stages = {}
+        self._stages_lock = threading.Lock()
+
+        os.makedirs(self.done_dir, exist_ok=True)
+        os.makedirs(self.failed_dir, exist_ok=True)
+
+    @property
+    def using_inotify(self) -> bool:
+        """True if the inbox is watched with inotify, and False if it's polled."""
+        return self._watcher.using_inotify
+
+    def warm_up(self) -> None:
+        """Start the shared parse pool's processes and import pydub, so that the first chat doesn't wait for them."""
+        parse_executor = get_parse_executor()
+        for future in [parse_executor.submit(os.getpid) for _ in range(os.cpu_count() or 1)]:
+            future.result()
+
+        try:
+            # pydub looks for ffmpeg when it's imported, which is slow
+            import pydub  # noqa: F401
+        except ImportError:
+            pass
+
+    def _move_chat(self, zip_path: str, directory: str, error: str = None) -> str:
+        """Move a zip file and its sidecar file into directory, and write error next to them if it's given.
+
+        Returns:
+            The new path of the zip file.
+
+        """
+        new_zip_path = _unique_path(directory, os.path.basename(zip_path))
+        shutil.move(zip_path, new_zip_path)
+
+        # The sidecar and error files are named after the zip file, which might have had a number added to its name
+        new_path_no_ext = os.path.splitext(new_zip_path)[0]
+
+        if os.path.isfile(sidecar_path := os.path.splitext(zip_path)[0] + '.json'):
+            shutil.move(sidecar_path, new_path_no_ext + '.json')
+
+        if error is not None:
+            with open(new_path_no_ext + '.error.txt', 'w', encoding='utf-8') as f:
+                f.write(error)
+
+        return new_zip_path
+
+    def _record_stage(self, chat_key: str, progress: dict) -> None:
+        """Remember the stage of a chat. This is the event sink of every chat."""
+        with self._stages_lock:
+            self._stages[chat_key] = progress['stage']
+
+    def _format_chat(self, zip_path: str) -> None:
+        """Format one chat with its settings, and then move it to the done or failed directory."""
+        name = os.path.basename(zip_path)
+        chat_key = None
+        error = None
+
+        try:
+            settings = load_chat_settings(zip_path, self._defaults)
+            chat_key = make_chat_key(zip_path, settings['html_file_name'], settings['output_dir'])
+            print(f'Formatting {name}')
+
+            process_chat(zip_path, settings['group_chat'], settings['sender_name'], settings['chat_title'],
+                         settings['html_file_name'], settings['output_dir'], event_sink=self._record_stage,
+                         event_interval=float('inf'), precompress=settings['precompress'],
+                         virtualized=settings['virtualized'], governor=self.governor)
+
+            if (stage := self._stages.get(chat_key)) != 'done':
+                error = f'The chat stopped at the {stage} stage.\n'
+        except Exception:
+            error = traceback.format_exc()
+        finally:
+            with self._stages_lock:
+                self._stages.pop(chat_key, None)
+
+        try:
+            if error is not None:
+                print(f'Failed to format {name}, moved it to {self._move_chat(zip_path, self.failed_dir, error)}')
+            else:
+                print(f'Formatted {name}, moved it to {self._move_chat(zip_path, self.done_dir)}')
+        finally:
+            self._watcher.forget(zip_path)
+
+    def _format_chat_safely(self, zip_path: str) -> None:
+        """Call _format_chat(), and report anything that went wrong while moving the chat, so the thread keeps going."""
+        try:
+            self._format_chat(zip_path)
+        except Exception:
+            print(f'Couldn\'t move {os.path.basename(zip_path)} out of the inbox:')
+            traceback.print_exc()
+
+    def run(self) -> None:
+        """Watch the inbox and format every chat that arrives until stop() is called.
+
+        The chats that have already started are finished before this returns, and the rest are left in the inbox.
+        """
+        futures = set()
+
+        try:
+            while not self._stop_event.is_set():
+                futures = {future for future in futures if not future.done()}
+
+                for zip_path in self._watcher.wait_for_chats():
+                    futures.add(self._executor.submit(self._format_chat_safely, zip_path))
+        finally:
+            for future in futures:
+                future.cancel()
+
+            self._executor.shutdown(wait=True)
+            self._watcher.close()
+
+    def stop(self) -> None:
+        """Make run() return once the chats that have already started are finished."""
+        self._stop_event.set()
+
+
+def run_daemon(inbox_dir: str, output_dir: str, done_dir: str = None, failed_dir: str = None, defaults_file: str = None,
+               sender_name: str = '', group_chat: bool = False, precompress: bool = False, virtualized: bool = False,
+               workers: int = 2, poll_interval: float = 2.0, use_inotify: bool = True,
+               governor: ResourceGovernor = None) -> None:
+    """Watch inbox_dir and format every chat that arrives in it until interrupted or sent SIGTERM.
+
+    Arguments:
+        inbox_dir: str:
+            The directory to watch for exported zip files.
+
+        output_dir: str:
+            The default output directory for every chat.
+
+    Keyword arguments:
+        done_dir: str:
+            The directory for the zip files of finished chats. It defaults to inbox_dir/done.
+
+        failed_dir: str:
+            The directory for the zip files of failed chats. It defaults to inbox_dir/failed.
+
+        defaults_file: str:
+            An optional JSON file of default settings for every chat, which override the keyword arguments below.
+
+        sender_name: str:
+            The default name of the sender, for chats without a sidecar JSON file.
+
+        group_chat: bool:
+            Whether chats without a sidecar JSON file are group chats.
+
+        precompress: bool:
+            Whether to precompress the output of chats without a sidecar JSON file. See process_chat().
+
+        virtualized: bool:
+            Whether to write chats without a sidecar JSON file for the virtualized viewer. See process_chat().
+
+        workers: int:
+            The number of chats to format at once.
+
+        poll_interval: float:
+            The maximum number of seconds between two scans of the inbox.
+
+        use_inotify: bool:
+            If False, always poll the inbox, even on Linux.
+
+        governor: ResourceGovernor:
+            The governor that limits the disk space, transcodes, and memory that the chats use at once.
+            Its report is printed when the daemon stops.
+
+    """
+    defaults = {'sender_name': sender_name, 'group_chat': group_chat, 'precompress': precompress,
+                'virtualized': virtualized}
+
+    if defaults_file is not None:
+        with open(defaults_file, 'r', encoding='utf-8') as f:
+            defaults.update(json.load(f))
+
+    daemon = WatchDaemon(inbox_dir, output_dir, done_dir, failed_dir, defaults, workers=workers,
+                         poll_interval=poll_interval, use_inotify=use_inotify, governor=governor)
+
+    signal.signal(signal.SIGTERM, lambda signal_number, frame: daemon.stop())
+
+    daemon.warm_up()
+    print(f'Watching {inbox_dir} with {"inotify" if daemon.using_inotify else "polling"}')
+
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        daemon.stop()
+
+    print_resource_report(daemon.governor.report())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Format every exported WhatsApp chat that is dropped into a directory.')
+    parser.add_argument('inbox_dir', help='the directory to watch for exported zip files')
+    parser.add_argument('output_dir', help='the default output directory')
+    parser.add_argument('--done-dir', help='where to move finished zip files (default: INBOX_DIR/done)')
+    parser.add_argument('--failed-dir', help='where to move failed zip files (default: INBOX_DIR/failed)')
+    parser.add_argument('--defaults', help='a JSON file of default settings for every chat')
+    parser.add_argument('--sender-name', default='', help='the default sender name (your WhatsApp alias)')
+    parser.add_argument('--group-chat', action='store_true', help='treat chats without a sidecar file as group chats')
+    parser.add_argument('--precompress', action='store_true', help='write .gz (and .br) files next to the output')
+    parser.add_argument('--virtualized', action='store_true', help='write chats for the virtualized viewer')
+    parser.add_argument('--workers', type=int, default=2, help='the number of chats to format at once (default: 2)')
+    parser.add_argument('--poll-interval', type=float, default=2.0,
+                        help='the maximum number of seconds between two scans of the inbox (default: 2)')
+    parser.add_argument('--poll', action='store_true', help='poll the inbox even if inotify is available')
+    parser.add_argument('--max-extraction-gb', type=float, default=None,
+                        help='the most GiB of zip files to extract at once (default: half the free disk space)')
+    parser.add_argument('--max-transcodes', type=int, default=None,
+                        help='the most audio and video conversions to run at once (default: the number of CPUs)')
+    parser.add_argument('--max-memory-gb', type=float, default=None,
+                        help='the most GiB of memory for work in flight (default: half the physical memory)')
+    args = parser.parse_args()
+
+    run_daemon(args.inbox_dir, args.output_dir, args.done_dir, args.failed_dir, args.defaults, args.sender_name,
+               args.group_chat, args.precompress, args.virtualized, args.workers, args.poll_interval, not args.poll,
+               ResourceGovernor(
+                   extraction_bytes=int(args.max_extraction_gb * 1024 ** 3) if args.max_extraction_gb is not None else None,
+                   transcodes=args.max_transcodes,
+                   memory_bytes=int(args.max_memory_gb * 1024 ** 3) if args.max_memory_gb is not None else None))